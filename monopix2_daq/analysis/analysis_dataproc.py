@@ -18,7 +18,7 @@ loglevel = logging.INFO
 
 
 class Analysis():
-    def __init__(self, raw_data_file=None, cluster_hits=False, build_events=False, build_events_simple=False):
+    def __init__(self, raw_data_file=None, cluster_hits=False, build_events=False, build_events_simple=False, n_threads=1):
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(loglevel)
@@ -31,6 +31,8 @@ class Analysis():
 
         self.raw_data_file = raw_data_file
         self.chunk_size = 200000
+        # Number of threads for the raw data interpretation, None: number of CPUs. Every thread interprets one chunk per step.
+        self.n_threads = n_threads
         self.cluster_hits = cluster_hits
         if self.cluster_hits:
             self._setup_clusterizer()
@@ -265,14 +267,31 @@ class Analysis():
                     hist_cs_tot = np.zeros(shape=(100, ), dtype=np.uint32)
                     hist_cs_shape = np.zeros(shape=(300, ), dtype=np.int32)
 
+                # Histograms are filled chunk by chunk, so the hit table does not have to be read again
+                scan_id = in_file.root.meta_data.attrs["scan_id"]
+                hist_occ = np.zeros(shape=(COL_SIZE, ROW_SIZE), dtype=np.uint32)
+                hist_scurve, tot_sums, injected_steps = None, None, None
+                if scan_id in ["scan_threshold"]:
+                    scan_param_range = self._get_scan_param_range()
+                    # Adaptive threshold scan: Injected scan parameters of every pixel
+                    if "/InjectedSteps" in in_file:
+                        injected_steps = in_file.root.InjectedSteps[:]
+                    hist_scurve = np.zeros(shape=(COL_SIZE, ROW_SIZE, len(scan_param_range)), dtype=np.uint16)
+                    tot_sums = np.zeros(shape=(COL_SIZE, ROW_SIZE, len(scan_param_range)), dtype=np.uint16)
+
                 start = 0
 
-                data_interpreter = interpreter.RawDataInterpreter()
+                if self.n_threads == 1:
+                    data_interpreter = interpreter.RawDataInterpreter()
+                    step_size = self.chunk_size
+                else:
+                    data_interpreter = interpreter.ParallelRawDataInterpreter(n_threads=self.n_threads)
+                    step_size = self.chunk_size * data_interpreter.n_threads
+                hit_buffer = np.zeros(shape=step_size, dtype=hit_dtype)
                 pbar = tqdm(total=n_words)
                 while start < n_words:
-                    tmp_end = min(n_words, start + self.chunk_size)
+                    tmp_end = min(n_words, start + step_size)
                     raw_data = in_file.root.raw_data[start:tmp_end]
-                    hit_buffer = np.zeros(shape=self.chunk_size, dtype=hit_dtype)
 
                     hit_dat = data_interpreter.interpret(
                         raw_data,
@@ -295,6 +314,14 @@ class Analysis():
                     hit_table.append(hit_dat)
                     hit_table.flush()
 
+                    if scan_id in ["scan_threshold"]:
+                        hits = hit_dat[hit_dat["cnt"] < 2]
+                        au.fill_scurve_hist3d(hits, hist_scurve)
+                        au.fill_tot_sum3d(hits, tot_sums)
+                    else:
+                        hits = hit_dat
+                    au.fill_occ_hist2d(hits, hist_occ)
+
                     """ 
                     if self.build_events:
                         ev_buffer = np.zeros(shape=self.chunk_size, dtype=event_dtype)
@@ -363,6 +390,8 @@ class Analysis():
                     pbar.update(tmp_end - start)
                     start = tmp_end
                 pbar.close()
+                if self.n_threads != 1:
+                    data_interpreter.close()
 
                 for value in in_file.root.meta_data.attrs._v_attrnamesuser:
                     out_file.root.Dut.attrs[value] = in_file.root.meta_data.attrs[value]
@@ -375,7 +404,7 @@ class Analysis():
 
                 in_file.root.kwargs._g_copy(out_file.root, "kwargs", recursive=True)
 
-                self._create_additional_hit_data()
+                self._create_additional_hit_data(hist_occ, hist_scurve, tot_sums, injected_steps)
                 self.logger.info("{:d} errors occured during analysis".format(data_interpreter.get_error_count()))
                 """
                 if self.build_events:
@@ -385,16 +414,15 @@ class Analysis():
                 if self.cluster_hits:
                     self._create_additional_cluster_data(hist_cs_size, hist_cs_tot, hist_cs_shape)
 
-    def _create_additional_hit_data(self):
+    def _get_scan_param_range(self):
+        return np.arange(self.scan_kwargs["injlist_param"][0],
+                         self.scan_kwargs["injlist_param"][1],
+                         self.scan_kwargs["injlist_param"][2])  # TODO: get from run configuration
+
+    def _create_additional_hit_data(self, hist_occ, hist_scurve=None, tot_sums=None, injected_steps=None):
+        ''' Store the histograms filled during the interpretation and the s-curve fit results '''
         with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
             scan_id = out_file.root.Dut.attrs["scan_id"]
-            if scan_id in ["scan_threshold"]:
-                hits_tmp = out_file.root.Dut[:]
-                hits=hits_tmp[hits_tmp["cnt"]<2]
-                hits_tmp = None
-            else:
-                hits = out_file.root.Dut[:]
-            hist_occ = au.occ_hist2d(hits)
 
             out_file.create_carray(out_file.root,
                                    name='HistOcc',
@@ -411,11 +439,9 @@ class Analysis():
                 #scan_param_range = np.arange(0, self.n_params + 1, 1)  # TODO: get from run configuration
 
                 n_injections = self.scan_kwargs["inj_n_param"]  # TODO: get from run configuration
-                scan_param_range = np.arange(self.scan_kwargs["injlist_param"][0],
-                                            self.scan_kwargs["injlist_param"][1],
-                                            self.scan_kwargs["injlist_param"][2])  # TODO: get from run configuration
-
-                hist_scurve = au.scurve_hist3d(hits, scan_param_range)
+                scan_param_range = self._get_scan_param_range()
+                if injected_steps is not None:
+                    hist_scurve = au.fill_unsampled_scurves(hist_scurve, injected_steps)
 
                 out_file.create_carray(out_file.root,
                                        name="HistSCurve",
@@ -425,8 +451,7 @@ class Analysis():
                                                           complevel=5,
                                                           fletcher32=False))
 
-                ave_tots = au.tot_ave3d(hits, scan_param_range)
-                ave_tots = np.array(ave_tots, dtype=np.float32) / np.array(hist_scurve, dtype=np.float32)
+                ave_tots = np.array(tot_sums, dtype=np.float32) / np.array(hist_scurve, dtype=np.float32)
                 out_file.create_carray(out_file.root,
                                        name="ToTAve",
                                        title="ToT average",
@@ -435,7 +460,7 @@ class Analysis():
                                                           complevel=5,
                                                           fletcher32=False))
 
-                self.threshold_map, self.noise_map, self.chi2_map = au.fit_scurves_multithread(
+                self.threshold_map, self.noise_map, self.chi2_map = au.fit_scurves_vectorized(
                     hist_scurve.reshape(COL_SIZE * ROW_SIZE, self.n_params + 1), scan_param_range, n_injections=n_injections, invert_x=False
                 )
 
@@ -1,7 +1,9 @@
 import ast
 import numba
+import queue
 import logging
 import numpy as np
+import tables as tb
 import multiprocessing as mp
 
 from tqdm import tqdm
@@ -134,42 +136,84 @@ def xy2d_morton(x, y):
 @numba.njit
 def occ_hist2d(hits):
     hist_occ = np.zeros(shape=(COL_SIZE, ROW_SIZE), dtype=np.uint32)
+    fill_occ_hist2d(hits, hist_occ)
+    return hist_occ
+
 
+@numba.njit
+def fill_occ_hist2d(hits, hist_occ):
+    '''
+        Add hits to an existing occupancy histogram (col, row)
+    '''
     for hit in hits:
         col = hit['col']
         row = hit['row']
         if col >= 0 and col < hist_occ.shape[0] and row >= 0 and row < hist_occ.shape[1]:
             hist_occ[col, row] += 1
 
-    return hist_occ
-
 
 @numba.njit
 def scurve_hist3d(hits, scan_param_range):
     hist_scurves = np.zeros(shape=(COL_SIZE, ROW_SIZE, len(scan_param_range)), dtype=np.uint16)
+    fill_scurve_hist3d(hits, hist_scurves)
+    return hist_scurves
+
 
+@numba.njit
+def fill_scurve_hist3d(hits, hist_scurves):
+    '''
+        Add hits to an existing s-curve histogram (col, row, scan_param_id)
+    '''
     for hit in hits:
         col = hit["col"]
         row = hit["row"]
         param = hit["scan_param_id"]
-        if col >= 0 and col < hist_scurves.shape[0] and row >= 0 and row < hist_scurves.shape[1]:
+        if col >= 0 and col < hist_scurves.shape[0] and row >= 0 and row < hist_scurves.shape[1] and param >= 0 and param < hist_scurves.shape[2]:
             hist_scurves[col, row, param] += 1
 
-    return hist_scurves
+
+def fill_unsampled_scurves(hist_scurves, sampled):
+    '''
+        Fills the s-curve histogram (col, row, scan_param_id) at the scan parameters which were not injected (adaptive threshold scan),
+        by linear interpolation between the injected scan parameters of every pixel. Pixels without injected scan parameters are not changed.
+    '''
+    scurves = np.reshape(hist_scurves, (-1, hist_scurves.shape[-1]))
+    sampled = np.reshape(sampled, scurves.shape)
+    sel = np.logical_and(np.any(sampled, axis=1), ~np.all(sampled, axis=1))
+    scurves, sampled = scurves[sel].astype(np.float64), sampled[sel]
+    steps = np.arange(scurves.shape[1])
+    # Previous and next injected scan parameter of every scan parameter, the first/last injected one outside of the injected range.
+    prev_step = np.maximum.accumulate(np.where(sampled, steps, -1), axis=1)
+    next_step = np.minimum.accumulate(np.where(sampled, steps, scurves.shape[1])[:, ::-1], axis=1)[:, ::-1]
+    prev_step = np.where(prev_step < 0, next_step, prev_step)
+    next_step = np.where(next_step >= scurves.shape[1], prev_step, next_step)
+    pix = np.arange(scurves.shape[0])[:, np.newaxis]
+    frac = np.where(next_step > prev_step, (steps - prev_step) / np.maximum(next_step - prev_step, 1), 0.)
+    filled = scurves[pix, prev_step] + frac * (scurves[pix, next_step] - scurves[pix, prev_step])
+
+    result = np.array(hist_scurves)
+    np.reshape(result, (-1, hist_scurves.shape[-1]))[sel] = np.round(filled).astype(result.dtype)
+    return result
 
 
 @numba.njit
 def tot_ave3d(hits, scan_param_range):
     ave_tots = np.zeros(shape=(COL_SIZE, ROW_SIZE, len(scan_param_range)), dtype=np.uint16)
+    fill_tot_sum3d(hits, ave_tots)
+    return ave_tots
 
+
+@numba.njit
+def fill_tot_sum3d(hits, tot_sums):
+    '''
+        Add the ToT of hits to an existing ToT sum histogram (col, row, scan_param_id)
+    '''
     for hit in hits:
         col = hit["col"]
         row = hit["row"]
         param = hit["scan_param_id"]
-        if col >= 0 and col < ave_tots.shape[0] and row >= 0 and row < ave_tots.shape[1]:
-            ave_tots[col, row, param] += (hit["te"] - hit['le']) & 0x3F
-
-    return ave_tots
+        if col >= 0 and col < tot_sums.shape[0] and row >= 0 and row < tot_sums.shape[1] and param >= 0 and param < tot_sums.shape[2]:
+            tot_sums[col, row, param] += (hit["te"] - hit['le']) & 0x3F
 
 
 def imap_bar(func, args, n_processes=None):
@@ -188,6 +232,149 @@ def imap_bar(func, args, n_processes=None):
     return res_list
 
 
+def get_chunk_size(table, chunk_size):
+    '''
+        Round chunk_size down to a multiple of the HDF5 chunkshape of table (at least one chunk),
+        so every chunk of the file is read and decompressed only once
+    '''
+    rows_per_chunk = table.chunkshape[0]
+    return max(1, int(chunk_size) // rows_per_chunk) * rows_per_chunk
+
+
+class HitTableWriter(object):
+    '''
+    Writes hit arrays into a 'Hits' table of several h5 files concurrently.
+
+    PyTables holds the GIL during compression, so the files are written by child processes (spawn context, as
+    the RawDataWriterProcess), one core is left for the caller. Every process owns a group of the files and
+    is fed through a bounded queue, append() blocks while a writer is behind. Without a spare core, and in
+    daemonic processes (e.g. multiprocessing.Pool workers), which cannot start child processes, the files are
+    written by the calling process.
+    '''
+
+    def __init__(self, filenames, description, title='Hits', expectedrows=10000, filters=None, n_processes=None, queue_size=4):
+        if filters is None:
+            filters = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+        self.filenames = list(filenames)
+        if n_processes is None:
+            n_processes = mp.cpu_count() - 1
+        if mp.current_process().daemon:
+            n_processes = 0
+        n_processes = min(n_processes, len(self.filenames))
+        table_args = (np.dtype(description), title, expectedrows, filters)
+        self._processes = []
+        if n_processes < 1:
+            self._writer = _HitTableGroupWriter(self.filenames, *table_args)
+            self._queues = None
+            return
+        ctx = mp.get_context('spawn')
+        self._queues = [ctx.Queue(queue_size) for _ in range(n_processes)]
+        for index, q in enumerate(self._queues):
+            p = ctx.Process(target=_hit_table_writer, name='HitTableWriter',
+                            args=(self.filenames[index::n_processes], table_args, q))
+            p.start()
+            self._processes.append(p)
+
+    def _put(self, index, item):
+        while True:
+            try:
+                self._queues[index].put(item, timeout=1.)
+                return
+            except queue.Full:
+                if not self._processes[index].is_alive():
+                    raise RuntimeError('HitTableWriter process %d failed' % index)
+
+    def append(self, index, hits):
+        '''
+            Append hits to the table of file number index
+        '''
+        if hits.shape[0] == 0:
+            return
+        if self._queues is None:
+            self._writer.append(index, hits)
+        else:
+            n_processes = len(self._processes)
+            self._put(index % n_processes, (index // n_processes, hits))
+
+    def close(self):
+        '''
+            Write the remaining hits and wait for the writer processes
+        '''
+        if self._queues is None:
+            self._writer.close()
+            return
+        for index, p in enumerate(self._processes):
+            if p.is_alive():
+                self._put(index, None)
+        failed = []
+        for index, p in enumerate(self._processes):
+            p.join()
+            if p.exitcode != 0:
+                failed.extend(self.filenames[index::len(self._processes)])
+        if failed:
+            raise RuntimeError('Writing %s failed' % ', '.join(failed))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._queues is None:  # Do not hide the original exception
+            self._writer.close()
+        else:
+            for p in self._processes:
+                p.terminate()
+                p.join()
+
+
+class _HitTableGroupWriter(object):
+    '''
+        Appends hits to the tables of a group of files, only whole HDF5 chunks are written until close()
+    '''
+
+    def __init__(self, filenames, description, title, expectedrows, filters):
+        self._out_files, self._tables, self._buffers = [], [], []
+        for filename in filenames:
+            out_file = tb.open_file(filename, mode='w')
+            self._out_files.append(out_file)
+            self._tables.append(out_file.create_table(out_file.root, name='Hits', description=description, title=title,
+                                                      filters=filters, expectedrows=expectedrows))
+            self._buffers.append([])
+
+    def append(self, index, hits):
+        buffer = self._buffers[index]
+        buffer.append(hits)
+        n_buffered = sum(b.shape[0] for b in buffer)
+        rows_per_chunk = self._tables[index].chunkshape[0]
+        if n_buffered >= rows_per_chunk:
+            hits = np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+            n_write = n_buffered - n_buffered % rows_per_chunk
+            self._tables[index].append(hits[:n_write])
+            self._buffers[index] = [hits[n_write:]] if n_write < n_buffered else []
+
+    def close(self):
+        try:
+            for buffer, hits_table in zip(self._buffers, self._tables):
+                if buffer:
+                    hits_table.append(np.concatenate(buffer))
+        finally:
+            for out_file in self._out_files:
+                out_file.close()
+
+
+def _hit_table_writer(filenames, table_args, hits_queue):
+    writer = _HitTableGroupWriter(filenames, *table_args)
+    try:
+        while True:
+            item = hits_queue.get()
+            if item is None:
+                break
+            writer.append(*item)
+    finally:
+        writer.close()
+
+
 def get_threshold(x, y, n_injections, invert_x=False):
     ''' Fit less approximation of threshold from s-curve.
         From: https://doi.org/10.1016/j.nima.2013.10.022
@@ -207,8 +394,8 @@ def get_threshold(x, y, n_injections, invert_x=False):
     if not np.allclose(np.diff(x), d):
         raise NotImplementedError('Threshold can only be calculated for equidistant x values!')
     if invert_x:
-        return x.min() + (d * M).astype(np.float) / n_injections
-    return x.max() - (d * M).astype(np.float) / n_injections
+        return x.min() + (d * M).astype(float) / n_injections
+    return x.max() - (d * M).astype(float) / n_injections
 
 
 def get_noise(x, y, n_injections, invert_x=False):
@@ -232,7 +419,7 @@ def get_noise(x, y, n_injections, invert_x=False):
         mu1 = y[x < mu].sum()
         mu2 = (n_injections - y[x > mu]).sum()
 
-    return d * (mu1 + mu2).astype(np.float) / n_injections * np.sqrt(np.pi / 2.) 
+    return d * (mu1 + mu2).astype(float) / n_injections * np.sqrt(np.pi / 2.) 
 
 
 def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
@@ -243,7 +430,7 @@ def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
             (mu, sigma, chi2/ndf)
     '''
 
-    scurve_data = np.array(scurve_data, dtype=np.float)
+    scurve_data = np.array(scurve_data, dtype=float)
 
     # Deselect masked values (== nan)
     x = scan_param_range[~np.isnan(scurve_data)]
@@ -256,7 +443,7 @@ def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
         return (0., 0., 0.)
 
     # Calculate data errors, Binomial errors
-    yerr = np.sqrt(y * (1. - y.astype(np.float) / n_injections))
+    yerr = np.sqrt(y * (1. - y.astype(float) / n_injections))
     # Set minimum error != 0, needed for fit minimizers
     # Set arbitrarly to error of 0.5 injections
     min_err = np.sqrt(0.5 - 0.5 / n_injections)
@@ -297,35 +484,19 @@ def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
     return (popt[1], popt[2], chi2 / (y.shape[0] - 3 - 1))
 
 
-def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert_x=False, optimize_fit_range=False):
-    ''' Fit Scurves on all available cores in parallel.
-        Parameters
-        ----------
-        scurves: numpy array like
-            Histogram with S-Curves. Channel index in the first and data in the second dimension.
-        scan_param_range: array like
-            Values used durig S-Curve scanning.
-        n_injections: integer
-            Number of injections
-        invert_x: boolean
-            True when x-axis inverted
-        optimize_fit_range: boolean
-            Reduce fit range of each S-curve independently to the S-Curve like range. Take full
-            range if false
+def mask_scurves(scurves, n_injections, invert_x=False, optimize_fit_range=False):
+    ''' Masked array of the S-curves, with the data outside of the fit range masked (see fit_scurves_multithread).
     '''
-
-    scan_param_range = np.array(scan_param_range)  # Make sure it is numpy array
-
     # Loop over S-curves to determine the fit range. Noisy data is excluded by searching for the
     # plateau region of an S-curve and only taking the value until the plateau ends. Fit range
     # is specified by a masked array.
     if optimize_fit_range:
-        scurve_mask = np.ones_like(scurves, dtype=np.bool)  # Mask to specify fit range
+        scurve_mask = np.ones_like(scurves, dtype=bool)  # Mask to specify fit range
         for i, scurve in enumerate(scurves):
             if not np.any(scurve) or np.all(scurve == n_injections):  # Speedup, nothing to do
                 continue
 
-            scurve_diff = np.diff(scurve.astype(np.float))
+            scurve_diff = np.diff(scurve.astype(float))
             max_inj = np.min([n_injections, scurve.max()])
 
             # Get indeces where S-Curve is settled (max injections and no slope)
@@ -358,6 +529,29 @@ def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert
     else:
         scurves_masked = np.ma.masked_array(scurves)
 
+    return scurves_masked
+
+
+def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert_x=False, optimize_fit_range=False):
+    ''' Fit Scurves on all available cores in parallel.
+        Parameters
+        ----------
+        scurves: numpy array like
+            Histogram with S-Curves. Channel index in the first and data in the second dimension.
+        scan_param_range: array like
+            Values used durig S-Curve scanning.
+        n_injections: integer
+            Number of injections
+        invert_x: boolean
+            True when x-axis inverted
+        optimize_fit_range: boolean
+            Reduce fit range of each S-curve independently to the S-Curve like range. Take full
+            range if false
+    '''
+
+    scan_param_range = np.array(scan_param_range)  # Make sure it is numpy array
+    scurves_masked = mask_scurves(scurves, n_injections, invert_x, optimize_fit_range)
+
     # Calculate noise median for fit start value
     logger.info("Calculate S-curve fit start parameters")
     sigmas = []
@@ -396,13 +590,210 @@ def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert
     return thr2D, sig2D, chi2ndf2D
 
 
+def get_threshold_noise_vectorized(scurves, scan_param_range, n_injections, invert_x=False):
+    ''' Fit less approximation of threshold and noise (see get_threshold and get_noise) of all S-curves at once.
+        Parameters
+        ----------
+        scurves: numpy array like
+            S-Curves with channel index in the first and data in the second dimension.
+            Masked (numpy.ma) or NaN entries are ignored.
+        scan_param_range: array like
+            Values used durig S-Curve scanning.
+        n_injections: integer
+            Number of injections
+        invert_x: boolean
+            True when x-axis inverted
+        Returns:
+            (mu, sigma), arrays with one entry per channel
+    '''
+    x = np.array(scan_param_range, dtype=np.float64)
+    d = np.diff(x)[0]  # Delta x
+    if not np.allclose(np.diff(x), d):
+        raise NotImplementedError('Threshold can only be calculated for equidistant x values!')
+    y = np.ma.masked_invalid(np.ma.asarray(scurves, dtype=np.float64)).filled(np.nan)
+    valid = ~np.isnan(y)
+    y = np.where(valid, y, 0.)
+
+    M = y.sum(axis=1)  # is total number of hits
+    if invert_x:
+        mu = np.min(np.where(valid, x, np.inf), axis=1) + d * M / n_injections
+        sel_1, sel_2 = x > mu[:, np.newaxis], x < mu[:, np.newaxis]
+    else:
+        mu = np.max(np.where(valid, x, -np.inf), axis=1) - d * M / n_injections
+        sel_1, sel_2 = x < mu[:, np.newaxis], x > mu[:, np.newaxis]
+    mu1 = np.sum(np.where(sel_1, y, 0.), axis=1)
+    mu2 = np.sum(np.where(sel_2 & valid, n_injections - y, 0.), axis=1)
+    sigma = np.abs(d) * (mu1 + mu2) / n_injections * np.sqrt(np.pi / 2.)
+
+    no_data = ~np.any(valid, axis=1)
+    mu[no_data] = 0.
+    sigma[no_data] = 0.
+    return mu, sigma
+
+
+def _scurve_jacobian(x, p, invert_x):
+    # Model (scurve or zcurve) and derivatives with respect to A, mu and sigma, for all channels
+    A, mu, sigma = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    sign = -1. if invert_x else 1.
+    z = (x - mu) / (np.sqrt(2) * sigma)
+    g = sign * A / np.sqrt(np.pi) * np.exp(-z ** 2)
+    jac = np.empty(z.shape + (3, ))
+    jac[..., 0] = 0.5 * (1. + sign * erf(z))
+    jac[..., 1] = -g / (np.sqrt(2) * sigma)
+    jac[..., 2] = -g * z / sigma
+    return A * jac[..., 0], jac
+
+
+def fit_scurves_batched(scurves, scan_param_range, n_injections, sigma_0, invert_x=False, max_iterations=200, tolerance=1e-8):
+    ''' Fit all S-curves at once with a Levenberg-Marquardt algorithm, iterating all channels in lockstep.
+        Fit model, data errors, start values and result checks are the same as in fit_scurve.
+        Parameters
+        ----------
+        scurves: numpy array like
+            S-Curves with channel index in the first and data in the second dimension.
+            Masked (numpy.ma) or NaN entries are ignored.
+        scan_param_range: array like
+            Values used durig S-Curve scanning.
+        n_injections: integer
+            Number of injections
+        sigma_0: float
+            Start value of sigma
+        invert_x: boolean
+            True when x-axis inverted
+        max_iterations: integer
+            Maximum number of iterations
+        tolerance: float
+            Relative change of chi2 or of the parameters for convergence
+        Returns:
+            (mu, sigma, chi2/ndf, converged), arrays with one entry per channel.
+            Channels without data or failing the checks are 0, not converged channels are not checked.
+    '''
+    x = np.array(scan_param_range, dtype=np.float64)
+    y = np.ma.masked_invalid(np.ma.asarray(scurves, dtype=np.float64)).filled(np.nan)
+    valid = ~np.isnan(y)
+    n_valid = np.count_nonzero(valid, axis=1)
+    y = np.where(valid, y, 0.)
+    n_channels = y.shape[0]
+
+    mu = np.zeros(n_channels)
+    sigma = np.zeros(n_channels)
+    chi2ndf = np.zeros(n_channels)
+    converged = np.ones(n_channels, dtype=bool)
+
+    # Only fit data that is fittable
+    fit_sel = np.flatnonzero((n_valid >= 3) & np.any(y != 0, axis=1) & (np.max(y, axis=1) >= 0.2 * n_injections))
+    if fit_sel.shape[0] == 0:
+        return mu, sigma, chi2ndf, converged
+    y_fit, valid_fit = y[fit_sel], valid[fit_sel]
+
+    # Binomial errors with a minimum error of 0.5 injections and high errors for additional hits, as in fit_scurve
+    yerr = np.sqrt(y_fit * (1. - y_fit / n_injections))
+    min_err = np.sqrt(0.5 - 0.5 / n_injections)
+    yerr[yerr < min_err] = min_err
+    sel_bad = y_fit > n_injections
+    yerr[sel_bad] = (y_fit - n_injections)[sel_bad]
+    weights = np.where(valid_fit, 1. / yerr, 0.)
+
+    p = np.empty((fit_sel.shape[0], 3))
+    p[:, 0] = n_injections
+    p[:, 1] = get_threshold_noise_vectorized(np.where(valid_fit, y_fit, np.nan), x, n_injections, invert_x)[0]
+    p[:, 2] = sigma_0
+    lam = np.full(fit_sel.shape[0], 1e-3)
+    done = np.zeros(fit_sel.shape[0], dtype=bool)
+    failed = np.zeros(fit_sel.shape[0], dtype=bool)
+
+    active = np.arange(fit_sel.shape[0])
+    for _ in range(max_iterations):
+        if active.shape[0] == 0:
+            break
+        w = weights[active]
+        model, jac = _scurve_jacobian(x, p[active], invert_x)
+        res = (y_fit[active] - model) * w
+        jac *= w[..., np.newaxis]
+        chi2 = np.sum(res ** 2, axis=1)
+        jtj = np.einsum('npi,npj->nij', jac, jac)
+        jtr = np.einsum('npi,np->ni', jac, res)
+
+        # Damped normal equations, the damping keeps the matrices positive definite
+        diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), 1e-12)
+        lhs = jtj + (lam[active][:, np.newaxis] * diag)[:, :, np.newaxis] * np.eye(3)
+        with np.errstate(all='ignore'):
+            try:
+                step = np.linalg.solve(lhs, jtr[..., np.newaxis])[..., 0]
+            except np.linalg.LinAlgError:  # Singular matrices (e.g. sigma close to 0), these steps are rejected
+                step = np.full(jtr.shape, np.nan)
+                for i in range(lhs.shape[0]):
+                    try:
+                        step[i] = np.linalg.solve(lhs[i], jtr[i])
+                    except np.linalg.LinAlgError:
+                        pass
+            p_new = p[active] + step
+            chi2_new = np.sum(((y_fit[active] - _scurve_jacobian(x, p_new, invert_x)[0]) * w) ** 2, axis=1)
+        accept = np.isfinite(chi2_new) & (chi2_new <= chi2)
+
+        p[active[accept]] = p_new[accept]
+        lam[active] = np.where(accept, lam[active] * 0.1, lam[active] * 10.)
+        with np.errstate(all='ignore'):
+            small_change = (chi2 - chi2_new <= tolerance * chi2) | np.all(np.abs(step) <= tolerance * (np.abs(p_new) + tolerance), axis=1)
+        done[active[accept & small_change]] = True
+        failed[active[~np.all(np.isfinite(p[active]), axis=1) | (lam[active] > 1e10)]] = True
+        active = active[~done[active] & ~failed[active]]
+
+    converged[fit_sel] = done & ~failed
+    model = _scurve_jacobian(x, p, invert_x)[0]
+    chi2_fit = np.sum(np.where(valid_fit, (y_fit - model) ** 2, 0.), axis=1)
+
+    # Treat data that does not follow an S-Curve, every fit result is possible here but not meaningful
+    x_max = np.max(np.where(valid_fit, x, -np.inf), axis=1)
+    x_min = np.min(np.where(valid_fit, x, np.inf), axis=1)
+    good = (p[:, 2] > 0) & (x_min - 5. * np.abs(p[:, 2]) < p[:, 1]) & (p[:, 1] < x_max + 5. * np.abs(p[:, 2])) & converged[fit_sel]
+    mu[fit_sel[good]] = p[good, 1]
+    sigma[fit_sel[good]] = p[good, 2]
+    chi2ndf[fit_sel[good]] = chi2_fit[good] / (n_valid[fit_sel[good]] - 3 - 1)
+    return mu, sigma, chi2ndf, converged
+
+
+def fit_scurves_vectorized(scurves, scan_param_range, n_injections=None, invert_x=False, optimize_fit_range=False, fit=True):
+    ''' Threshold and noise of all S-curves from vectorized calculations instead of one curve_fit per pixel.
+        The fit less results are used directly (fit = False) or as start values for fit_scurves_batched.
+        Only channels where the batched fit does not converge are fitted with fit_scurve.
+        Parameters are the same as for fit_scurves_multithread.
+        Returns:
+            Threshold, noise and chi2/ndf maps (chi2/ndf is 0 without fit)
+    '''
+    scan_param_range = np.array(scan_param_range)  # Make sure it is numpy array
+    scurves_masked = mask_scurves(scurves, n_injections, invert_x, optimize_fit_range)
+    y = scurves_masked.astype(np.float64).filled(np.nan)
+
+    mu, sigma = get_threshold_noise_vectorized(y, scan_param_range, n_injections, invert_x)
+    if fit:
+        # Noise median of pixels with valid data (maximum = n_injections) as fit start value
+        sigma_0 = np.median(sigma[np.nanmax(y, axis=1) == n_injections])
+        mu, sigma, chi2ndf, converged = fit_scurves_batched(y, scan_param_range, n_injections, sigma_0, invert_x)
+        retry = np.flatnonzero(~converged)
+        logger.info("S-curve fit finished, %d fit(s) repeated with curve_fit", retry.shape[0])
+        for i in retry:
+            mu[i], sigma[i], chi2ndf[i] = fit_scurve(y[i], scan_param_range, n_injections, sigma_0, invert_x)
+    else:
+        # Same channels as without fit
+        no_fit = (np.sum(~np.isnan(y), axis=1) < 3) | ~(np.nanmax(np.where(np.isnan(y), 0, y), axis=1) >= 0.2 * n_injections)
+        mu[no_fit] = 0.
+        sigma[no_fit] = 0.
+        chi2ndf = np.zeros_like(mu)
+
+    thr2D = np.reshape(mu, (COL_SIZE, ROW_SIZE))
+    sig2D = np.reshape(sigma, (COL_SIZE, ROW_SIZE))
+    chi2ndf2D = np.reshape(chi2ndf, (COL_SIZE, ROW_SIZE))
+    return thr2D, sig2D, chi2ndf2D
+
+
 def fit_line(y_data, y_err, x_data):
     """
         Fit line to x and y data.
         Returns:
             (slope, offset, chi2)
     """
-    y_data = np.array(y_data, dtype=np.float)
+    y_data = np.array(y_data, dtype=float)
 
     # Select valid data
     x = x_data[~np.isnan(y_data)]
@@ -433,8 +824,8 @@ def fit_gauss(y_data, y_err, x_data):
         Returns:
             (amp, mu, sigma, chi2)
     """
-    y_data = np.array(y_data, dtype=np.float)
-    y_err = np.array(y_err, dtype=np.float)
+    y_data = np.array(y_data, dtype=float)
+    y_err = np.array(y_err, dtype=float)
 
     # Select valid data
     x = x_data[~np.isnan(y_data)]
@@ -0,0 +1,358 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+# Benchmark of the analysis hot paths (raw data interpretation, Analysis.analyze_data,
+# fit_scurves_multithread, build_events and the matchers of the event builder) on scan files or synthetic data.
+#
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+import tables as tb
+import yaml
+
+from monopix2_daq.analysis import analysis_utils as au
+from monopix2_daq.analysis import interpreter
+from monopix2_daq.analysis.analysis_dataproc import Analysis
+from monopix2_daq.sim.raw_data_generator import RawDataGenerator
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['interpret', 'analyze', 'fit_scurves', 'build_events', 'matchers']
+
+
+class ResourceMonitor(object):
+    '''
+    Measures the wall time and samples the peak resident memory (RSS) of this process and its child processes
+    (e.g. the pool of fit_scurves_multithread) while the context is active.
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.duration = 0.
+        self.peak_rss = 0
+
+    def _get_rss(self):
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:  # Child finished in the meantime
+                pass
+        return rss
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._get_rss())
+
+    def __enter__(self):
+        self.peak_rss = self._get_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='ResourceMonitor')
+        self._thread.daemon = True
+        self._start = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self._start
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._get_rss())
+
+
+def interpret(raw_data_file, chunk_size=1000000, n_threads=1):
+    '''
+    Interprets the raw data chunk by chunk (RawDataInterpreter, or ParallelRawDataInterpreter for n_threads != 1),
+    only one chunk is kept in memory.
+
+    Returns
+    -------
+    n_hits, n_errors: int
+    '''
+    hit_buffer = np.zeros(chunk_size, dtype=interpreter.hit_dtype)
+    if n_threads == 1:
+        data_interpreter = interpreter.RawDataInterpreter()
+    else:
+        data_interpreter = interpreter.ParallelRawDataInterpreter(n_threads=n_threads)
+    n_hits = 0
+    with tb.open_file(raw_data_file) as in_file:
+        meta_data = in_file.root.meta_data[:]
+        for start in range(0, in_file.root.raw_data.shape[0], chunk_size):
+            n_hits += data_interpreter.interpret(in_file.root.raw_data[start:start + chunk_size], meta_data, hit_buffer).shape[0]
+    if n_threads != 1:
+        data_interpreter.close()
+    return n_hits, data_interpreter.get_error_count()
+
+
+def analyze(raw_data_file, n_threads=1):
+    '''
+    Runs Analysis.analyze_data, returns the interpreted file.
+    '''
+    with Analysis(raw_data_file=raw_data_file, n_threads=n_threads) as a:
+        a.analyze_data()
+    return a.analyzed_data_file
+
+
+def fit_scurves(interpreted_file):
+    '''
+    Fits the s-curves of a threshold scan with fit_scurves_multithread.
+
+    Returns
+    -------
+    n_fitted: int
+        Number of pixels with a threshold.
+    '''
+    with tb.open_file(interpreted_file) as in_file:
+        hist_scurve = in_file.root.HistSCurve[:]
+        scan_kwargs = yaml.full_load(in_file.root.kwargs[0])
+    scan_param_range = np.arange(*scan_kwargs['injlist_param'])
+    threshold_map, _, _ = au.fit_scurves_multithread(hist_scurve.reshape(-1, hist_scurve.shape[2]), scan_param_range,
+                                                     n_injections=scan_kwargs['inj_n_param'])
+    return np.count_nonzero(np.isfinite(threshold_map) & (threshold_map != 0))
+
+
+def build_events(interpreted_file, ref_file):
+    '''
+    Runs event_builder.build_events (with the FE-I4 reference plane hits of ref_file), returns the output file.
+    '''
+    # The event builder modules import each other as scripts
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import event_builder
+    fout = interpreted_file[:-3] + '_ev.h5'
+    event_builder.build_events(interpreted_file, ref_file, fout, None, plot_flag=False)
+    return fout
+
+
+def compare_matchers(interpreted_file, ref_file):
+    '''
+    Runs the matchers of the event builder on the whole run, with the linear search windows (assign_timestamps_to_tlu_hr,
+    assign_tlu_to_monopix, assign_rx1, del_invalid_tlu_in_FE + assign_rx1_to_FE, correlate_ev) and with the sorted merge
+    joins replacing them (*_sorted). The trigger number joins of both get the output of the sorted word matchers as input.
+
+    Returns
+    -------
+    results: dict
+        For every matcher: time_linear and time_sorted (s, only the matcher calls), n_linear and n_sorted (matched rows).
+    '''
+    # The event builder modules import each other as scripts
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import event_builder
+    import event_builder_utils as ebu
+    with tb.open_file(interpreted_file) as in_file:
+        dat = in_file.root.Dut[:]
+    with tb.open_file(ref_file) as in_file:
+        ref = in_file.root.Hits[:]
+    tlu_mask = dat['col'] == event_builder.TLU_TAG
+    event_builder.align_tlu_trigger_number(tlu_mask, np.int64(dat['cnt'][tlu_mask]), dat)
+
+    def timed(function, *args):
+        start = time.time()
+        ret = function(*args)
+        return ret, time.time() - start
+
+    def found(table):
+        return table['trigger_number'] != event_builder.MAX_64BIT_TAG
+
+    results = {}
+    tables = {}
+    for name, mask, dtype, linear, sorted_ in [('assign_tlu', dat['col'] == event_builder.TLU640_TAG, event_builder.TLU_MATCH_DTYPE,
+                                                ebu.assign_timestamps_to_tlu_hr, ebu.assign_timestamps_to_tlu_hr_sorted),
+                                               ('assign_monopix', dat['col'] < event_builder.MONO_COL_SIZE, event_builder.MONOPIX_MATCH_DTYPE,
+                                                ebu.assign_tlu_to_monopix, ebu.assign_tlu_to_monopix_sorted)]:
+        table_linear, table_sorted = np.empty(np.count_nonzero(mask), dtype=dtype), np.empty(np.count_nonzero(mask), dtype=dtype)
+        _, time_linear = timed(linear, dat, table_linear, event_builder.WORD_SEARCH_DISTANCE)
+        _, time_sorted = timed(sorted_, dat, table_sorted)
+        tables[name] = table_sorted[found(table_sorted)]
+        results[name] = {'time_linear': time_linear, 'time_sorted': time_sorted,
+                         'n_linear': np.count_nonzero(found(table_linear)), 'n_sorted': len(tables[name])}
+    tlu_match_table = tables['assign_tlu'][tables['assign_tlu']['rx1_timestamp'] != event_builder.MAX_64BIT_TAG]
+
+    monopix_linear, monopix_sorted = tables['assign_monopix'].copy(), tables['assign_monopix'].copy()
+    _, time_linear = timed(ebu.assign_rx1, monopix_linear, tlu_match_table)
+    _, time_sorted = timed(ebu.assign_rx1_sorted, monopix_sorted, tlu_match_table)
+    monopix_match_table = monopix_sorted[found(monopix_sorted)]
+    results['assign_rx1'] = {'time_linear': time_linear, 'time_sorted': time_sorted,
+                             'n_linear': np.count_nonzero(found(monopix_linear)), 'n_sorted': len(monopix_match_table)}
+
+    ref_linear, ref_sorted = np.empty(len(ref), dtype=ref.dtype), np.empty(len(ref), dtype=ref.dtype)
+    n_linear, time_linear = timed(ebu.del_invalid_tlu_in_FE, ref, tlu_match_table, ref_linear)
+    if n_linear > 0:
+        time_linear += timed(ebu.assign_rx1_to_FE, ref_linear[:n_linear], tlu_match_table)[1]
+    n_sorted, time_sorted = timed(ebu.assign_rx1_to_FE_sorted, ref, tlu_match_table, ref_sorted)
+    ref_valid_table = ref_sorted[:n_sorted]
+    results['assign_rx1_to_FE'] = {'time_linear': time_linear, 'time_sorted': time_sorted, 'n_linear': n_linear, 'n_sorted': n_sorted}
+
+    correlation_table = np.empty(len(monopix_match_table), dtype=event_builder.CORRELATION_DTYPE)
+    (_, n_linear), time_linear = timed(ebu.correlate_ev, monopix_match_table.copy(), correlation_table, ref_valid_table)
+    (_, n_sorted), time_sorted = timed(ebu.correlate_ev_sorted, monopix_match_table.copy(), correlation_table, ref_valid_table)
+    results['correlate_ev'] = {'time_linear': time_linear, 'time_sorted': time_sorted, 'n_linear': n_linear, 'n_sorted': n_sorted}
+
+    for result in results.values():
+        result.update({key: int(result[key]) for key in ['n_linear', 'n_sorted']})
+    return results
+
+
+def print_matchers(results):
+    '''
+    Prints the results of compare_matchers.
+    '''
+    print('{0:20s} {1:>12s} {2:>12s} {3:>10s} {4:>12s} {5:>12s}'.format('matcher', 'linear [s]', 'sorted [s]', 'speedup', 'n_linear', 'n_sorted'))
+    for matcher, result in results.items():
+        print('{0:20s} {1:12.3f} {2:12.3f} {3:9.1f}x {4:12d} {5:12d}'.format(matcher, result['time_linear'], result['time_sorted'],
+                                                                           result['time_linear'] / max(result['time_sorted'], 1e-9),
+                                                                           result['n_linear'], result['n_sorted']))
+
+
+def run_benchmark(raw_data_file, stages=None, ref_file=None, chunk_size=1000000, n_threads=1, warmup=True):
+    '''
+    Runs the benchmark stages on a scan file and measures time, throughput and peak RSS of every stage.
+
+    Parameters
+    ----------
+    raw_data_file: string
+        h5 file of a scan (raw_data, meta_data, kwargs).
+    stages: list
+        Stages to run (default: all of STAGES which apply to the scan). fit_scurves needs a threshold scan,
+        build_events and matchers a source scan and ref_file, all use the output of analyze.
+    ref_file: string
+        Interpreted FE-I4 reference plane hits for build_events.
+    chunk_size, n_threads: int
+        Words per chunk and threads of the interpret stage.
+    warmup: bool
+        Run all stages on a small synthetic file first, so JIT compilation is not part of the timing.
+
+    Returns
+    -------
+    results: dict
+        For every stage: time (s), peak_rss (bytes), throughput (MB/s of raw data) and stage specific numbers.
+    '''
+    with tb.open_file(raw_data_file) as in_file:
+        scan_id = in_file.root.meta_data.attrs.scan_id
+        n_words = in_file.root.raw_data.shape[0]
+    if stages is None:
+        stages = ['interpret', 'analyze']
+        if scan_id == 'scan_threshold':
+            stages.append('fit_scurves')
+        elif ref_file is not None:
+            stages.append('build_events')
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage %s' % stage)
+
+    if warmup:
+        logger.info('Warm up with a small %s file', scan_id)
+        tmp_dir = tempfile.mkdtemp()
+        warmup_file = os.path.join(tmp_dir, 'warmup.h5')
+        warmup_ref_file = os.path.join(tmp_dir, 'warmup_ref.h5') if 'build_events' in stages or 'matchers' in stages else None
+        RawDataGenerator(scan_id=scan_id if scan_id in ['scan_threshold', 'scan_source'] else 'scan_source').generate(warmup_file, '1MB', ref_file=warmup_ref_file)
+        _run_stages(warmup_file, stages, warmup_ref_file, chunk_size, n_threads)
+        shutil.rmtree(tmp_dir)
+
+    results = _run_stages(raw_data_file, stages, ref_file, chunk_size, n_threads)
+    for result in results.values():
+        result['throughput'] = float(n_words * 4 / 1e6 / max(result['time'], 1e-9))
+    return results
+
+
+def _run_stages(raw_data_file, stages, ref_file, chunk_size, n_threads):
+    results = {}
+    interpreted_file = None
+    for stage in stages:
+        logger.info('Running %s', stage)
+        with ResourceMonitor() as monitor:
+            if stage == 'interpret':
+                n_hits, n_errors = interpret(raw_data_file, chunk_size=chunk_size, n_threads=n_threads)
+                result = {'n_hits': int(n_hits), 'n_errors': int(n_errors)}
+            elif stage == 'analyze':
+                interpreted_file = analyze(raw_data_file, n_threads=n_threads)
+                result = {}
+            elif stage == 'fit_scurves':
+                result = {'n_fitted': int(fit_scurves(interpreted_file or raw_data_file[:-3] + '_interpreted.h5'))}
+            elif stage == 'build_events':
+                build_events(interpreted_file or raw_data_file[:-3] + '_interpreted.h5', ref_file)
+                result = {}
+            else:
+                result = {'matchers': compare_matchers(interpreted_file or raw_data_file[:-3] + '_interpreted.h5', ref_file)}
+        result.update({'time': monitor.duration, 'peak_rss': int(monitor.peak_rss)})
+        results[stage] = result
+    return results
+
+
+def print_results(results, baseline=None, tolerance=0.2):
+    '''
+    Prints the results, compared to the results of a previous run (baseline) if given. The throughput is compared,
+    so the baseline can be measured with a file of a different size.
+
+    Returns
+    -------
+    regressions: list
+        Stages which are slower than the baseline by more than the tolerance.
+    '''
+    regressions = []
+    print('{0:15s} {1:>10s} {2:>10s} {3:>14s} {4:>10s}'.format('stage', 'time [s]', 'MB/s', 'peak RSS [MB]', 'slowdown'))
+    for stage, result in results.items():
+        line = '{0:15s} {1:10.2f} {2:10.1f} {3:14.1f}'.format(stage, result['time'], result['throughput'], result['peak_rss'] / 1e6)
+        if baseline is not None and stage in baseline:
+            slowdown = baseline[stage]['throughput'] / max(result['throughput'], 1e-9)
+            line += ' {0:9.2f}x'.format(slowdown)
+            if slowdown > 1 + tolerance:
+                regressions.append(stage)
+                line += ' REGRESSION'
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(usage="python benchmark.py raw_data.h5 [--generate 1GB --scan_id scan_threshold] [-s interpret analyze matchers] [-o results.yaml] [-b baseline.yaml]",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("raw_data_file", type=str, help="Raw data file of a scan (created with --generate).")
+    parser.add_argument("--generate", type=str, default=None, help="Generate a synthetic raw data file of this size first (e.g. 100MB).")
+    parser.add_argument("--scan_id", type=str, default='scan_source', help="Scan of the synthetic data (scan_source, scan_threshold).")
+    parser.add_argument("--error_rate", type=float, default=0., help="Error rate of the synthetic data.")
+    parser.add_argument("--ref_file", type=str, default=None, help="FE-I4 reference plane hits for build_events.")
+    parser.add_argument("-s", "--stages", type=str, nargs='+', default=None, choices=STAGES)
+    parser.add_argument("-c", "--chunk_size", type=int, default=1000000)
+    parser.add_argument("-t", "--n_threads", type=int, default=1)
+    parser.add_argument("--no_warmup", action='store_const', const=1, default=0, help="Include JIT compilation in the timing.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the results to a yaml file.")
+    parser.add_argument("-b", "--baseline", type=str, default=None, help="Compare to the results of a previous run.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown relative to the baseline.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ref_file = args.ref_file
+    if args.generate is not None:
+        if args.scan_id == 'scan_source' and ref_file is None:
+            ref_file = args.raw_data_file[:-3] + '_ref.h5'
+        with ResourceMonitor() as monitor:
+            n_words = RawDataGenerator(scan_id=args.scan_id, error_rate=args.error_rate).generate(args.raw_data_file, args.generate, ref_file=ref_file)
+        print('Generated {0:d} words in {1:.2f} s ({2:.1f} MB/s)'.format(n_words, monitor.duration, n_words * 4 / 1e6 / max(monitor.duration, 1e-9)))
+
+    results = run_benchmark(args.raw_data_file, stages=args.stages, ref_file=ref_file, chunk_size=args.chunk_size,
+                            n_threads=args.n_threads, warmup=not args.no_warmup)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = yaml.safe_load(f)
+    regressions = print_results(results, baseline=baseline, tolerance=args.tolerance)
+    if 'matchers' in results:
+        print_matchers(results['matchers']['matchers'])
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            yaml.dump(results, f)
+    if regressions:
+        sys.exit(1)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 import numpy as np
 import tables
 from numba import njit
@@ -35,23 +36,34 @@ MONO_TOKEN_TS_MAX = 0xFFFFFFFFFFFE0
 MONO_TOT_MAX = 0x3F #63, since TOT starts at 0
 
 MAX_64BIT_TAG = 0x7FFFFFFFFFFFFFFF
-WORD_SEARCH_DISTANCE = 20 # Search distance for associated word matching 
+WORD_SEARCH_DISTANCE = 20 # Search distance of the linear word matchers (the *_sorted ones have no limit)
 
-def load_interpreted_data(fin, fref):
+CHUNK_SIZE = 1000000 # Words (Monopix data) or triggers per chunk of the event builder
+
+TLU_MATCH_DTYPE = np.dtype([("trigger_number","<i8"),("tlu_timestamp","<i8"),("rx1_timestamp","<i8"),("tlu_HR_timestamp","<i8")])
+MONOPIX_MATCH_DTYPE = np.dtype([("col","u1"),("row","<u8"),("le","u1"),("te","u1"),("tlu_timestamp","<u8"),
+                        ("trigger_number","<i8"), ("token_timestamp","<u8"), ("le_timestamp","<u8"),
+                        ("rx1_timestamp","<u8"),("tlu_HR_timestamp","<u8"),("flg","u1")])
+CORRELATION_DTYPE = np.dtype([("event_number","<i8"),("dut_col","u1"),("dut_row","u2"),("ref_col","u1"),("ref_row","u2")])
+EVENT_DTYPE = np.dtype([("event_number","<i8"),("column","<u2"),("row","<u2"),("frame","<u2"),("charge","<f4"),
+                ("tot","<f4"),("phase","u1"),("phase_quality","u1"),("veto_flg","u1")])
+
+def open_interpreted_data(fin, fref):
     dat, ref = None, None
     try:
-        with tables.open_file(fin) as f:
-            dat=f.root.Dut[:]
+        f_dat = tables.open_file(fin)
+        dat = f_dat.root.Dut
     except:
         print ("{0} is not a valid Monopix input file.".format(fin))
         raise
     try:
-        with tables.open_file(fref) as f:
-            ref=f.root.Hits[:]
+        f_ref = tables.open_file(fref)
+        ref = f_ref.root.Hits
     except:
+        f_dat.close()
         print ("{0} is not a valid FE-I4 input file.".format(fref))    
         raise
-    return dat, ref
+    return f_dat, dat, f_ref, ref
 
 def create_mono_masks(dat):
     monopix_masks = {"mono":(dat["col"]<=MONO_COL_SIZE),
@@ -72,11 +84,24 @@ def create_masked_mono_data(monopix_masks, dat):
     
     return masked_data
 
-def align_tlu_trigger_number(tlu_mask, tlu_triggerN, dat):
-    tlu_triggerN[1:]=np.add.accumulate(np.diff(tlu_triggerN) & TLU_TRIGGERNUMBER_MAX) + tlu_triggerN[0]
+def align_tlu_trigger_number(tlu_mask, tlu_triggerN, dat, last_trigger_n=None):
+    """
+    Corrects the overflow of the TLU trigger numbers. For chunks of data, last_trigger_n is the (raw, aligned) trigger number
+    of the last TLU word of the previous chunk, the same is returned for this chunk.
+    """
+    if len(tlu_triggerN) == 0:
+        return last_trigger_n
+    raw_last = tlu_triggerN[-1]
+    if last_trigger_n is None:
+        tlu_triggerN[1:]=np.add.accumulate(np.diff(tlu_triggerN) & TLU_TRIGGERNUMBER_MAX) + tlu_triggerN[0]
+        aligned = tlu_triggerN
+    else:
+        tlu_triggerN[:]=np.add.accumulate(np.diff(np.append(last_trigger_n[0], tlu_triggerN)) & TLU_TRIGGERNUMBER_MAX) + last_trigger_n[1]
+        aligned = np.append(last_trigger_n[1], tlu_triggerN)
     dat["cnt"][tlu_mask] = tlu_triggerN
-    if np.count_nonzero(np.diff(dat["cnt"][tlu_mask])<=0):
+    if np.count_nonzero(np.diff(aligned)<=0):
         raise ValueError("Trigger number not increasing monothonically. Check your data.")
+    return raw_last, tlu_triggerN[-1]
 
 def align_tlu_timestamp(tlu_mask, tlu_timestamp, dat):
     tlu_timestamp[1:]=np.add.accumulate(np.diff(tlu_timestamp) & TLU_TS_MAX) + tlu_timestamp[0]
@@ -84,29 +109,203 @@ def align_tlu_timestamp(tlu_mask, tlu_timestamp, dat):
     if np.count_nonzero(np.diff(dat["timestamp"][tlu_mask])<0):
         raise ValueError("TLU timestamp not increasing monothonically. Check your data.")
 
-def cut_mono_before_reset(mono_mask, dat):
-    print("Cutting Monopix data before Token timestamp reset...")
-    mono_cut_mask = np.diff(dat[mono_mask]["timestamp"]) < 0
-    cut_index = np.argwhere(mono_cut_mask)
+def find_mono_reset(mono_timestamp, last_timestamp=None):
+    """
+    Returns the indices of the Monopix data where the Token timestamp was reset (relative to the first hit of the chunk if the 
+    timestamp of the last hit of the previous chunk is given).
+    """
+    if last_timestamp is not None:
+        return np.argwhere(np.diff(np.append(last_timestamp, mono_timestamp)) < 0)[:, 0] - 1
+    return np.argwhere(np.diff(mono_timestamp) < 0)[:, 0]
+
+def cut_mono_before_reset(cut_index):
     if len(cut_index) > 1: # Token timestamp reset more than once during the scan
         raise RuntimeError("Token timestamp reset more than once during the scan. Indeces: {0}".format(cut_index))
     elif len(cut_index) == 1:
-        dat = dat[cut_index[0]:]
         print("Token timestamp was reset once during data taking, at data index: {0}".format(cut_index[0]))
     else:
         print("Token timestamp was never reset during data taking.")
 
-def build_events(fin, fref, fout, fcal, plot_flag=False):
+def iter_aligned_data(dat, chunk_size):
+    """
+    Reads the interpreted Monopix data in chunks with aligned TLU trigger numbers. 
+    The trigger number and Token timestamp of the previous chunk are carried over, so the result does not depend on the chunk size.
+    """
+    last_trigger_n, last_timestamp = None, None
+    n_mono = 0
+    cut_index = []
+    print("Cutting Monopix data before Token timestamp reset...")
+    for start in range(0, dat.nrows, chunk_size):
+        dat_chunk = dat.read(start, start + chunk_size)
+        # Initialize masks of the different types of data within the chunk
+        monopix_masks = {"mono": dat_chunk["col"]<=MONO_COL_SIZE, "tlu": dat_chunk["col"]==TLU_TAG}
+        monopix_masked_data = create_masked_mono_data(monopix_masks=monopix_masks, dat=dat_chunk)
+        # Check for Monopix data that comes up before the Monopix timestamp is reset
+        cut_index.extend(find_mono_reset(monopix_masked_data["mono"], last_timestamp) + n_mono)
+        if len(cut_index) > 1:
+            cut_mono_before_reset(cut_index)
+        if len(monopix_masked_data["mono"]) > 0:
+            last_timestamp = monopix_masked_data["mono"][-1]
+        n_mono += len(monopix_masked_data["mono"])
+        # Align TLU trigger numbers in the input TLU data
+        last_trigger_n = align_tlu_trigger_number(tlu_mask=monopix_masks["tlu"], tlu_triggerN=monopix_masked_data["tlu_trigger_n"], dat=dat_chunk, last_trigger_n=last_trigger_n)
+        yield dat_chunk
+    cut_mono_before_reset(cut_index)
+
+def match_tlu_and_monopix(dat, tmp_h5, chunk_size):
+    """
+    Assigns the closest RX1 and TLU words to the TLU640/HR words and TLU words to the Monopix hits, calculates the LE timestamps of the hits.
+    The matching only depends on the order of the tagged words, so the words of a chunk are matched together with the (up to three) 
+    earlier words they can be matched to: the last RX1 word, the last TLU640/HR word and its TLU word. Words from the first TLU640/HR
+    word after the last TLU word of a chunk on wait for a TLU word in the next chunks, and the last cluster of hits is carried over.
+    The matched TLU and Monopix data are appended to the TLU and Monopix tables of tmp_h5. Returns the histogram of the TLU-RX distances.
+    """
+    tlu_table = tmp_h5.create_table(tmp_h5.root, name="TLU", description=TLU_MATCH_DTYPE)
+    monopix_table = tmp_h5.create_table(tmp_h5.root, name="Monopix", description=MONOPIX_MATCH_DTYPE)
+    tlu_hist = np.zeros(len(mono_ev_utils.TLU_RX_BINS)-1, dtype=np.int64)
+    n_tlu, n_mono = 0, 0
+    dat_before, n_context, cluster = dat.read(0, 0), 0, np.empty(0, dtype=MONOPIX_MATCH_DTYPE)
+    chunks = iter_aligned_data(dat, chunk_size)
+    dat_chunk = next(chunks, None)
+    while dat_chunk is not None:
+        next_chunk = next(chunks, None)
+        dat_ext = np.concatenate((dat_before, dat_chunk))
+        col = dat_ext["col"]
+        # Words which depend on a TLU word of the next chunk are matched with the next chunk
+        n_done = len(dat_ext)
+        if next_chunk is not None:
+            tlu_index = np.flatnonzero(col==TLU_TAG)
+            last_tlu = tlu_index[-1] if len(tlu_index) > 0 else -1
+            pending_index = np.flatnonzero(col[last_tlu+1:]==TLU640_TAG)
+            if len(pending_index) > 0:
+                n_done = last_tlu + 1 + pending_index[0]
+        dat_done = dat_ext[:n_done]
+
+        # Create an empty array of the size of the TLU640/HR data, where all TLU and data from related timestamps will be condensed 
+        tlu_hr_mask = col[:n_done]==TLU640_TAG
+        tlu_match_table = np.empty(np.count_nonzero(tlu_hr_mask), dtype=TLU_MATCH_DTYPE)
+        # Assign the closest RX1 and TLU timestamps to TLU640/HR data
+        mono_ev_utils.assign_timestamps_to_tlu_hr_sorted(dat=dat_done, tlu_match_table=tlu_match_table)
+        tlu_match_table = tlu_match_table[np.count_nonzero(tlu_hr_mask[:n_context]):]
+        n_tlu += len(tlu_match_table)
+        # Filter the TLU640/HR words without a Scintillator (RX) word before or a TLU Word after them
+        tlu_match_table = tlu_match_table[np.logical_and(tlu_match_table["rx1_timestamp"]!=MAX_64BIT_TAG, tlu_match_table["trigger_number"]!=MAX_64BIT_TAG)]
+        tlu_hist += mono_ev_utils.hist_TLUvsRXdistance(tlu_match_table)
+        tlu_table.append(tlu_match_table)
+
+        # Create an empty array of the size of the Monopix data, where data from all hits will be condensed and associated with the TLU data
+        monopix_match_table = np.empty(np.count_nonzero(col[:n_done]<MONO_COL_SIZE), dtype=MONOPIX_MATCH_DTYPE)
+        # Assign TLU timestamps to Monopix hits (the context words are no hits)
+        mono_ev_utils.assign_tlu_to_monopix_sorted(dat=dat_done, monopix_match_table=monopix_match_table)
+        n_mono += len(monopix_match_table)
+        # Filter the Monopix words without TLU words
+        monopix_match_table = np.concatenate((cluster, monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]))
+        # Keep the last cluster (hits with the same token timestamp) for the next chunk
+        if next_chunk is not None and len(monopix_match_table) > 0:
+            token_timestamp = monopix_match_table["token_timestamp"]
+            n_cluster = len(token_timestamp) - np.argmax(token_timestamp[::-1] != token_timestamp[-1]) if np.any(token_timestamp != token_timestamp[-1]) else 0
+            monopix_match_table, cluster = monopix_match_table[:n_cluster], monopix_match_table[n_cluster:]
+        else:
+            cluster = monopix_match_table[:0]
+        # Calculate the LE timestamp of every hit based on the token timestamp caused by the hit with the shortest ToT in a cluster (defined by Token Timestamp)
+        if len(monopix_match_table) > 0:
+            mono_ev_utils.calculate_le_timestamp(monopix_match_table=monopix_match_table)
+        monopix_table.append(monopix_match_table)
+
+        # Context of the remaining words: the last RX1 word, the last TLU640/HR word and the TLU word following it
+        context_index = []
+        rx1_index = np.flatnonzero(col[:n_done]==RX640_TAG)
+        if len(rx1_index) > 0:
+            context_index.append(rx1_index[-1])
+        tlu_hr_index = np.flatnonzero(tlu_hr_mask)
+        if len(tlu_hr_index) > 0:
+            context_index.append(tlu_hr_index[-1])
+            tlu_index = np.flatnonzero(col[tlu_hr_index[-1]+1:n_done]==TLU_TAG)
+            if len(tlu_index) > 0:
+                context_index.append(tlu_hr_index[-1] + 1 + tlu_index[0])
+        context = dat_ext[np.sort(np.array(context_index, dtype=np.int64))]
+        dat_before, n_context = np.concatenate((context, dat_ext[n_done:])), len(context)
+        dat_chunk = next_chunk
+
+    tlu_table.flush()
+    monopix_table.flush()
+    print ("# of TLU words {0:d} / {1:d} ({2:.6f}% are assigned -properly or not- to a rx1_timestamp word)".format(tlu_table.nrows, n_tlu, 100.0*tlu_table.nrows/float(max(1, n_tlu))))
+    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% were assigned a TLU word)".format(monopix_table.nrows, n_mono, 100.0*monopix_table.nrows/float(max(1, n_mono))))
+    return tlu_hist
+
+def match_triggers(tmp_h5, ref, out_h5, ref_valid_h5, tlu_lim, chunk_size):
+    """
+    Assigns RX1 timestamps to Monopix and FE-I4 data and correlates them, in windows of chunk_size triggers.
+    All matching is done with merge joins on trigger numbers, so the Monopix, TLU and FE-I4 data of a window are read for the same 
+    range of trigger numbers. The TLU, Correlation and FE-I4 tables are appended to out_h5 and ref_valid_h5, the correlated Monopix 
+    data to tmp_h5. Returns the histograms of the Time-walk (LE-RX1) per phase.
+    """
+    tlu_table, monopix_table = tmp_h5.root.TLU, tmp_h5.root.Monopix
+    tlu_reader = mono_ev_utils.SortedTableReader(tlu_table, "trigger_number", chunk_size,
+                                                selection=lambda tlu: mono_ev_utils.select_TLUvsRXdistance(tlu, *tlu_lim))
+    monopix_reader = mono_ev_utils.SortedTableReader(monopix_table, "trigger_number", chunk_size)
+    ref_reader = mono_ev_utils.SortedTableReader(ref, "event_number", chunk_size)
+    tlu_out = mono_ev_utils.create_data_table(h5_file=out_h5, name="TLU", description=TLU_MATCH_DTYPE, title='TLU with RX1 timestamp')
+    correlation_out = mono_ev_utils.create_data_table(h5_file=out_h5, name="Correlation", description=CORRELATION_DTYPE, title='Correlation between Monopix and Reference FE-I4')
+    ref_valid_out = mono_ev_utils.create_data_table(h5_file=ref_valid_h5, name="Hits", description=ref.dtype, title='Hits with valid TLU trigger number')
+    correlated_table = tmp_h5.create_table(tmp_h5.root, name="Correlated", description=MONOPIX_MATCH_DTYPE)
+    phase_hists = np.zeros((16, len(mono_ev_utils.LE_RX_BINS)-1), dtype=np.int64)
+    n_assigned_rx1, n_ref_valid, n_correlated = 0, 0, 0
+
+    for window_start in range(0, max(1, tlu_table.nrows), chunk_size):
+        # Trigger numbers of the window
+        trigger_limit = tlu_table[window_start + chunk_size]["trigger_number"] if window_start + chunk_size < tlu_table.nrows else None
+        tlu_match_table = tlu_reader.read_until(trigger_limit)
+        tlu_out.append(tlu_match_table)
+
+        # Assign RX1 timestamps -based on their trigger number in the TLU match table- to the Monopix data
+        monopix_match_table = monopix_reader.read_until(trigger_limit)
+        mono_ev_utils.assign_rx1_sorted(monopix_match_table=monopix_match_table, tlu_match_table=tlu_match_table)
+        # Filter the Monopix words that could not find reliable RX1 words in the TLU data based on Trigger Numbers
+        monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]
+        n_assigned_rx1 += len(monopix_match_table)
+
+        # Filter FE-I4 events based on the selection done through timestamp comparison in the TLU data (TLU-RX distance), and assign their RX1 timestamps
+        ref_chunk = ref_reader.read_until(trigger_limit)
+        ref_valid_table = np.empty(len(ref_chunk), dtype=ref.dtype)
+        ref_valid_table = ref_valid_table[:mono_ev_utils.assign_rx1_to_FE_sorted(ref=ref_chunk, tlu_match_table=tlu_match_table, ref_valid_table=ref_valid_table)]
+        n_ref_valid += len(ref_valid_table)
+        ref_valid_out.append(ref_valid_table)
+
+        # Correlate events between the Monopix and FE-I4
+        correlation_table = np.empty(len(monopix_match_table), dtype=CORRELATION_DTYPE)
+        _, correlation_match_index = mono_ev_utils.correlate_ev_sorted(monopix_match_table=monopix_match_table, correlation_table=correlation_table, ref_valid_table=ref_valid_table)
+        correlation_out.append(correlation_table[:correlation_match_index])
+        # Filter the Monopix words that could not be correlated to the FE-I4 (including the ones after the last FE-I4 event)
+        monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]
+        mono_ev_utils.hist_phase(monopix_match_table=monopix_match_table, phase_hists=phase_hists)
+        correlated_table.append(monopix_match_table)
+        n_correlated += len(monopix_match_table)
+    correlated_table.flush()
+
+    print ("# of TLU words: {0:d} / {1:d} ({2:.2f}% are discarded based on their TLU-RX1 distance)".format(tlu_out.nrows, tlu_table.nrows, 100.0-100.0*tlu_out.nrows/max(1, tlu_table.nrows)))
+    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% were assigned a RX1 timestamp)".format(n_assigned_rx1, monopix_table.nrows, 100.0*n_assigned_rx1/float(max(1, monopix_table.nrows))))
+    print ("# of FE data {0:d} / {1:d} ({2:.6f}% of the original FE data has a valid TLU trigger number and RX1 timestamp)".format(n_ref_valid, ref.nrows, 100.0*n_ref_valid/float(max(1, ref.nrows))))
+    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% correlated to an event in the FE)".format(n_correlated, n_assigned_rx1, 100.0*n_correlated/float(max(1, n_assigned_rx1))))
+    return phase_hists
+
+def build_events(fin, fref, fout, fcal, plot_flag=False, chunk_size=CHUNK_SIZE):
     """
     Build events using timestamp information from Monopix hits, scintillator (RX1) 
     and TLU (both the standard 15-bit @ 40MHz one, and the 56-bit @640 MHz one).
+
+    The data is processed in chunks of chunk_size words / triggers, so the memory does not depend on the length of the run.
+    Intermediate tables are stored in a temporary file next to fout. Cuts which need the whole run (TLU-RX1 and LE-RX1 distance, 
+    phase quality) are calculated from histograms, which are filled while going through the data.
+    Only Monopix hits correlated to an FE-I4 event are built into events, also after the last FE-I4 event (which the original 
+    in-memory builder kept without correlation, and included in the phase quality).
     """
 
     if plot_flag:
         evBuilderPlot = mono_ev_plot.event_Builder_Plotting(fout=fout, save_png=True, save_single_pdf=False)
 
-    # Load Interpreted Monopix and FE-I4 data
-    dat, ref = load_interpreted_data(fin, fref)
+    # Open Interpreted Monopix and FE-I4 data
+    f_dat, dat, f_ref, ref = open_interpreted_data(fin, fref)
     # Load Pixel Calibration (if any)
     if fcal is not None:
         #TODO: Implement load of pixel calibration
@@ -115,115 +314,65 @@ def build_events(fin, fref, fout, fcal, plot_flag=False):
         pix_calibration = None 
     # Define the name of a modified FE-I4 data file, that will take into account the filters and additional data provided by this event builder
     fref_valid=fref[:-3]+"_valid.h5"
-    # Initialize masks of the different types of data within the whole input data set from the chip
-    monopix_masks = create_mono_masks(dat)
-    monopix_masked_data = create_masked_mono_data(monopix_masks=monopix_masks, dat=dat)
-
-    # Check for Monopix data that comes up before the Monopix timestamp is reset
-    cut_mono_before_reset(mono_mask=monopix_masks["mono"], dat=dat)
-
-    # Align TLU trigger numbers in the input TLU data
-    align_tlu_trigger_number(tlu_mask=monopix_masks["tlu"], tlu_triggerN=monopix_masked_data["tlu_trigger_n"], dat=dat)
-
-    # Create an empty array of the size of the TLU data, where all TLU and data from related timestamps will be condensed 
-    tlu_match_table = np.empty(len(monopix_masked_data["tlu"]),
-                                dtype=[("trigger_number","<i8"),("tlu_timestamp","<i8"),("rx1_timestamp","<i8"),("tlu_HR_timestamp","<i8")])
-    # Assign nearby timestamps to TLU640/HR data
-    tlu_to_timestamps_match_index = mono_ev_utils.assign_timestamps_to_tlu_hr(dat=dat, tlu_match_table=tlu_match_table, search_distance=WORD_SEARCH_DISTANCE)
-    # Filter the TLU640/HR words that could not find a Scintillator (RX) Word within the word search distance
-    tlu_match_table = tlu_match_table[tlu_match_table["rx1_timestamp"]!=MAX_64BIT_TAG]
-    print ("# of TLU words {0:d} / {1:d} ({2:.6f}% are assigned -properly or not- to a rx1_timestamp word)".format(len(tlu_match_table), tlu_to_timestamps_match_index, 100.0*len(tlu_match_table)/float(tlu_to_timestamps_match_index)))
-    #TODO: Plot Timestamps and Trigger Number after overflow correction 
-    # Filter TLU data words according to the difference between TLU and RX timestamps
-    tlu_match_table, TLU_RX_hist, TLU_RX_box_params, TLU_RX_offset, TLU_RX_lowlim, TLU_RX_highlim = mono_ev_utils.hist_and_fit_TLUvsRXdistance(tlu_match_table, fout)
-    if plot_flag:
-        evBuilderPlot.plot_TLUvsRX1(hist=TLU_RX_hist, boxfit_params=TLU_RX_box_params, diff_offset=TLU_RX_offset, lower_lim=TLU_RX_lowlim, upper_lim=TLU_RX_highlim)
-    # Write the filtered TLU match table to a node of the output file
-    mono_ev_utils.create_data_node(file=fout, data=tlu_match_table, name="TLU", description=tlu_match_table.dtype, title='TLU with RX1 timestamp')
-
-    # Create an empty array of the size of the Monopix data, where data from all hits will be condensed and associated with the TLU data
-    monopix_match_table = np.empty(len(monopix_masked_data["mono"]), 
-                                dtype=[("col","u1"),("row","<u8"),("le","u1"),("te","u1"),("tlu_timestamp","<u8"),
-                                ("trigger_number","<i8"), ("token_timestamp","<u8"), ("le_timestamp","<u8"),
-                                ("rx1_timestamp","<u8"),("tlu_HR_timestamp","<u8"),("flg","u1")])
-    # Assign TLU timestamps to Monopix hits.
-    monopix_to_tlu_match_index = mono_ev_utils.assign_tlu_to_monopix(dat=dat, monopix_match_table=monopix_match_table, search_distance=WORD_SEARCH_DISTANCE)
-    # Filter the Monopix words that could not find TLU words within the search distance
-    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]
-    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% were assigned a TLU word)".format(len(monopix_match_table), monopix_to_tlu_match_index, 100.0*len(monopix_match_table)/float(monopix_to_tlu_match_index)))
-    # Calculate the LE timestamp of every hit based on the token timestamp caused by the hit with the shortest ToT in a cluster (defined by Token Timestamp)
-    mono_ev_utils.calculate_le_timestamp(monopix_match_table=monopix_match_table)
-
-    # Assign RX1 timestamps -based on their trigger number in the TLU match table- to the Monopix data
-    monopix_to_rx_match_index = mono_ev_utils.assign_rx1(monopix_match_table=monopix_match_table, tlu_match_table=tlu_match_table)
-    # Filter the Monopix words that could not find reliable RX1 words in the TLU data based on Trigger Numbers
-    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]
-    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% were assigned a RX1 timestamp)".format(len(monopix_match_table), monopix_to_rx_match_index, 100.0*len(monopix_match_table)/float(monopix_to_rx_match_index)))
-
-    # Create an empty array of the size of the FE-I4 data, where the filtered FE data will be located
-    ref_valid_table = np.empty(len(ref), 
-                                dtype=ref.dtype)
-    # Filter FE-I4 events based on the selection done through timestamp comparison in the TLU data (TLU-RX distance)
-    ref_to_filtered_tlu_match_index = mono_ev_utils.del_invalid_tlu_in_FE(ref=ref, tlu_match_table=tlu_match_table, ref_valid_table=ref_valid_table)
-    # Write the filtered valid FE table (up to the maximum index reached) to a node of the modified FE-I4 interpreted file
-    ref_valid_table=ref_valid_table[:ref_to_filtered_tlu_match_index]
-    mono_ev_utils.create_data_node(file=fref_valid, data=ref_valid_table, name="Hits", description=ref_valid_table.dtype, title='Hits with valid TLU trigger number', mode="w")
-    print ("# of FE data {0:d} / {1:d} ({2:.6f}% of the original FE data has a valid TLU trigger number)".format(len(ref_valid_table), len(ref), 100.0*len(ref_valid_table)/float(len(ref))))
-    # Assign RX1 timestamps -based on their trigger number in the TLU match table- to the FE data
-    ref_with_rx1_match_index = mono_ev_utils.assign_rx1_to_FE(ref_valid_table=ref_valid_table, tlu_match_table=tlu_match_table)
-    # Filter the FE-I4 words that could not find reliable RX1 words in the TLU data based on Trigger Numbers
-    ref_valid_table = ref_valid_table[ref_valid_table["trigger_number"]!=MAX_64BIT_TAG]
-    # Write the valid FE table with RX1 (up to the maximum index reached) to a node of the modified FE-I4 interpreted file
-    mono_ev_utils.create_data_node(file=fref_valid, data=ref_valid_table, name="Hits", description=ref_valid_table.dtype, title='Hits with valid TLU trigger number')
-    print ("# of FE data {0:d} / {1:d} ({2:.6f}% were assigned a RX1 timestamp)".format(len(ref_valid_table), ref_with_rx1_match_index, 100.0*len(ref_valid_table)/float(ref_with_rx1_match_index)))
-    
-    # Create an empty array of the size of the Monopix data, where data specifically related to correlation will be recorded
-    correlation_table = np.empty(len(monopix_masked_data["mono"]),
-                                dtype=[("event_number","<i8"),("dut_col","u1"),("dut_row","u2"),("ref_col","u1"),("ref_row","u2")])
-    # Correlate events between the Monopix and FE-I4
-    matched_monopix_index, correlation_match_index = mono_ev_utils.correlate_ev(monopix_match_table=monopix_match_table, correlation_table=correlation_table, ref_valid_table=ref_valid_table)
-    # Filter the Monopix words that could not be correlated to the FE-I4
-    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"]!=MAX_64BIT_TAG]
-    print ("# of Monopix data {0:d} / {1:d} ({2:.6f}% correlated to an event in the FE)".format(len(monopix_match_table), matched_monopix_index, 100.0*len(monopix_match_table)/float(matched_monopix_index)))
-    # Write the filtered correlation table (up to the maximum index reached) to a node of the output file
-    correlation_table=correlation_table[:correlation_match_index]
-    mono_ev_utils.create_data_node(file=fout, data=correlation_table, name="Correlation", description=correlation_table.dtype, title='Correlation between Monopix and Reference FE-I4')                                            
-    # Plot correlation in rows and columns
-    if plot_flag:
-        evBuilderPlot.plot_correlation(corr_str_orientation="Vertical", 
-                                        corr_dut=correlation_table["dut_col"], corr_ref=correlation_table["ref_col"], 
-                                        dim_str_dut="Column", dim_str_ref="Column", 
-                                        dim_size_dut=MONO_COL_SIZE,  dim_size_ref=FE_COL_SIZE)
-        evBuilderPlot.plot_correlation(corr_str_orientation="Horizontal", 
-                                        corr_dut=correlation_table["dut_row"], corr_ref=correlation_table["ref_row"], 
-                                        dim_str_dut="Row", dim_str_ref="Row", 
-                                        dim_size_dut=MONO_ROW_SIZE,  dim_size_ref=FE_ROW_SIZE)
-
-    # Calculate the quality of the phase (delay of the RX1 in 640MHz Clocks, with respect to the start of every 40MHz Clock)
-    monopix_phase_quality, monopix_phase_fraction=mono_ev_utils.calculate_phase_quality(fout=fout, monopix_match_table=monopix_match_table)
-    if plot_flag:
-        evBuilderPlot.plot_phase_fraction(monopix_phase_fraction=monopix_phase_fraction)
-    # Calculate the phase and assign quality in the FE-I4 data
-    ref_with_phase_quality_index=mono_ev_utils.calculate_phase_in_FE(ref_valid_table=ref_valid_table,monopix_phase_quality=monopix_phase_quality)
-    # Write the modified FE-I4 data to to a node of the modified FE-I4 interpreted file
-    mono_ev_utils.create_data_node(file=fref_valid, data=ref_valid_table, name="Hits", description=ref_valid_table.dtype, title='Hits with valid TLU trigger number')
-    
-    # Create an empty array of the size of the matched Monopix data, where all valid events are recorded
-    event_table = np.empty(len(monopix_match_table),
-                                dtype=[("event_number","<i8"),("column","<u2"),("row","<u2"),("frame","<u2"),("charge","<f4"),
-                                ("tot","<f4"),("phase","u1"),("phase_quality","u1"),("veto_flg","u1")])
-    # Fill the table of events
-    mono_ev_utils.fill_event_table(event_table=event_table, monopix_match_table=monopix_match_table, monopix_phase_quality=monopix_phase_quality, pix_calibration=pix_calibration)
-    # Filter events according to a reasonable difference between LE and RX timestamps (Time-walk)
-    event_table, LE_RX_hist, LE_RX_box_params, LE_RX_offset, LE_RX_lowlim, LE_RX_highlim = mono_ev_utils.hist_and_fit_LEvsRXdistance(monopix_match_table=monopix_match_table, event_table=event_table, fout=fout, add_safety_offset=32)
-    if plot_flag:
-        evBuilderPlot.plot_LEvsRX1(hist=LE_RX_hist, boxfit_params=LE_RX_box_params, diff_offset=LE_RX_offset, lower_lim=LE_RX_lowlim, upper_lim=LE_RX_highlim)
-    
-    # Store events to a node of the output file
-    mono_ev_utils.create_data_node(file=fout, data=event_table, name="Hits", description=event_table.dtype, title='Events built with time-walk and phase')
-    # Plot the time-walk, ToT and phase distribution of all built events
-    if plot_flag:
-        evBuilderPlot.plot_built_events(event_table=event_table, pix_calibration=pix_calibration)
+    fd, ftmp = tempfile.mkstemp(suffix=".h5", prefix=os.path.basename(fout)[:-3]+"_", dir=os.path.dirname(os.path.abspath(fout)))
+    os.close(fd)
+    try:
+        with f_dat, f_ref, tables.open_file(ftmp, "w") as tmp_h5, tables.open_file(fout, "a") as out_h5, tables.open_file(fref_valid, "w") as ref_valid_h5:
+            # Assign TLU and RX1 timestamps to TLU640/HR words, and TLU words to Monopix hits
+            tlu_hist = match_tlu_and_monopix(dat=dat, tmp_h5=tmp_h5, chunk_size=chunk_size)
+            #TODO: Plot Timestamps and Trigger Number after overflow correction 
+            # Filter TLU data words according to the difference between TLU and RX timestamps
+            TLU_RX_box_params, TLU_RX_offset, TLU_RX_lowlim, TLU_RX_highlim = mono_ev_utils.fit_TLUvsRXdistance(tlu_hist)
+            if plot_flag:
+                evBuilderPlot.plot_TLUvsRX1(hist=(tlu_hist, mono_ev_utils.TLU_RX_BINS), boxfit_params=TLU_RX_box_params, diff_offset=TLU_RX_offset, lower_lim=TLU_RX_lowlim, upper_lim=TLU_RX_highlim)
+
+            # Assign RX1 timestamps to Monopix and FE data, filter invalid FE-I4 events and correlate events between the Monopix and FE-I4
+            phase_hists = match_triggers(tmp_h5=tmp_h5, ref=ref, out_h5=out_h5, ref_valid_h5=ref_valid_h5, tlu_lim=(TLU_RX_lowlim, TLU_RX_highlim), chunk_size=chunk_size)
+            # Plot correlation in rows and columns
+            if plot_flag:
+                evBuilderPlot.plot_correlation(corr_str_orientation="Vertical", 
+                                                corr_dut=out_h5.root.Correlation.col("dut_col"), corr_ref=out_h5.root.Correlation.col("ref_col"), 
+                                                dim_str_dut="Column", dim_str_ref="Column", 
+                                                dim_size_dut=MONO_COL_SIZE,  dim_size_ref=FE_COL_SIZE)
+                evBuilderPlot.plot_correlation(corr_str_orientation="Horizontal", 
+                                                corr_dut=out_h5.root.Correlation.col("dut_row"), corr_ref=out_h5.root.Correlation.col("ref_row"), 
+                                                dim_str_dut="Row", dim_str_ref="Row", 
+                                                dim_size_dut=MONO_ROW_SIZE,  dim_size_ref=FE_ROW_SIZE)
+
+            # Calculate the quality of the phase (delay of the RX1 in 640MHz Clocks, with respect to the start of every 40MHz Clock)
+            monopix_phase_quality, monopix_phase_fraction=mono_ev_utils.calculate_phase_quality(phase_hists=phase_hists)
+            if plot_flag:
+                evBuilderPlot.plot_phase_fraction(monopix_phase_fraction=monopix_phase_fraction)
+            # Calculate the phase and assign quality in the FE-I4 data
+            ref_valid_table = ref_valid_h5.root.Hits
+            for start in range(0, ref_valid_table.nrows, chunk_size):
+                ref_valid_chunk = ref_valid_table.read(start, start + chunk_size)
+                mono_ev_utils.calculate_phase_in_FE(ref_valid_table=ref_valid_chunk, monopix_phase_quality=monopix_phase_quality)
+                ref_valid_table.modify_rows(start=start, rows=ref_valid_chunk)
+
+            # Filter events according to a reasonable difference between LE and RX timestamps (Time-walk)
+            LE_RX_hist = phase_hists.sum(axis=0)
+            LE_RX_box_params, LE_RX_offset, LE_RX_lowlim, LE_RX_highlim = mono_ev_utils.fit_LEvsRXdistance(LE_RX_hist)
+            if plot_flag:
+                evBuilderPlot.plot_LEvsRX1(hist=(LE_RX_hist, mono_ev_utils.LE_RX_BINS), boxfit_params=LE_RX_box_params, diff_offset=LE_RX_offset, lower_lim=LE_RX_lowlim, upper_lim=LE_RX_highlim)
+            event_out = mono_ev_utils.create_data_table(h5_file=out_h5, name="Hits", description=EVENT_DTYPE, title='Events built with time-walk and phase')
+            monopix_table = tmp_h5.root.Correlated
+            for start in range(0, monopix_table.nrows, chunk_size):
+                monopix_match_table = monopix_table.read(start, start + chunk_size)
+                # Create an empty array of the size of the matched Monopix data, where all valid events are recorded
+                event_table = np.empty(len(monopix_match_table), dtype=EVENT_DTYPE)
+                # Fill the table of events
+                mono_ev_utils.fill_event_table(event_table=event_table, monopix_match_table=monopix_match_table, monopix_phase_quality=monopix_phase_quality, pix_calibration=pix_calibration)
+                # Store events to a node of the output file
+                event_out.append(event_table[mono_ev_utils.select_LEvsRXdistance(monopix_match_table=monopix_match_table, event_table=event_table, diff_offset=LE_RX_offset, lower_lim=LE_RX_lowlim, upper_lim=LE_RX_highlim, add_safety_offset=32)])
+            event_out.flush()
+            print ("# of Events: {0:d} / {1:d} ({2:.2f}% are discarded based on their LE-RX1 distance)".format(event_out.nrows, monopix_table.nrows, 100.0-100.0*event_out.nrows/max(1, monopix_table.nrows)))
+
+            # Plot the time-walk, ToT and phase distribution of all built events
+            if plot_flag:
+                evBuilderPlot.plot_built_events(event_table={name: event_out.col(name) for name in ["frame", "tot", "charge", "phase"]}, pix_calibration=pix_calibration)
+    finally:
+        os.remove(ftmp)
 
     if plot_flag:
         evBuilderPlot._close_pdf()
@@ -235,6 +384,7 @@ if __name__=="__main__":
     parser.add_argument("-fin", "--fin", type=str, default=None)
     parser.add_argument('-fref',"--fref", type=str, default=None)
     parser.add_argument('-fcal',"--fcal", type=str, default=None)
+    parser.add_argument('-c',"--chunk_size", type=int, default=CHUNK_SIZE, help="Words / triggers per chunk, limits the memory.")
     
     args=parser.parse_args()
 
@@ -259,4 +409,4 @@ if __name__=="__main__":
         os.makedirs(output_folder)
     fout=os.path.join(output_folder, fin_filename[:-14]+"ev.h5")
 
-    build_events(fin, fref, fout, fcal, plot_flag=True)
+    build_events(fin, fref, fout, fcal, plot_flag=True, chunk_size=args.chunk_size)
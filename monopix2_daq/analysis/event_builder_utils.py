@@ -8,18 +8,73 @@ import matplotlib.pyplot as plt
 import tables
 
 
+TLU_RX_BINS = np.arange(-0x80000,0x80000,1)
+LE_RX_BINS = np.arange(-0x10000,0x10000,0x1)
+
 def create_data_node(file, data, name, description, title, mode="a"):
     """
     This function creates a node in a specific table file and appends the input data to it 
     """
     with tables.open_file(file, mode) as f:
-        try:  ##TODO how to get existance of table?
-            f.remove_node(f.root, name)
-        except:
-            pass
-        hit_table=f.create_table(f.root, name=name, description=description, title=title)
+        hit_table=create_data_table(h5_file=f, name=name, description=description, title=title)
         hit_table.append(data)
 
+def create_data_table(h5_file, name, description, title, filters=None):
+    """
+    This function creates an empty table in an open file (replacing an existing node with the same name), data can be appended chunk by chunk
+    """
+    if name in h5_file.root:
+        h5_file.remove_node(h5_file.root, name)
+    return h5_file.create_table(h5_file.root, name=name, description=description, title=title, filters=filters)
+
+class SortedTableReader(object):
+    """
+    Reads a table sorted by one field in windows of field values (all rows below an upper limit), only a few chunks are kept in memory.
+    An optional selection (function of the rows returning a mask) is applied when reading.
+    """
+    def __init__(self, table, field, chunk_size, selection=None):
+        self.table=table
+        self.field=field
+        self.chunk_size=chunk_size
+        self.selection=selection
+        self.n_read=0
+        self._buffer=table.read(0, 0)
+        self._last=None
+
+    def _fill(self):
+        rows=self.table.read(self.n_read, self.n_read+self.chunk_size)
+        self.n_read+=len(rows)
+        if len(rows)==0:
+            return
+        values=rows[self.field]
+        if (self._last is not None and values[0]<self._last) or np.any(np.diff(values)<0):
+            raise RuntimeError("{0} of {1} is not increasing monothonically. Check your data.".format(self.field, self.table._v_pathname))
+        self._last=values[-1]
+        if self.selection is not None:
+            rows=rows[self.selection(rows)]
+        self._buffer=np.concatenate((self._buffer, rows))
+
+    def read_until(self, limit=None):
+        """
+        Returns the following rows with field values below limit (all remaining rows if limit is None)
+        """
+        while self.n_read < self.table.nrows and (limit is None or len(self._buffer)==0 or self._buffer[self.field][-1] < limit):
+            self._fill()
+        n_rows=len(self._buffer) if limit is None else np.searchsorted(self._buffer[self.field], limit, side="left")
+        rows, self._buffer = self._buffer[:n_rows], self._buffer[n_rows:]
+        return rows
+
+def hist_distance(diff, bins):
+    """
+    Histograms integer timestamp differences, same as np.histogram(diff, bins)[0] for bins of width 1 (without a binary search per entry).
+    The histograms of chunks of data can be added.
+    """
+    n_bins=len(bins)-1
+    index=np.int64(diff)-bins[0]
+    index=index[np.logical_and(index>=0, index<=n_bins)]
+    index[index==n_bins]=n_bins-1  # The last bin includes its right edge
+    return np.bincount(index, minlength=n_bins)
+
 @njit
 def assign_timestamps_to_tlu_hr(dat, tlu_match_table, search_distance):
     """
@@ -35,8 +90,9 @@ def assign_timestamps_to_tlu_hr(dat, tlu_match_table, search_distance):
             # Initialize standard TLU and RX1 timestamps with a very large value.
             tlu_match_table[t_i]['tlu_timestamp']=mono_evBuilder.MAX_64BIT_TAG
             tlu_match_table[t_i]['rx1_timestamp']=mono_evBuilder.MAX_64BIT_TAG    
+            tlu_match_table[t_i]['trigger_number']=mono_evBuilder.MAX_64BIT_TAG
             # Search for the closest (LATER) TLU_timestamp word. IF AVAILABLE.
-            for i in range(d_i+1,d_i+search_distance,1):
+            for i in range(d_i+1,min(len(dat), d_i+search_distance),1):
                 if dat[i]["col"]==mono_evBuilder.TLU_TAG:
                     tlu_match_table[t_i]['tlu_timestamp']=dat[i]["timestamp"]
                     tlu_match_table[t_i]["trigger_number"]=dat[i]['cnt']                           
@@ -51,18 +107,19 @@ def assign_timestamps_to_tlu_hr(dat, tlu_match_table, search_distance):
     # Return the index of the highest TLU word
     return t_i
 
-def hist_and_fit_TLUvsRXdistance(tlu_match_table, fout):
+def hist_TLUvsRXdistance(tlu_match_table):
     """
-    This function histograms and fits a box function to the distance between two input timestamps.
-    It plots such distribution and the corresponding fit parameters. 
-    It returns the data within a valid selection range, parameters of the box fit and low and high limit of the selection range.
+    This function histograms the distance between the TLU_HR and RX1 timestamps (histograms of chunks of data can be added)
     """
+    return hist_distance(np.int64(tlu_match_table["tlu_HR_timestamp"]-tlu_match_table["rx1_timestamp"]), TLU_RX_BINS)
 
-    # Calculate the difference between TLU_HR and RX input, and histogram it
-    diff=np.int64(tlu_match_table["tlu_HR_timestamp"]-tlu_match_table["rx1_timestamp"])
-    hist=np.histogram(diff, bins=np.arange(-0x80000,0x80000,1) )
-    x=hist[1][:-1]
-    y=hist[0]
+def fit_TLUvsRXdistance(hist):
+    """
+    This function fits a box function to the histogram of the distance between TLU_HR and RX1 timestamps.
+    It returns the parameters of the box fit and low and high limit of the valid selection range.
+    """
+    x=TLU_RX_BINS[:-1]
+    y=hist
 
     print("Fitting a box function to TLU-RX1 distribution...")
     boxfit_params=mono_utils.fit_boxfc(x, y)
@@ -75,12 +132,16 @@ def hist_and_fit_TLUvsRXdistance(tlu_match_table, fout):
     lower_lim=round(diff_offset-1*np.abs(width)-5*np.abs(sigma),0)
     upper_lim=round(diff_offset+2*np.abs(width)+5*np.abs(sigma),0)
     print("Rising edge of the main peak (TLU-RX1 offset @ 640MHz Clocks) located at %s"%str(diff_offset))
-
     print ("Filtering TLU_timestamp-Rx1_timestamp by upper_lim of ",upper_lim," and lower_lim of",lower_lim)
-    diff_selection_mask=tlu_match_table[np.bitwise_and(diff<=upper_lim, diff>=lower_lim)]
-    print ("# of TLU words: {0:d} / {1:d} ({2:.2f}% are discarded based on their TLU-RX1 distance)".format(len(diff_selection_mask), len(tlu_match_table), 100.0-100.0*len(diff_selection_mask)/len(tlu_match_table)))
 
-    return diff_selection_mask, hist, boxfit_params, diff_offset, lower_lim, upper_lim
+    return boxfit_params, diff_offset, lower_lim, upper_lim
+
+def select_TLUvsRXdistance(tlu_match_table, lower_lim, upper_lim):
+    """
+    This function returns the mask of TLU words within the valid TLU-RX1 distance range
+    """
+    diff=np.int64(tlu_match_table["tlu_HR_timestamp"]-tlu_match_table["rx1_timestamp"])
+    return np.bitwise_and(diff<=upper_lim, diff>=lower_lim)
 
 @njit
 def assign_tlu_to_monopix(dat, monopix_match_table, search_distance):
@@ -96,6 +157,7 @@ def assign_tlu_to_monopix(dat, monopix_match_table, search_distance):
             monopix_match_table[m_i]["trigger_number"] = mono_evBuilder.MAX_64BIT_TAG
             monopix_match_table[m_i]["tlu_timestamp"] = mono_evBuilder.MAX_64BIT_TAG
             monopix_match_table[m_i]["tlu_HR_timestamp"] = mono_evBuilder.MAX_64BIT_TAG
+            monopix_match_table[m_i]["rx1_timestamp"] = mono_evBuilder.MAX_64BIT_TAG
             # Assign hit pixel information and timestamp as token timestamp.
             monopix_match_table[m_i]["col"] = d['col']
             monopix_match_table[m_i]["row"] = d['row']
@@ -110,7 +172,7 @@ def assign_tlu_to_monopix(dat, monopix_match_table, search_distance):
                     #Assign the TLU_HR word to the Monopix hit
                     monopix_match_table[m_i]["tlu_HR_timestamp"] = dat[i]['timestamp']
                     # Look for the first TLU_HR words a few words after the Monopix data, "assuming" the TLU word comes always AFTER the TLU_HR one. 
-                    for j in range(i+1,i+search_distance,1):
+                    for j in range(i+1,min(len(dat), i+search_distance),1):
                         if dat[j]['col'] == mono_evBuilder.TLU_TAG:
                             # Assign the TLU trigger timestamp to the hit 
                             monopix_match_table[m_i]["tlu_timestamp"] = dat[j]['timestamp']
@@ -291,62 +353,170 @@ def correlate_ev(monopix_match_table, correlation_table, ref_valid_table):
                 break
     return m_i+1, c_i
 
-def calculate_phase_quality(fout, monopix_match_table):    
+@njit
+def assign_timestamps_to_tlu_hr_sorted(dat, tlu_match_table):
     """
-    It calculates the quality of the 640 MHz phase of a Monopix hits
-    (The smaller the quality, the more hits within a single bin, i.e. closer to the start of the 40 MHz clock)
+    Assigns the closest EARLIER RX1 word and the closest LATER TLU word to every TLU word sampled in 640 MHz, at any distance.
+    Merge join on the word position (the last RX1 word and the next TLU word only move forward), O(n).
+    Not found: MAX_64BIT_TAG
+    """
+    t_i=0
+    rx1_timestamp=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+    next_tlu=0
+    for d_i in range(len(dat)):
+        if dat[d_i]["col"]==mono_evBuilder.RX640_TAG:
+            rx1_timestamp=np.int64(dat[d_i]["timestamp"])
+        elif dat[d_i]["col"]==mono_evBuilder.TLU640_TAG:
+            tlu_match_table[t_i]['tlu_HR_timestamp']=dat[d_i]["timestamp"]
+            tlu_match_table[t_i]['rx1_timestamp']=rx1_timestamp
+            next_tlu=max(next_tlu, d_i+1)
+            while next_tlu<len(dat) and dat[next_tlu]["col"]!=mono_evBuilder.TLU_TAG:
+                next_tlu=next_tlu+1
+            if next_tlu<len(dat):
+                tlu_match_table[t_i]['tlu_timestamp']=dat[next_tlu]["timestamp"]
+                tlu_match_table[t_i]["trigger_number"]=dat[next_tlu]['cnt']
+            else:
+                tlu_match_table[t_i]['tlu_timestamp']=mono_evBuilder.MAX_64BIT_TAG
+                tlu_match_table[t_i]["trigger_number"]=mono_evBuilder.MAX_64BIT_TAG
+            t_i=t_i+1
+    return t_i
+
+@njit
+def assign_tlu_to_monopix_sorted(dat, monopix_match_table):
+    """
+    Assigns the closest EARLIER TLU_HR word, and the closest TLU word after it, to every Monopix word, at any distance.
+    Merge join on the word position (as assign_timestamps_to_tlu_hr_sorted), O(n).
+    Not found: MAX_64BIT_TAG
+    """
+    m_i=0
+    tlu_hr_timestamp=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+    tlu_timestamp=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+    trigger_number=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+    next_tlu=0
+    for d_i in range(len(dat)):
+        if dat[d_i]["col"]==mono_evBuilder.TLU640_TAG:
+            tlu_hr_timestamp=np.int64(dat[d_i]["timestamp"])
+            next_tlu=max(next_tlu, d_i+1)
+            while next_tlu<len(dat) and dat[next_tlu]["col"]!=mono_evBuilder.TLU_TAG:
+                next_tlu=next_tlu+1
+            if next_tlu<len(dat):
+                tlu_timestamp=np.int64(dat[next_tlu]["timestamp"])
+                trigger_number=np.int64(dat[next_tlu]["cnt"])
+            else:
+                tlu_timestamp=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+                trigger_number=np.int64(mono_evBuilder.MAX_64BIT_TAG)
+        elif dat[d_i]["col"] < mono_evBuilder.MONO_COL_SIZE:
+            monopix_match_table[m_i]["col"] = dat[d_i]['col']
+            monopix_match_table[m_i]["row"] = dat[d_i]['row']
+            monopix_match_table[m_i]["le"] = dat[d_i]['le']
+            monopix_match_table[m_i]["te"] = dat[d_i]['te']
+            monopix_match_table[m_i]["flg"] = dat[d_i]['cnt']
+            monopix_match_table[m_i]["token_timestamp"] = dat[d_i]['timestamp']
+            monopix_match_table[m_i]["tlu_HR_timestamp"] = tlu_hr_timestamp
+            monopix_match_table[m_i]["tlu_timestamp"] = tlu_timestamp
+            monopix_match_table[m_i]["trigger_number"] = trigger_number
+            monopix_match_table[m_i]["rx1_timestamp"] = mono_evBuilder.MAX_64BIT_TAG
+            m_i=m_i+1
+    return m_i
+
+@njit
+def assign_rx1_sorted(monopix_match_table, tlu_match_table):
+    """
+    Assigns the RX1_timestamp of the TLU word with the same trigger number to the Monopix hits, flags hits without one.
+    Two-pointer merge join, both tables have to be sorted by trigger number, O(n+m).
+    """
+    t_i=0
+    for m_i in range(len(monopix_match_table)):
+        trigger_number=monopix_match_table[m_i]["trigger_number"]
+        while t_i<len(tlu_match_table) and tlu_match_table[t_i]["trigger_number"]<trigger_number:
+            t_i=t_i+1
+        if t_i<len(tlu_match_table) and tlu_match_table[t_i]["trigger_number"]==trigger_number:
+            monopix_match_table[m_i]["rx1_timestamp"]=tlu_match_table[t_i]["rx1_timestamp"]
+        else:
+            monopix_match_table[m_i]["trigger_number"]=mono_evBuilder.MAX_64BIT_TAG
+    return len(monopix_match_table)
+
+@njit
+def assign_rx1_to_FE_sorted(ref, tlu_match_table, ref_valid_table):
+    """
+    Copies the FE-I4 hits of events in the (filtered) TLU data to ref_valid_table and writes the RX1_timestamp to their TDC column
+    (replaces del_invalid_tlu_in_FE and assign_rx1_to_FE). The event number has to match the trigger number, and the FE-I4 trigger number its lower 16 bits.
+    Two-pointer merge join, both tables have to be sorted by event / trigger number, O(n+m).
+    """
+    t_i=0
+    b_i=0
+    for r_i in range(len(ref)):
+        event_number=ref[r_i]["event_number"]
+        while t_i<len(tlu_match_table) and tlu_match_table[t_i]["trigger_number"]<event_number:
+            t_i=t_i+1
+        if (t_i<len(tlu_match_table) and tlu_match_table[t_i]["trigger_number"]==event_number and 
+                (np.int64(ref[r_i]["trigger_number"]) & mono_evBuilder.TLU_TRIGGERNUMBER_MAX)==(event_number & mono_evBuilder.TLU_TRIGGERNUMBER_MAX)):
+            ref_valid_table[b_i]=ref[r_i]
+            ref_valid_table[b_i]["TDC"]=tlu_match_table[t_i]["rx1_timestamp"]
+            b_i=b_i+1
+    return b_i
+
+@njit
+def correlate_ev_sorted(monopix_match_table, correlation_table, ref_valid_table):
+    """
+    Correlates every Monopix hit with the first FE-I4 hit of the event with the same trigger number, flags hits without one.
+    Unlike correlate_ev, this includes the hits after the last FE-I4 event.
+    Two-pointer merge join, both tables have to be sorted by trigger / event number, O(n+m).
+    """
+    f_i=0
+    c_i=0
+    for m_i in range(len(monopix_match_table)):
+        trigger_number=monopix_match_table[m_i]["trigger_number"]
+        while f_i<len(ref_valid_table) and ref_valid_table[f_i]["event_number"]<trigger_number:
+            f_i=f_i+1
+        if f_i<len(ref_valid_table) and ref_valid_table[f_i]["event_number"]==trigger_number:
+            correlation_table[c_i]["event_number"]=ref_valid_table[f_i]["event_number"]
+            correlation_table[c_i]["dut_col"]=monopix_match_table[m_i]["col"]
+            correlation_table[c_i]["ref_row"]=ref_valid_table[f_i]["row"]
+            correlation_table[c_i]["dut_row"]=monopix_match_table[m_i]["row"]
+            correlation_table[c_i]["ref_col"]=ref_valid_table[f_i]["column"]
+            c_i=c_i+1
+        else:
+            monopix_match_table[m_i]["trigger_number"]=mono_evBuilder.MAX_64BIT_TAG
+    return len(monopix_match_table), c_i
+
+def hist_phase(monopix_match_table, phase_hists):
+    """
+    It adds the Time-walk (LE-RX1) of Monopix hits to the histograms of the 16 640 MHz phases of the RX1 timestamp
     """
     # Segment the RX1 timestamp of the chip in 16 values ("phases")
     phase_ref=np.int64(monopix_match_table["rx1_timestamp"])&0xF
+    diff=np.int64(monopix_match_table['le_timestamp']-monopix_match_table['rx1_timestamp'])
+    for ph in np.arange(0,16):
+        phase_hists[ph]+=hist_distance(diff[phase_ref==ph], LE_RX_BINS)
+
+def calculate_phase_quality(phase_hists):
+    """
+    It calculates the quality of the 640 MHz phase of a Monopix hits from the Time-walk histograms of the phases (see hist_phase)
+    (The smaller the quality, the more hits within a single bin, i.e. closer to the start of the 40 MHz clock)
+    """
     # Initialize the best phase and ratio-between-bins counters
     best_phase=0
     ratio=0
-    # Histogram the Time-walk (LE-RX1) 
-    phase_hist=np.histogram( np.int64( monopix_match_table['le_timestamp']-monopix_match_table['rx1_timestamp'])
-                        ,bins=np.arange(-0x10000,0x10000,0x1))
-    # Find the rising edge of the largest peak
-    tw_mainpeak=np.argwhere(phase_hist[0]> (phase_hist[0][np.argmax(phase_hist[0])])/2 )
-    # Pass the rising edge of the largest peak as offset
-    tw_offset_ns=phase_hist[1][tw_mainpeak[0]]
-    #print (tw_offset_ns)
-    #plt.step(phase_hist[1][:-1], phase_hist[0])
-    #plt.yscale("log")
     phase_fraction=[]
     phase_id=np.arange(0,16)
     # Goes through all the phases until it finds the phase where most of the hits are within one bin 
     # (compared to the sum of hits in that bin, and the ones before and after)
     for ph in np.arange(0,16):
-        #print (ph)
-        curr_phase_data=monopix_match_table[phase_ref==ph]
-        #fig, ax1 = plt.subplots()
-        phase_hist=np.histogram( np.int64( curr_phase_data['le_timestamp']-curr_phase_data['rx1_timestamp'])
-                            ,bins=np.arange(-0x10000,0x10000,0x1))
-        #plt.step(phase_hist[1][:-1], phase_hist[0])
-        #plt.yscale("log")
-        window=[tw_offset_ns-32,tw_offset_ns+32]
-        max_i=np.argmax(phase_hist[0])
-        #print max_i
-        max1, max2, max3= phase_hist[0][max_i], phase_hist[0][max_i-16], phase_hist[0][max_i+16]
-        #print (max1, max2, max3)
+        max_i=np.argmax(phase_hists[ph])
+        max1, max2, max3= phase_hists[ph][max_i], phase_hists[ph][max_i-16], phase_hists[ph][max_i+16]
         rat= float(max1)/float(max1+max2+max3)
         phase_fraction.append(rat)
-        #print (rat, ratio)
         if rat>=ratio:
             best_phase=ph
             ratio=rat
-        #ax1.set_xlim(window[0],window[1])
-        #ax1.set_xlabel("Time [ns]")
-        #ax1.set_title("Phase %s"%str(ph))
     print ("Best phase value: %s"%str(best_phase))
-    #print phase_id
-    #print phase_fraction
 
     # Generate a list that classifies the phase values according to their fraction (0: Best, 15: Worse) 
     phase_quality=[x for y, x in sorted(zip(phase_fraction, phase_id), reverse=True)]
 
     # The list has to be casted into a numba-valid typed-list in order to be able to use it as parameter for other jitted functions
     phase_quality=List(phase_quality)
-    #phase_quality=np.asarray(phase_quality)
 
     return phase_quality, phase_fraction
 
@@ -387,18 +557,13 @@ def fill_event_table(event_table, monopix_match_table, monopix_phase_quality, pi
         event_table[m_i]["phase_quality"]=monopix_phase_quality.index(np.int64(m["rx1_timestamp"])&0xF)
         event_table[m_i]["veto_flg"]=m["flg"]
 
-def hist_and_fit_LEvsRXdistance(monopix_match_table, event_table, fout, add_safety_offset):
+def fit_LEvsRXdistance(hist):
     """
-    This function histograms and fits a box function to the distance between two input timestamps (LE and RX/Scintillator).
-    It plots such distribution and the corresponding fit parameters. 
-    The whole data set is shifted by an offset (safety_offset) and filtered to include only positive values (as required by Test-Beam Analysis)
-    It returns the data within a valid selection range, parameters of the box fit and low and high limit of the selection range.
+    This function fits a box function to the histogram of the distance between LE and RX/Scintillator timestamps (the sum of the phase histograms).
+    It returns the parameters of the box fit and low and high limit of the valid selection range.
     """
-    # Calculate the difference between TLU_HR and RX input, and histogram it
-    diff=np.int64(monopix_match_table["le_timestamp"]-monopix_match_table["rx1_timestamp"])
-    hist=np.histogram(diff, bins=np.arange(-0x10000,0x10000,0x1))
-    x=hist[1][:-1]
-    y=hist[0]
+    x=LE_RX_BINS[:-1]
+    y=hist
 
     print("Fitting a box function to LE-RX1 distribution...")
     boxfit_params=mono_utils.fit_boxfc(x, y)
@@ -411,19 +576,16 @@ def hist_and_fit_LEvsRXdistance(monopix_match_table, event_table, fout, add_safe
     lower_lim=round(diff_offset-1*np.abs(width)-5*np.abs(sigma),0)
     upper_lim=round(diff_offset+10*np.abs(width)+5*np.abs(sigma),0)
     print("Rising edge of the main peak (TLU-RX1 offset @ 640MHz Clocks) located at %s"%str(diff_offset))
+    print ("Filtering LE_timestamp-RX1_timestamp by upper_lim of ",upper_lim," and lower_lim of",lower_lim)
 
+    return boxfit_params, diff_offset, lower_lim, upper_lim
 
+def select_LEvsRXdistance(monopix_match_table, event_table, diff_offset, lower_lim, upper_lim, add_safety_offset):
+    """
+    The data set is shifted by an offset (safety_offset) and the frame of the events is set to the LE-RX1 distance. 
+    It returns the mask of events within the valid selection range (only positive values, as required by Test-Beam Analysis).
+    """
+    diff=np.int64(monopix_match_table["le_timestamp"]-monopix_match_table["rx1_timestamp"])
     frame=diff-diff_offset+add_safety_offset
-    #frame[frame<0]=0
-    #frame[frame>0xFFFFFFFF]=0xFFFFFFFF  
     event_table["frame"]=np.uint16(frame)
-    #valid=np.argwhere(np.bitwise_and(frame!=0,frame!=0xFFFFFFFF))[:,0]
-    #print ("# of data with valid frame",len(valid),100.0*len(valid)/len(frame))
-
-    print ("Filtering LE_timestamp-RX1_timestamp by upper_lim of ",upper_lim," and lower_lim of",lower_lim)
-    #diff_selection_mask=frame[np.bitwise_and(frame<=upper_lim+0x8000-diff_offset, frame>=lower_lim+0x8000-diff_offset)]
-    diff_selection_mask=event_table[np.bitwise_and(frame<=upper_lim-diff_offset+add_safety_offset, frame>=lower_lim-diff_offset+add_safety_offset)]
-    print ("# of Events: {0:d} / {1:d} ({2:.2f}% are discarded based on their LE-RX1 distance)".format(len(diff_selection_mask), len(monopix_match_table), 100.0-100.0*len(diff_selection_mask)/len(monopix_match_table)))
-
-    return diff_selection_mask, hist, boxfit_params, diff_offset, lower_lim, upper_lim
-
+    return np.bitwise_and(frame<=upper_lim-diff_offset+add_safety_offset, frame>=lower_lim-diff_offset+add_safety_offset)
@@ -3,6 +3,7 @@ import time
 import os
 import numpy as np
 import numba
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import tables as tb
 
@@ -37,6 +38,9 @@ class_spec = [
     ('raw_idx', numba.uint32)
 ]
 
+# Hits of RawDataInterpreter, ParallelRawDataInterpreter and VectorizedRawDataInterpreter
+hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<i4')]
+
 """
 Functions to identify and interpret words generated by the LF-Monopix2 read-out.
     1. Pixel address and ToT (32-bit Word):
@@ -205,36 +209,380 @@ def get_tlu_timestamp(word):
     return word & 0x7FFF0000
 
 
+"""
+Interpretation kernel. The interpreter state is kept in an int64 array (indices below), so the kernel can run
+without the GIL and a state can be copied, compared and handed over between threads.
+Only the flags and the words combined so far (timestamps, ToT) carry information from one word to the next one:
+col, row, le, te and noise are always set again before they are used.
+"""
+STATE_MONOPIX_FLAG = 0
+STATE_RX_FLAG = 1
+STATE_INJ_FLAG = 2
+STATE_MON_FLAG = 3
+STATE_TLU_FLAG = 4
+STATE_MONOPIX_TOKEN_TIMESTAMP = 5
+STATE_RX_TIMESTAMP640 = 6
+STATE_INJ_TIMESTAMP640 = 7
+STATE_MON_TIMESTAMP640 = 8
+STATE_MON_TOT640 = 9
+STATE_TLU_TIMESTAMP640 = 10
+STATE_COL = 11
+STATE_ROW = 12
+STATE_LE = 13
+STATE_TE = 14
+STATE_NOISE = 15
+STATE_ERROR_CNT = 16
+STATE_RAW_IDX = 17
+STATE_SIZE = 18
+
+
+@numba.njit(nogil=True)
+def reset_state(state):
+    """
+    Reset all values that are computed from multiple data words
+    """
+    for i in range(STATE_COL):
+        state[i] = 0
+
+
+@numba.njit(nogil=True)
+def has_open_sequence(state):
+    for i in range(STATE_TLU_FLAG + 1):
+        if state[i] != 0:
+            return True
+    return False
+
+
+@numba.njit(nogil=True)
+def _fill_hit(hit_data, hit_index, col, row, le, te, cnt, timestamp, raw_idx):
+    hit_data[hit_index]["col"] = col
+    hit_data[hit_index]["row"] = row
+    hit_data[hit_index]["le"] = le
+    hit_data[hit_index]["te"] = te
+    hit_data[hit_index]["cnt"] = cnt
+    hit_data[hit_index]["timestamp"] = timestamp
+    hit_data[hit_index]["scan_param_id"] = raw_idx
+
+
+@numba.njit(nogil=True)
+def interpret_raw_data(raw_data, state, hit_data, hit_index=0):
+    """
+    Interpret raw data words starting from the given state, which is updated. See RawDataInterpreter.interpret().
+    The state is kept in local variables while interpreting. Returns the new hit index.
+    """
+    monopix_data_flag = state[STATE_MONOPIX_FLAG]
+    rx_timestamp640_flag = state[STATE_RX_FLAG]
+    inj_timestamp640_flag = state[STATE_INJ_FLAG]
+    mon_timestamp640_flag = state[STATE_MON_FLAG]
+    tlu_timestamp640_flag = state[STATE_TLU_FLAG]
+    monopix_token_timestamp = state[STATE_MONOPIX_TOKEN_TIMESTAMP]
+    rx_timestamp640 = state[STATE_RX_TIMESTAMP640]
+    inj_timestamp640 = state[STATE_INJ_TIMESTAMP640]
+    mon_timestamp640 = state[STATE_MON_TIMESTAMP640]
+    mon_tot640 = np.int16(state[STATE_MON_TOT640])
+    tlu_timestamp640 = state[STATE_TLU_TIMESTAMP640]
+    col = state[STATE_COL]
+    row = state[STATE_ROW]
+    le = state[STATE_LE]
+    te = state[STATE_TE]
+    noise = state[STATE_NOISE]
+    error_cnt = state[STATE_ERROR_CNT]
+    raw_idx = np.uint32(state[STATE_RAW_IDX])
+
+    for raw_data_word in raw_data:
+        error = False
+
+        ################
+        # MONOPIX DATA #
+        ################
+        if is_monopix_data_1(raw_data_word):
+            if monopix_data_flag != 0:
+                error = True
+            else:
+                col = get_col(raw_data_word)
+                row = get_row(raw_data_word)
+                te = get_te(raw_data_word)
+                le = get_le(raw_data_word)
+                monopix_data_flag = 1
+
+        elif is_monopix_data_2(raw_data_word):
+            if monopix_data_flag != 1:
+                error = True
+            else:
+                noise = get_noise_flag(raw_data_word)
+                # Get right-most side of the token timestamp, shift it and add "0" on the right to turn it into a 640 MHz-like timestamp.
+                monopix_token_timestamp |= (get_token_TS_right(raw_data_word) << 2) & 0x7FFFFF0
+                monopix_data_flag = 2
+
+        elif is_monopix_data_3(raw_data_word):
+            if monopix_data_flag != 2:
+                error = True
+            else:
+                # Get left-most side of the token timestamp, shift it and merge it with the right-most one.
+                monopix_token_timestamp |= (get_token_TS_left(raw_data_word) << 27) & 0xFFFFFF8000000
+                _fill_hit(hit_data, hit_index, col, row, le, te, noise, monopix_token_timestamp, raw_idx)
+                hit_index += 1
+                monopix_data_flag = 0
+                monopix_token_timestamp = 0
+
+        ########################################
+        # TIMESTAMP 640 MHz (RX1), TAG: 0xFA   #
+        ########################################
+        # Third word comes first in data
+        elif is_timestamp640_rx_3(raw_data_word):
+            if rx_timestamp640_flag != 0:
+                error = True
+            else:
+                rx_timestamp640 |= (get_timestamp640_8bits(raw_data_word) << 48) & 0xFF000000000000
+                rx_timestamp640_flag = 1
+
+        elif is_timestamp640_rx_2(raw_data_word):
+            if rx_timestamp640_flag != 1:
+                error = True
+            else:
+                rx_timestamp640 |= (get_timestamp640_24bits(raw_data_word) << 24) & 0x00FFFFFF000000
+                rx_timestamp640_flag = 2
+
+        elif is_timestamp640_rx_1(raw_data_word):
+            if rx_timestamp640_flag != 2:
+                error = True
+            else:
+                rx_timestamp640 |= get_timestamp640_24bits(raw_data_word) & 0x00000000FFFFFF
+                _fill_hit(hit_data, hit_index, 0xFA, 0, 0, 0, 0, rx_timestamp640, raw_idx)
+                hit_index += 1
+                rx_timestamp640_flag = 0
+                rx_timestamp640 = 0
+
+        ########################################
+        # TIMESTAMP 640 MHz (INJ), TAG: 0xFC   #
+        ########################################
+        elif is_timestamp640_inj_3(raw_data_word):
+            if inj_timestamp640_flag != 0:
+                error = True
+            else:
+                inj_timestamp640 |= (get_timestamp640_8bits(raw_data_word) << 48) & 0xFF000000000000
+                inj_timestamp640_flag = 1
+
+        elif is_timestamp640_inj_2(raw_data_word):
+            if inj_timestamp640_flag != 1:
+                error = True
+            else:
+                inj_timestamp640 |= (get_timestamp640_24bits(raw_data_word) << 24) & 0x00FFFFFF000000
+                inj_timestamp640_flag = 2
+
+        elif is_timestamp640_inj_1(raw_data_word):
+            if inj_timestamp640_flag != 2:
+                error = True
+            else:
+                inj_timestamp640 |= get_timestamp640_24bits(raw_data_word) & 0x00000000FFFFFF
+                _fill_hit(hit_data, hit_index, 0xFC, 0, 0, 0, 0, inj_timestamp640, raw_idx)
+                hit_index += 1
+                inj_timestamp640_flag = 0
+                inj_timestamp640 = 0
+
+        ############################################
+        # TIMESTAMP 640 MHz (MON/HITOR), TAG: 0xFD #
+        ############################################
+        # Leading (row = 0) and trailing edge (row = 1) share one sequence.
+        elif is_timestamp640_mon_3(raw_data_word) or is_timestamp640_mon_3(raw_data_word, te=True):
+            if mon_timestamp640_flag != 0:
+                error = True
+            else:
+                mon_timestamp640 |= (get_timestamp640_8bits(raw_data_word) << 48) & 0xFF000000000000
+                mon_tot640 = np.int16(get_timestamp640_tot(raw_data_word) >> 8)
+                mon_timestamp640_flag = 1
+
+        elif is_timestamp640_mon_2(raw_data_word) or is_timestamp640_mon_2(raw_data_word, te=True):
+            if mon_timestamp640_flag != 1:
+                error = True
+            else:
+                mon_timestamp640 |= (get_timestamp640_24bits(raw_data_word) << 24) & 0x00FFFFFF000000
+                mon_timestamp640_flag = 2
+
+        elif is_timestamp640_mon_1(raw_data_word) or is_timestamp640_mon_1(raw_data_word, te=True):
+            if mon_timestamp640_flag != 2:
+                error = True
+            else:
+                mon_timestamp640 |= get_timestamp640_24bits(raw_data_word) & 0x00000000FFFFFF
+                _fill_hit(hit_data, hit_index, 0xFD, 1 if is_timestamp640_mon_1(raw_data_word, te=True) else 0, 0, 0,
+                          mon_tot640, mon_timestamp640, raw_idx)
+                hit_index += 1
+                mon_timestamp640_flag = 0
+                mon_timestamp640 = 0
+                mon_tot640 = 0
+
+        ########################################
+        # TIMESTAMP 640 MHz (TLU), TAG: 0xFB   #
+        ########################################
+        elif is_timestamp640_tlu_3(raw_data_word):
+            if tlu_timestamp640_flag != 0:
+                error = True
+            else:
+                tlu_timestamp640 |= (get_timestamp640_8bits(raw_data_word) << 48) & 0xFF000000000000
+                tlu_timestamp640_flag = 1
+
+        elif is_timestamp640_tlu_2(raw_data_word):
+            if tlu_timestamp640_flag != 1:
+                error = True
+            else:
+                tlu_timestamp640 |= (get_timestamp640_24bits(raw_data_word) << 24) & 0x00FFFFFF000000
+                tlu_timestamp640_flag = 2
+
+        elif is_timestamp640_tlu_1(raw_data_word):
+            if tlu_timestamp640_flag != 2:
+                error = True
+            else:
+                tlu_timestamp640 |= get_timestamp640_24bits(raw_data_word) & 0x00000000FFFFFF
+                _fill_hit(hit_data, hit_index, 0xFB, 0, 0, 0, 0, tlu_timestamp640, raw_idx)
+                hit_index += 1
+                tlu_timestamp640_flag = 0
+                tlu_timestamp640 = 0
+
+        ############
+        # TLU DATA #
+        ############
+        elif is_tlu(raw_data_word):
+            # Get the TLU timestamp, shift it and leave a 4-bit "0" on the right to turn it into a 640 MHz-like timestamp.
+            _fill_hit(hit_data, hit_index, 0xFF, 0, 0, 0, get_tlu_number(raw_data_word), get_tlu_timestamp(raw_data_word) >> 12, raw_idx)
+            hit_index += 1
+
+        if error:
+            # Reset all sequences, the word does not increase raw_idx
+            monopix_data_flag = rx_timestamp640_flag = inj_timestamp640_flag = mon_timestamp640_flag = tlu_timestamp640_flag = 0
+            monopix_token_timestamp = rx_timestamp640 = inj_timestamp640 = mon_timestamp640 = tlu_timestamp640 = 0
+            mon_tot640 = 0
+            error_cnt += 1
+        else:
+            # Increase raw_index and move to next data word.
+            raw_idx += np.uint32(1)
+
+    state[STATE_MONOPIX_FLAG] = monopix_data_flag
+    state[STATE_RX_FLAG] = rx_timestamp640_flag
+    state[STATE_INJ_FLAG] = inj_timestamp640_flag
+    state[STATE_MON_FLAG] = mon_timestamp640_flag
+    state[STATE_TLU_FLAG] = tlu_timestamp640_flag
+    state[STATE_MONOPIX_TOKEN_TIMESTAMP] = monopix_token_timestamp
+    state[STATE_RX_TIMESTAMP640] = rx_timestamp640
+    state[STATE_INJ_TIMESTAMP640] = inj_timestamp640
+    state[STATE_MON_TIMESTAMP640] = mon_timestamp640
+    state[STATE_MON_TOT640] = mon_tot640
+    state[STATE_TLU_TIMESTAMP640] = tlu_timestamp640
+    state[STATE_COL] = col
+    state[STATE_ROW] = row
+    state[STATE_LE] = le
+    state[STATE_TE] = te
+    state[STATE_NOISE] = noise
+    state[STATE_ERROR_CNT] = error_cnt
+    state[STATE_RAW_IDX] = raw_idx
+    return hit_index
+
+
+@numba.njit(nogil=True)
+def interpret_until_synchronized(raw_data, state, hit_data, hit_index, other_state):
+    """
+    Interpret raw data words with two states in lockstep, until both have no open sequence after the same word.
+    From there on the interpretation does not depend on the state anymore (except for error count and raw_idx).
+    Hits are only written for the first state.
+
+    Returns the number of words interpreted, the new hit index and the number of hits of the second state.
+    """
+    other_hit = np.zeros(1, dtype=hit_data.dtype)
+    n_other_hits = 0
+    for i in range(raw_data.shape[0]):
+        hit_index = interpret_raw_data(raw_data[i:i + 1], state, hit_data, hit_index)
+        n_other_hits += interpret_raw_data(raw_data[i:i + 1], other_state, other_hit, 0)
+        if not has_open_sequence(state) and not has_open_sequence(other_state):
+            return i + 1, hit_index, n_other_hits
+    return raw_data.shape[0], hit_index, n_other_hits
+
+
+@numba.njit(nogil=True)
+def shift_raw_idx(hit_data, offset):
+    """
+    Add an offset to the raw data index (uint32) in the scan_param_id column.
+    """
+    if offset == 0:
+        return
+    for i in range(hit_data.shape[0]):
+        hit_data[i]["scan_param_id"] = ((np.int64(hit_data[i]["scan_param_id"]) & 0xFFFFFFFF) + offset) & 0xFFFFFFFF
+
+
+@numba.njit(nogil=True)
+def assign_scan_param_id(hit_data, meta_data, meta_idx):
+    """
+    Replace the raw data index in the scan_param_id column by the scan parameter of the readout containing the word.
+    Returns the meta data index of the last hit.
+    """
+    for scan_idx, param_id in enumerate(hit_data["scan_param_id"]):
+        while meta_idx < len(meta_data):
+            if param_id >= meta_data[meta_idx]['index_start'] and param_id < meta_data[meta_idx]['index_stop']:
+                hit_data[scan_idx]['scan_param_id'] = meta_data[meta_idx]['scan_param_id']
+                break
+            elif param_id >= meta_data[meta_idx]['index_stop']:
+                meta_idx += 1
+    return meta_idx
+
+
 class Interpreter(object):
-    def __init(self):
-        self.reset()
+    """
+    Interprets a complete raw data array at once, see RawDataInterpreter.interpret().
+    """
+    hit_dtype = [('col', '<u1'), ('row', '<u2'), ('le', '<u1'), ('te', '<u1'), ('cnt', '<u8'), ('timestamp', '<u8'), ('scan_param_id', '<u4')]
+
+    def __init__(self):
+        self.error_cnt = 0
 
     def interpret_data(self, raw_data, meta_data=None, chunk_size=1000000):
-        hit_dtype = [('col', '<u1'), ('row', '<u2'), ('le', '<u1'), ('te', '<u1'), ('cnt', '<u8'), ('timestamp', '<u8'), ('scan_param_id', '<u4')]
+        """
+        Interpret raw data chunk by chunk into one hit array.
+
+        The hits of every chunk are written directly into the result array, which is allocated once
+        (for about one hit per three words) and only grows (doubling its size) for data with more hits.
 
-        n_words=len(raw_data)
-        start = 0
+        Returns
+        -------
+        hit_data, error_cnt
+        """
+        n_words = len(raw_data)
         data_interpreter = RawDataInterpreter()
+        # A chunk never gives more hits than words
+        hit_data = np.zeros(min(n_words, n_words // 3 + chunk_size), dtype=self.hit_dtype)
+        hit_index = 0
         pbar = tqdm(total=n_words)
-        hit_data=np.array([], dtype=hit_dtype)
-        if len(raw_data)==0:
-            hit_data=np.array([], dtype=hit_dtype)
-        while start < n_words:
-            tmp_end = min(n_words, start + chunk_size)
-            raw_data_chunk = raw_data[start:tmp_end]
-            hit_buffer = np.zeros(shape=chunk_size, dtype=hit_dtype)
-
-            hit_data_chunk = data_interpreter.interpret(raw_data_chunk, meta_data, hit_buffer)
-
-            hit_data=np.concatenate((hit_data,hit_data_chunk))
+        for start in range(0, n_words, chunk_size):
+            raw_data_chunk = raw_data[start:start + chunk_size]
+            if hit_index + raw_data_chunk.shape[0] > hit_data.shape[0]:
+                hit_data = self._grow(hit_data, hit_index, min(n_words, max(2 * hit_data.shape[0], hit_index + raw_data_chunk.shape[0])))
+            hit_data_chunk = data_interpreter.interpret(raw_data_chunk, meta_data, hit_data[hit_index:hit_index + raw_data_chunk.shape[0]])
+            hit_index += hit_data_chunk.shape[0]
+            pbar.update(raw_data_chunk.shape[0])
+        pbar.close()
 
-            pbar.update(tmp_end - start)
+        self.error_cnt = data_interpreter.get_error_count()
+        if hit_data.shape[0] > 2 * hit_index:  # do not keep a mostly unused array alive
+            return hit_data[:hit_index].copy(), self.error_cnt
+        return hit_data[:hit_index], self.error_cnt
 
-            start = tmp_end
+    def iter_interpret_data(self, raw_data, meta_data=None, chunk_size=1000000):
+        """
+        Interpret raw data chunk by chunk and yield the hits of every chunk.
 
-        pbar.close()
+        The yielded hit arrays are views into one buffer, which is reused for the next chunk; copy them to keep them.
+        The error count is available in self.error_cnt during and after the iteration.
+        """
+        data_interpreter = RawDataInterpreter()
+        hit_buffer = np.zeros(min(len(raw_data), chunk_size), dtype=self.hit_dtype)
+        self.error_cnt = 0
+        for start in range(0, len(raw_data), chunk_size):
+            hit_data_chunk = data_interpreter.interpret(raw_data[start:start + chunk_size], meta_data, hit_buffer)
+            self.error_cnt = data_interpreter.get_error_count()
+            yield hit_data_chunk
 
-        return hit_data, data_interpreter.get_error_count()
+    @staticmethod
+    def _grow(hit_data, n_hits, size):
+        new_hit_data = np.zeros(size, dtype=hit_data.dtype)
+        new_hit_data[:n_hits] = hit_data[:n_hits]
+        return new_hit_data
 
 @numba.experimental.jitclass(class_spec)
 class RawDataInterpreter(object):
@@ -272,8 +620,53 @@ class RawDataInterpreter(object):
     def get_error_count(self):
         return self.error_cnt
 
+    def get_state(self):
+        """
+        Copy of the interpreter state for the interpretation kernel (see STATE_*)
+        """
+        state = np.zeros(STATE_SIZE, dtype=np.int64)
+        state[STATE_MONOPIX_FLAG] = self.monopix_data_flag
+        state[STATE_RX_FLAG] = self.rx_timestamp640_flag
+        state[STATE_INJ_FLAG] = self.inj_timestamp640_flag
+        state[STATE_MON_FLAG] = self.mon_timestamp640_flag
+        state[STATE_TLU_FLAG] = self.tlu_timestamp640_flag
+        state[STATE_MONOPIX_TOKEN_TIMESTAMP] = self.monopix_token_timestamp
+        state[STATE_RX_TIMESTAMP640] = self.rx_timestamp640
+        state[STATE_INJ_TIMESTAMP640] = self.inj_timestamp640
+        state[STATE_MON_TIMESTAMP640] = self.mon_timestamp640
+        state[STATE_MON_TOT640] = self.mon_tot640
+        state[STATE_TLU_TIMESTAMP640] = self.tlu_timestamp640
+        state[STATE_COL] = self.col
+        state[STATE_ROW] = self.row
+        state[STATE_LE] = self.le
+        state[STATE_TE] = self.te
+        state[STATE_NOISE] = self.noise
+        state[STATE_ERROR_CNT] = self.error_cnt
+        state[STATE_RAW_IDX] = self.raw_idx
+        return state
+
+    def set_state(self, state):
+        self.monopix_data_flag = state[STATE_MONOPIX_FLAG]
+        self.rx_timestamp640_flag = state[STATE_RX_FLAG]
+        self.inj_timestamp640_flag = state[STATE_INJ_FLAG]
+        self.mon_timestamp640_flag = state[STATE_MON_FLAG]
+        self.tlu_timestamp640_flag = state[STATE_TLU_FLAG]
+        self.monopix_token_timestamp = state[STATE_MONOPIX_TOKEN_TIMESTAMP]
+        self.rx_timestamp640 = state[STATE_RX_TIMESTAMP640]
+        self.inj_timestamp640 = state[STATE_INJ_TIMESTAMP640]
+        self.mon_timestamp640 = state[STATE_MON_TIMESTAMP640]
+        self.mon_tot640 = state[STATE_MON_TOT640]
+        self.tlu_timestamp640 = state[STATE_TLU_TIMESTAMP640]
+        self.col = state[STATE_COL]
+        self.row = state[STATE_ROW]
+        self.le = state[STATE_LE]
+        self.te = state[STATE_TE]
+        self.noise = state[STATE_NOISE]
+        self.error_cnt = state[STATE_ERROR_CNT]
+        self.raw_idx = state[STATE_RAW_IDX]
+
     def interpret(self, raw_data, meta_data, hit_data):
-        """ 
+        """
         This function interprets data recorded by the LF-Monopix2 data acquisition system (LF2 + GPAC + MIO3 cards).
 
         The raw data words contain at least the LF-Monopix2 hit information and token timestamps (in 40 MHz), but they can also correspond to several timestamps 
@@ -306,336 +699,443 @@ class RawDataInterpreter(object):
                             ('cnt', '<u8'), ('timestamp', '<u8'), ('scan_param_id', '<u4')])
         """
 
-        hit_index = 0
-
-        for raw_data_word in raw_data:
-
-            ################
-            # MONOPIX DATA #
-            ################
-
-            if is_monopix_data_1(raw_data_word):
-                if self.monopix_data_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                # Asssign pixel data
-                self.col = get_col(raw_data_word)
-                self.row = get_row(raw_data_word)
-                self.te = get_te(raw_data_word)
-                self.le = get_le(raw_data_word)
-
-                self.monopix_data_flag = 1
-
-            elif is_monopix_data_2(raw_data_word):
-                if self.monopix_data_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-                
-                # Get noise
-                self.noise = get_noise_flag(raw_data_word)
-                # Get right-most side of the token timestamp, shift it and add "0" on the right to turn it into a 640 MHz-like timestamp.
-                self.monopix_token_timestamp = self.monopix_token_timestamp | ( (get_token_TS_right(raw_data_word) << 2) & 0x7FFFFF0 )
-                
-                self.monopix_data_flag = 2
-
-            elif is_monopix_data_3(raw_data_word):
-                if self.monopix_data_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                # Get left-most side of the token timestamp, shift it and merge it with the right-most one.
-                self.monopix_token_timestamp = self.monopix_token_timestamp | ( (get_token_TS_left(raw_data_word) << 27) & 0xFFFFFF8000000 )
-                
-                # Fill the information for the 
-                hit_data[hit_index]["row"] = self.row
-                hit_data[hit_index]["col"] = self.col
-                hit_data[hit_index]["le"] = self.le
-                hit_data[hit_index]["te"] = self.te
-                hit_data[hit_index]["cnt"] = self.noise
-                hit_data[hit_index]["timestamp"] = self.monopix_token_timestamp
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
-                
-                # Prepare for next hit: Increase hit index and reset monopix_data_flag
-                hit_index += 1
-                self.monopix_data_flag = 0
-                self.monopix_token_timestamp = 0
-
-            ########################################
-            # TIMESTAMP 640 MHz (RX1), TAG: 0xFA   #
-            ########################################
-
-            # Third word comes first in data
-
-            elif is_timestamp640_rx_3(raw_data_word):
-                if self.rx_timestamp640_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.rx_timestamp640 = self.rx_timestamp640 | ( (get_timestamp640_8bits(raw_data_word) <<48) & 0xFF000000000000 )
-                
-                self.rx_timestamp640_flag = 1
-
-            elif is_timestamp640_rx_2(raw_data_word):
-                if self.rx_timestamp640_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.rx_timestamp640 = self.rx_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) <<24) & 0x00FFFFFF000000 )
-
-                self.rx_timestamp640_flag = 2
-
-            elif is_timestamp640_rx_1(raw_data_word):
-                if self.rx_timestamp640_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.rx_timestamp640 = self.rx_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) ) & 0x00000000FFFFFF )
-
-                hit_data[hit_index]["col"] = 0xFA
-                hit_data[hit_index]["row"] = 0
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = 0
-                hit_data[hit_index]["timestamp"] = self.rx_timestamp640
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
+        state = self.get_state()
+        hit_index = interpret_raw_data(raw_data, state, hit_data)
+        self.set_state(state)
 
-                # Prepare for next data block. Increase hit index and reset rx_timestamp640 flag.
-                hit_index += 1
-                self.rx_timestamp640_flag = 0
-                self.rx_timestamp640 = 0
-
-            ########################################
-            # TIMESTAMP 640 MHz (INJ), TAG: 0xFC   #
-            ########################################
-
-            # Third word comes first in data
-
-            elif is_timestamp640_inj_3(raw_data_word):
-                if self.inj_timestamp640_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.inj_timestamp640 = self.inj_timestamp640 | ( (get_timestamp640_8bits(raw_data_word) <<48) & 0xFF000000000000 )
-                
-                self.inj_timestamp640_flag = 1
-
-            elif is_timestamp640_inj_2(raw_data_word):
-                if self.inj_timestamp640_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.inj_timestamp640 = self.inj_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) <<24) & 0x00FFFFFF000000 )
-
-                self.inj_timestamp640_flag = 2
-
-            elif is_timestamp640_inj_1(raw_data_word):
-                if self.inj_timestamp640_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.inj_timestamp640 = self.inj_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) ) & 0x00000000FFFFFF )
-
-                hit_data[hit_index]["col"] = 0xFC
-                hit_data[hit_index]["row"] = 0
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = 0
-                hit_data[hit_index]["timestamp"] = self.inj_timestamp640
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
-
-                # Prepare for next data block. Increase hit index and reset inj_timestamp640 flag.
-                hit_index += 1
-                self.inj_timestamp640_flag = 0
-                self.inj_timestamp640 = 0
-
-            ############################################
-            # TIMESTAMP 640 MHz (MON/HITOR), TAG: 0xFD #
-            ############################################
-
-            # Third word comes first in data 
+        # Trim hit_data buffer to interpreted data hits
+        hit_data = hit_data[:hit_index]
 
-            # Get Timestamp of the Monitor Leading Edge.
+        # Find correct scan_param_id in meta data and attach to hit.
+        if meta_data is not None:
+            self.meta_idx = assign_scan_param_id(hit_data, meta_data, self.meta_idx)
+        return hit_data
 
-            elif is_timestamp640_mon_3(raw_data_word):
-                if self.mon_timestamp640_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
 
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_8bits(raw_data_word) <<48) & 0xFF000000000000 )
-                self.mon_tot640 = ( get_timestamp640_tot(raw_data_word) ) >> 8
+class ParallelRawDataInterpreter(object):
+    """
+    Multi-threaded version of RawDataInterpreter with the same interface and the same output,
+    including error count, raw data index and scan parameter assignment.
 
-                self.mon_timestamp640_flag = 1
+    The raw data of one call is split into n_threads parts, which are interpreted at the same time (the kernel runs
+    without the GIL), each starting without open sequences. The parts are then stitched in order: if the previous part
+    ends with open sequences, the beginning of the part is interpreted again from the real state until it agrees with
+    the speculative interpretation, which usually takes a few words. The hits of this beginning are replaced and the
+    raw data indices of the remaining hits are shifted by the difference in errors.
+    Calls with few words are interpreted in one part, so use chunks of n_threads times the usual chunk size.
+    """
 
-            elif is_timestamp640_mon_2(raw_data_word):
-                if self.mon_timestamp640_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
+    def __init__(self, n_threads=None, min_part_size=65536):
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.min_part_size = min_part_size
+        self.state = np.zeros(STATE_SIZE, dtype=np.int64)
+        self.meta_idx = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix='Interpreter')
 
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) <<24) & 0x00FFFFFF000000 )
+    def reset(self):
+        """
+        Reset all values that are computed from multiple data words
+        """
+        reset_state(self.state)
 
-                self.mon_timestamp640_flag = 2
+    def get_error_count(self):
+        return int(self.state[STATE_ERROR_CNT])
 
-            elif is_timestamp640_mon_1(raw_data_word):
-                if self.mon_timestamp640_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
+    def close(self):
+        self._pool.shutdown()
 
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) ) & 0x00000000FFFFFF )
+    def __enter__(self):
+        return self
 
-                hit_data[hit_index]["col"] = 0xFD
-                hit_data[hit_index]["row"] = 0
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = self.mon_tot640
-                hit_data[hit_index]["timestamp"] = self.mon_timestamp640
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
+    def __exit__(self, *exc_info):
+        self.close()
 
-                # Prepare for next data block. Increase hit index and reset mon_timestamp640 flag.
-                hit_index += 1
-                self.mon_timestamp640_flag = 0
-                self.mon_timestamp640 = 0
-                self.mon_tot640 = 0
-            
-            # Get Timestamp of the Monitor Trailing Edge.
-
-            elif is_timestamp640_mon_3(raw_data_word, te=True):
-                if self.mon_timestamp640_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_8bits(raw_data_word) <<48) & 0xFF000000000000 )
-                self.mon_tot640 = ( get_timestamp640_tot(raw_data_word) ) >> 8
-
-                self.mon_timestamp640_flag = 1
-
-            elif is_timestamp640_mon_2(raw_data_word, te=True):
-                if self.mon_timestamp640_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) <<24) & 0x00FFFFFF000000 )
-
-                self.mon_timestamp640_flag = 2
-
-            elif is_timestamp640_mon_1(raw_data_word, te=True):
-                if self.mon_timestamp640_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
-
-                self.mon_timestamp640 = self.mon_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) ) & 0x00000000FFFFFF )
-
-                hit_data[hit_index]["col"] = 0xFD
-                hit_data[hit_index]["row"] = 1
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = self.mon_tot640
-                hit_data[hit_index]["timestamp"] = self.mon_timestamp640
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
-
-                # Prepare for next data block. Increase hit index and reset mon_timestamp640 flag.
-                hit_index += 1
-                self.mon_timestamp640_flag = 0
-                self.mon_timestamp640 = 0
-                self.mon_tot640 = 0
+    def interpret(self, raw_data, meta_data, hit_data):
+        """
+        Interpret raw data, see RawDataInterpreter.interpret().
 
-            ########################################
-            # TIMESTAMP 640 MHz (TLU), TAG: 0xFB   #
-            ########################################
+        Parameters:
+        -----------
+        raw_data : np.array
+            Array with raw data words.
+        meta_data : np.array
+            Array with meta information (scan_param_id, data length, ...)
+        hit_data :
+            Array prepared to be filled with interpreted data, at least as long as raw_data.
+        """
+        raw_data = np.ascontiguousarray(raw_data, dtype=np.uint32)
+        n_parts = int(max(1, min(self.n_threads, raw_data.shape[0] // max(self.min_part_size, 1))))
+        bounds = np.linspace(0, raw_data.shape[0], n_parts + 1).astype(np.int64)
+
+        def interpret_part(i):
+            # Only the first part starts from the real state
+            state = self.state.copy() if i == 0 else np.zeros(STATE_SIZE, dtype=np.int64)
+            n_hits = interpret_raw_data(raw_data[bounds[i]:bounds[i + 1]], state, hit_data[bounds[i]:bounds[i + 1]])
+            return state, n_hits
+
+        if n_parts == 1:
+            parts = [interpret_part(0)]
+        else:
+            parts = list(self._pool.map(interpret_part, range(n_parts)))
+
+        # Stitch the parts in order and move their hits to the beginning of hit_data
+        self.state[:], n_hits = parts[0]
+        for i, (part_state, n_part_hits) in enumerate(parts[1:], start=1):
+            part_raw_data = raw_data[bounds[i]:bounds[i + 1]]
+            n_words, n_spec_hits, spec_state = 0, 0, np.zeros(STATE_SIZE, dtype=np.int64)
+            hits = None
+            if has_open_sequence(self.state):
+                stitch_hits = np.zeros(min(part_raw_data.shape[0], 64), dtype=hit_data.dtype)
+                n_stitch_hits = 0
+                while n_words < part_raw_data.shape[0]:
+                    if stitch_hits.shape[0] - n_stitch_hits < stitch_hits.shape[0] // 2:
+                        stitch_hits = np.concatenate((stitch_hits, np.zeros_like(stitch_hits)))
+                    n, n_stitch_hits, n_other_hits = interpret_until_synchronized(part_raw_data[n_words:n_words + stitch_hits.shape[0] - n_stitch_hits],
+                                                                                  self.state, stitch_hits, n_stitch_hits, spec_state)
+                    n_words += n
+                    n_spec_hits += n_other_hits
+                    if not has_open_sequence(self.state) and not has_open_sequence(spec_state):
+                        break
+                hits = hit_data[bounds[i] + n_spec_hits:bounds[i] + n_part_hits]
+                if n_hits + n_stitch_hits > bounds[i] + n_spec_hits:  # would overwrite the remaining hits of the part
+                    hits = hits.copy()
+                hit_data[n_hits:n_hits + n_stitch_hits] = stitch_hits[:n_stitch_hits]
+                n_hits += n_stitch_hits
+            if n_words == part_raw_data.shape[0]:  # part did not synchronize, state is complete
+                continue
+
+            # Speculative hits after the synchronization. The raw data index of the part started at 0 and
+            # contains the errors of the replaced beginning.
+            if hits is None:
+                hits = hit_data[bounds[i]:bounds[i] + n_part_hits]
+            if n_hits != bounds[i] + n_spec_hits:
+                hit_data[n_hits:n_hits + hits.shape[0]] = hits
+                hits = hit_data[n_hits:n_hits + hits.shape[0]]
+            shift_raw_idx(hits, self.state[STATE_RAW_IDX] - spec_state[STATE_RAW_IDX])
+            n_hits += hits.shape[0]
+
+            error_cnt = self.state[STATE_ERROR_CNT] + part_state[STATE_ERROR_CNT] - spec_state[STATE_ERROR_CNT]
+            raw_idx = (self.state[STATE_RAW_IDX] + part_state[STATE_RAW_IDX] - spec_state[STATE_RAW_IDX]) & 0xFFFFFFFF
+            self.state[:] = part_state
+            self.state[STATE_ERROR_CNT] = error_cnt
+            self.state[STATE_RAW_IDX] = raw_idx
+        hit_data = hit_data[:n_hits]
 
-            # Third word comes first in data
+        # Find correct scan_param_id in meta data and attach to hit.
+        if meta_data is not None:
+            self.meta_idx = assign_scan_param_id(hit_data, meta_data, self.meta_idx)
+        return hit_data
 
-            elif is_timestamp640_tlu_3(raw_data_word):
-                if self.tlu_timestamp640_flag != 0:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
 
-                self.tlu_timestamp640 = self.tlu_timestamp640 | ( (get_timestamp640_8bits(raw_data_word) <<48) & 0xFF000000000000 )
-                
-                self.tlu_timestamp640_flag = 1
+"""
+Word classification for the vectorized interpreter, indexed by the upper 8 bits of a word:
+    - Stream of the word. 0: Monopix data, 1: RX1, 2: INJ, 3: MON and 4: TLU timestamps in 640 MHz,
+      5: TLU word, 6: unknown word.
+    - Position of the word within its 3-word sequence (Monopix data 1->2->3, timestamps 3->2->1).
+"""
+N_SEQ_STREAMS = 5
+STREAM_TLU = 5
+STREAM_UNKNOWN = 6
+TIMESTAMP640_TAGS = {1: 0xFA, 2: 0xFC, 3: 0xFD, 4: 0xFB}
+
+WORD_STREAM = np.full(256, STREAM_UNKNOWN, dtype=np.uint8)
+WORD_STEP = np.zeros(256, dtype=np.uint8)
+for _header, _step in ((0x00, 0), (0x08, 1), (0x0A, 2)):
+    _n = 8 if _step == 0 else 2
+    WORD_STREAM[_header:_header + _n] = 0
+    WORD_STEP[_header:_header + _n] = _step
+for _stream, _header in ((1, 0x40), (2, 0x50), (3, 0x60), (4, 0x70)):
+    for _step, _id in enumerate((3, 2, 1)):
+        WORD_STREAM[_header + _id] = _stream
+        WORD_STEP[_header + _id] = _step
+for _step, _id in enumerate((7, 6, 5)):  # Monitor trailing edge, shares the sequence with the leading edge
+    WORD_STREAM[0x60 + _id] = 3
+    WORD_STEP[0x60 + _id] = _step
+WORD_STREAM[0x80:] = STREAM_TLU
+
+
+class VectorizedRawDataInterpreter(object):
+    """
+    Array-at-a-time version of RawDataInterpreter with the same interface and the same output,
+    including error count, raw data index and scan parameter assignment.
+
+    All words of a block are classified by their header at once and split into one list per stream.
+    Without sequence errors the position of a word within its 3-word sequence only depends on its index in the stream list,
+    so for every stream the possible sequence errors are precomputed for the three possible sequence starts. The actual errors
+    are then found by jumping from one error to the next (every error resets all sequences, as in RawDataInterpreter) and
+    the hits are assembled in bulk. Incomplete sequences are kept as raw words and continued in the next block.
+
+    Data with many sequence errors is slower than with RawDataInterpreter, since every error is one step in python.
+    Meta data is assigned with a binary search on index_stop, which expects increasing meta data indices as written by ScanBase.
+    """
+
+    def __init__(self, block_size=1048576):
+        self.block_size = block_size
+        self.error_cnt = 0
+        self.raw_idx = 0
+        self.meta_idx = 0
+        self._phase = np.zeros(0, dtype=np.uint8)
+        self.reset()
 
-            elif is_timestamp640_tlu_2(raw_data_word):
-                if self.tlu_timestamp640_flag != 1:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
+    def reset(self):
+        """
+        Discard all incomplete word sequences
+        """
+        self.pending = [np.zeros(0, dtype=np.uint32) for _ in range(N_SEQ_STREAMS)]
 
-                self.tlu_timestamp640 = self.tlu_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) <<24) & 0x00FFFFFF000000 )
+    def get_error_count(self):
+        return self.error_cnt
 
-                self.tlu_timestamp640_flag = 2
+    def interpret(self, raw_data, meta_data, hit_data):
+        """
+        Interpret raw data, see RawDataInterpreter.interpret().
 
-            elif is_timestamp640_tlu_1(raw_data_word):
-                if self.tlu_timestamp640_flag != 2:
-                    self.reset()
-                    self.error_cnt += 1
-                    continue
+        Parameters:
+        -----------
+        raw_data : np.array
+            Array with raw data words.
+        meta_data : np.array
+            Array with meta information (scan_param_id, data length, ...)
+        hit_data :
+            Array prepared to be filled with interpreted data, at least as long as raw_data.
+        """
+        raw_data = np.ascontiguousarray(raw_data, dtype=np.uint32)
+        hit_index = 0
+        for start in range(0, raw_data.shape[0], self.block_size):
+            hit_index = self._interpret_block(raw_data[start:start + self.block_size], hit_data, hit_index)
+        hit_data = hit_data[:hit_index]
 
-                self.tlu_timestamp640 = self.tlu_timestamp640 | ( (get_timestamp640_24bits(raw_data_word) ) & 0x00000000FFFFFF )
+        # Find correct scan_param_id in meta data and attach to hit.
+        if meta_data is not None and hit_index > 0 and self.meta_idx < meta_data.shape[0]:
+            param_id = hit_data["scan_param_id"].astype(np.int64)
+            meta_idx = self.meta_idx + np.searchsorted(meta_data["index_stop"][self.meta_idx:].astype(np.int64), param_id, side="right")
+            sel = meta_idx < meta_data.shape[0]
+            sel[sel] = param_id[sel] >= meta_data["index_start"][meta_idx[sel]]
+            hit_data["scan_param_id"][sel] = meta_data["scan_param_id"][meta_idx[sel]]
+            self.meta_idx = meta_idx[-1]
+        return hit_data
 
-                hit_data[hit_index]["col"] = 0xFB
-                hit_data[hit_index]["row"] = 0
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = 0
-                hit_data[hit_index]["timestamp"] = self.tlu_timestamp640
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
+    def _interpret_block(self, words, hit_data, hit_index):
+        n_words = words.shape[0]
+        header = words >> 24
+        stream = WORD_STREAM[header]
+        step = WORD_STEP[header]
+
+        # Word lists per stream, starting with the words of incomplete sequences from the previous block (at position -1)
+        stream_pos, stream_words, stream_bad = [], [], []
+        for s in range(N_SEQ_STREAMS):
+            idx = np.flatnonzero(stream == s)
+            n_pending = self.pending[s].shape[0]
+            pos = np.concatenate((np.full(n_pending, -1, dtype=np.int64), idx))
+            steps = np.concatenate((np.arange(n_pending, dtype=np.uint8), step[idx]))
+            phase = self._get_phase(pos.shape[0] + 2)
+            stream_pos.append(pos)
+            stream_words.append(np.concatenate((self.pending[s], words[idx])))
+            # Index of words with wrong position, if the sequence started at an index i with i % 3 == r
+            stream_bad.append([np.flatnonzero(steps != phase[(3 - r) % 3:(3 - r) % 3 + pos.shape[0]]) for r in range(3)])
+
+        # Find sequence errors. After every error all sequences start again with the next word.
+        errors = []
+        seq_start = [0] * N_SEQ_STREAMS
+        while True:
+            error_pos = n_words
+            for s in range(N_SEQ_STREAMS):
+                bad = stream_bad[s][seq_start[s] % 3]
+                i = np.searchsorted(bad, seq_start[s])
+                if i < bad.shape[0]:
+                    error_pos = min(error_pos, stream_pos[s][bad[i]])
+            if error_pos == n_words:
+                break
+            errors.append(error_pos)
+            for s in range(N_SEQ_STREAMS):
+                seq_start[s] = np.searchsorted(stream_pos[s], error_pos, side="right")
+        errors = np.array(errors, dtype=np.int64)
+
+        # Assemble complete sequences. Erroneous words are skipped and do not increase raw_idx.
+        is_hit = np.zeros(n_words, dtype=np.bool_)
+        hits = []
+        for s in range(N_SEQ_STREAMS):
+            pos, seq = stream_pos[s], stream_words[s]
+            if errors.shape[0] == 0:
+                n_err = np.zeros_like(pos)
+                last = np.arange(2, pos.shape[0], 3)
+            else:
+                n_err = np.searchsorted(errors, pos, side="left")
+                valid = np.searchsorted(errors, pos, side="right") == n_err
+                pos, n_err, seq = pos[valid], n_err[valid], seq[valid]
+                seq_idx = np.arange(pos.shape[0]) - np.searchsorted(n_err, n_err, side="left")
+                last = np.flatnonzero(seq_idx % 3 == 2)
+            tail = seq[np.searchsorted(n_err, errors.shape[0], side="left"):]
+            self.pending[s] = tail[tail.shape[0] - tail.shape[0] % 3:].copy()
+            if last.shape[0] == 0:
+                continue
+            is_hit[pos[last]] = True
+            hits.append((s, pos[last], n_err[last], seq[last - 2], seq[last - 1], seq[last]))
+        tlu_pos = np.flatnonzero(stream == STREAM_TLU)
+        is_hit[tlu_pos] = True
+
+        hit_rank = np.cumsum(is_hit) - 1 + hit_index
+        for s, pos, n_err, w_1, w_2, w_3 in hits:
+            out = hit_rank[pos]
+            if s == 0:
+                hit_data["col"][out] = (w_1 >> 21) & 0x3F
+                hit_data["row"][out] = w_1 & 0x1FF
+                hit_data["le"][out] = (w_1 >> 15) & 0x3F
+                hit_data["te"][out] = (w_1 >> 9) & 0x3F
+                hit_data["cnt"][out] = w_2 & 0x3
+                hit_data["timestamp"][out] = ((w_2 & 0x1FFFFFC) << 2) | ((w_3 & 0x1FFFFFF).astype(np.uint64) << np.uint64(27))
+            else:
+                # Third word comes first in data
+                hit_data["col"][out] = TIMESTAMP640_TAGS[s]
+                if s == 3:
+                    hit_data["row"][out] = (w_3 >> 24) == 0x65  # Trailing edge
+                    # ToT is stored as int16 in RawDataInterpreter
+                    hit_data["cnt"][out] = ((w_1 & 0xFFFF00) >> 8).astype(np.int16).astype(hit_data.dtype["cnt"])
+                else:
+                    hit_data["row"][out] = 0
+                    hit_data["cnt"][out] = 0
+                hit_data["le"][out] = 0
+                hit_data["te"][out] = 0
+                hit_data["timestamp"][out] = ((w_1 & 0xFF).astype(np.uint64) << np.uint64(48)) | ((w_2 & 0xFFFFFF).astype(np.uint64) << np.uint64(24)) | (w_3 & 0xFFFFFF)
+            hit_data["scan_param_id"][out] = self._get_raw_idx(pos - n_err).astype(hit_data.dtype["scan_param_id"])
+
+        if tlu_pos.shape[0] > 0:
+            out = hit_rank[tlu_pos]
+            tlu_words = words[tlu_pos]
+            hit_data["col"][out] = 0xFF
+            hit_data["row"][out] = 0
+            hit_data["le"][out] = 0
+            hit_data["te"][out] = 0
+            hit_data["cnt"][out] = tlu_words & 0xFFFF
+            hit_data["timestamp"][out] = (tlu_words & 0x7FFF0000) >> 12
+            hit_data["scan_param_id"][out] = self._get_raw_idx(tlu_pos - np.searchsorted(errors, tlu_pos)).astype(hit_data.dtype["scan_param_id"])
+
+        self.error_cnt += errors.shape[0]
+        self.raw_idx += n_words - errors.shape[0]
+        return hit_index + int(np.count_nonzero(is_hit))
+
+    def _get_phase(self, n):
+        # 0, 1, 2, 0, 1, 2, ... (at least n entries)
+        if self._phase.shape[0] < n:
+            self._phase = np.tile(np.arange(3, dtype=np.uint8), n // 3 + 1)
+        return self._phase
+
+    def _get_raw_idx(self, offset):
+        # raw_idx is an uint32 in RawDataInterpreter
+        return ((self.raw_idx + offset) & 0xFFFFFFFF).astype(np.uint32)
+
+
+@numba.njit(nogil=True)
+def fill_occupancy(hit_data, occupancy, max_cnt):
+    """
+    Add the pixel hits (cnt < max_cnt, inside of the matrix) to the occupancy map.
+    """
+    n_cols, n_rows = occupancy.shape
+    for i in range(hit_data.shape[0]):
+        col = hit_data[i]["col"]
+        row = hit_data[i]["row"]
+        if hit_data[i]["cnt"] < max_cnt and col < n_cols and row < n_rows:
+            occupancy[col, row] += 1
+
+
+class OccupancyAccumulator(object):
+    """
+    Interprets raw data chunk by chunk as it is read out and adds the hits to an occupancy map.
+
+    The interpreter state is kept between the chunks, so word sequences split across two FIFO reads are not lost.
+    Only the occupancy is kept, the raw data and the hits are discarded after every chunk.
+    """
+    def __init__(self, shape=(56, 340), max_cnt=2):
+        """
+        Parameters:
+        -----------
+        shape : tuple
+            Shape of the occupancy map (columns, rows).
+        max_cnt : int
+            Hits with a cnt value of max_cnt or larger (e.g. TLU words and timestamps) are not counted.
+        """
+        self.max_cnt = max_cnt
+        self.occupancy = np.zeros(shape, dtype=np.uint32)
+        self.n_words = 0
+        self._interpreter = RawDataInterpreter()
+        self._hit_buffer = np.zeros(0, dtype=hit_dtype)
 
-                # Prepare for next data block. Increase hit index and reset tlu_timestamp640 flag.
-                hit_index += 1
-                self.tlu_timestamp640_flag = 0
-                self.tlu_timestamp640 = 0
-                
-            ############
-            # TLU DATA #
-            ############
-
-            elif is_tlu(raw_data_word):
-                tlu_word = get_tlu_number(raw_data_word)
-                # Get the TLU timestamp, shift it and leave a 4-bit "0" on the right to turn it into a 640 MHz-like timestamp.
-                tlu_timestamp_low_res = get_tlu_timestamp(raw_data_word) >> 12
-
-                hit_data[hit_index]["col"] = 0xFF
-                hit_data[hit_index]["row"] = 0
-                hit_data[hit_index]["le"] = 0
-                hit_data[hit_index]["te"] = 0
-                hit_data[hit_index]["cnt"] = tlu_word
-                hit_data[hit_index]["timestamp"] = tlu_timestamp_low_res
-                hit_data[hit_index]["scan_param_id"] = self.raw_idx
-
-                # Prepare for next data block. Increase hit index
-                hit_index += 1
-            
-            # Increase raw_index and move to next data word.
-            self.raw_idx += 1
+    def reset(self):
+        """
+        Clear the occupancy map and discard incomplete word sequences.
+        """
+        self.occupancy[:] = 0
+        self.n_words = 0
+        self._interpreter = RawDataInterpreter()
 
-        # Trim hit_data buffer to interpreted data hits
-        hit_data = hit_data[:hit_index]
+    def add(self, raw_data):
+        """
+        Interpret one chunk of raw data and add its hits to the occupancy map.
+        """
+        if raw_data.shape[0] == 0:
+            return
+        if self._hit_buffer.shape[0] < raw_data.shape[0]:
+            self._hit_buffer = np.zeros(max(raw_data.shape[0], 2 * self._hit_buffer.shape[0]), dtype=hit_dtype)
+        hits = self._interpreter.interpret(raw_data, None, self._hit_buffer)
+        fill_occupancy(hits, self.occupancy, self.max_cnt)
+        self.n_words += raw_data.shape[0]
 
-        # Find correct scan_param_id in meta data and attach to hit.
-        if meta_data is not None:
-            for scan_idx, param_id in enumerate(hit_data["scan_param_id"]):
-                while self.meta_idx < len(meta_data):
-                    if param_id >= meta_data[self.meta_idx]['index_start'] and param_id < meta_data[self.meta_idx]['index_stop']:
-                        hit_data[scan_idx]['scan_param_id'] = meta_data[self.meta_idx]['scan_param_id']
-                        break
-                    elif param_id >= meta_data[self.meta_idx]['index_stop']:
-                        self.meta_idx += 1
-        else:
-            pass
-        return hit_data
+    def get_error_count(self):
+        return self._interpreter.get_error_count()
+
+
+def benchmark(raw_data_file, chunk_size=1000000, compare=True):
+    """
+    Interpret the raw data of a file chunk by chunk with RawDataInterpreter and VectorizedRawDataInterpreter
+    and print the throughput of both (in words/s). Only one chunk is kept in memory, so multi-GB files can be used.
+
+    Parameters:
+    -----------
+    raw_data_file : string
+        h5 file with raw_data and meta_data nodes (output of a scan).
+    chunk_size : int
+        Number of words interpreted per call.
+    compare : bool
+        Check that both interpreters return the same hits and error count.
+    """
+    hit_buffer = np.zeros(chunk_size, dtype=hit_dtype)
+    n_hits = 0
+    identical = True
+
+    with tb.open_file(raw_data_file) as in_file:
+        n_words = in_file.root.raw_data.shape[0]
+        meta_data = in_file.root.meta_data[:]
+        RawDataInterpreter().interpret(in_file.root.raw_data[:0], meta_data, hit_buffer)  # compile before timing
+        interpreters = {'RawDataInterpreter': RawDataInterpreter(), 'VectorizedRawDataInterpreter': VectorizedRawDataInterpreter()}
+        run_time = {name: 0. for name in interpreters}
+        for start in tqdm(range(0, n_words, chunk_size), unit='chunks'):
+            raw_data = in_file.root.raw_data[start:start + chunk_size]
+            hits = {}
+            for name, data_interpreter in interpreters.items():
+                t0 = time.time()
+                hits[name] = data_interpreter.interpret(raw_data, meta_data, hit_buffer).copy()
+                run_time[name] += time.time() - t0
+            n_hits += hits['RawDataInterpreter'].shape[0]
+            if compare:
+                identical &= np.array_equal(hits['RawDataInterpreter'], hits['VectorizedRawDataInterpreter'])
+
+    print('{0:d} words, {1:d} hits'.format(n_words, n_hits))
+    for name, data_interpreter in interpreters.items():
+        print('{0:30s} {1:8.2f} s {2:8.2f} Mwords/s, {3:d} errors'.format(name, run_time[name], n_words / max(run_time[name], 1e-9) / 1e6, data_interpreter.get_error_count()))
+    if compare:
+        identical &= interpreters['RawDataInterpreter'].get_error_count() == interpreters['VectorizedRawDataInterpreter'].get_error_count()
+        print('Identical output: {0}'.format(identical))
+    return run_time
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(usage="python interpreter.py raw_data.h5 -c 1000000",
+             formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("raw_data_file", type=str, help="Raw data file of a scan.")
+    parser.add_argument("-c", "--chunk_size", type=int, default=1000000)
+    parser.add_argument("--no_compare", action='store_const', const=1, default=0, help="Do not compare the output of both interpreters.")
+    args = parser.parse_args()
+
+    benchmark(args.raw_data_file, chunk_size=args.chunk_size, compare=not args.no_compare)
@@ -19,6 +19,8 @@ from pybar.analysis.analyze_raw_data import AnalyzeRawData
 
 from beam_telescope_analysis.hit_analysis import default_hits_dtype
 
+from monopix2_daq.analysis import analysis_utils as au
+
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
@@ -119,7 +121,8 @@ def format_hit_table(input_filename, output_filename=None, chunk_size=1000000):
         Filename of the output interpreted and formatted data file.
         If None, the filename will be generated.
     chunk_size : uint
-        Chunk size of the data when reading from file.
+        Chunk size of the data when reading from file, rounded to a multiple of the HDF5 chunkshape.
+        The output file is written by a separate process (see analysis_utils.HitTableWriter).
 
     Returns
     -------
@@ -133,19 +136,12 @@ def format_hit_table(input_filename, output_filename=None, chunk_size=1000000):
     with tb.open_file(filename=input_filename, mode='r') as in_file_h5:
         last_event_number = np.zeros(shape=1, dtype=np.int64)
         input_hits_table = in_file_h5.root.Hits
-        with tb.open_file(filename=output_filename, mode='w') as out_file_h5:
-            output_hits_table = out_file_h5.create_table(
-                where=out_file_h5.root,
-                name='Hits',
-                description=beam_telescope_analysis_dtype,
-                title='Hits for test beam analysis',
-                filters=tb.Filters(
-                    complib='blosc',
-                    complevel=5,
-                    fletcher32=False))
+        chunk_size = au.get_chunk_size(input_hits_table, chunk_size)
+        with au.HitTableWriter([output_filename], description=beam_telescope_analysis_dtype, title='Hits for test beam analysis',
+                               expectedrows=max(1, input_hits_table.nrows)) as writer:
             for read_index in tqdm(range(0, input_hits_table.nrows, chunk_size)):
                 hits_chunk = input_hits_table.read(read_index, read_index + chunk_size)
-                if np.any(np.diff(np.concatenate((last_event_number, hits_chunk['event_number']))) < 0):
+                if hits_chunk['event_number'][0] < last_event_number[0] or np.any(np.diff(hits_chunk['event_number']) < 0):
                     raise RuntimeError('The event number does not increase.')
                 last_event_number = hits_chunk['event_number'][-1:]
                 hits_data_formatted = np.zeros(shape=hits_chunk.shape[0], dtype=beam_telescope_analysis_dtype)
@@ -160,8 +156,7 @@ def format_hit_table(input_filename, output_filename=None, chunk_size=1000000):
                 hits_data_formatted['tot'] = hits_chunk['tot']
                 hits_data_formatted['phase'] = hits_chunk['TDC_time_stamp']
                 hits_data_formatted['phase_quality'] = hits_chunk['TDC_trigger_distance']
-                output_hits_table.append(hits_data_formatted)
-                output_hits_table.flush()
+                writer.append(0, hits_data_formatted)
 
     return output_filename
 
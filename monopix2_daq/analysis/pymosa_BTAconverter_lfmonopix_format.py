@@ -11,13 +11,13 @@ from multiprocessing import Pool
 
 from tqdm import tqdm
 
-from contextlib2 import ExitStack
-
 from pymosa_mimosa26_interpreter import data_interpreter
 from pymosa_mimosa26_interpreter import raw_data_interpreter
 
 from beam_telescope_analysis.hit_analysis import default_hits_dtype
 
+from monopix2_daq.analysis import analysis_utils as au
+
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
@@ -75,6 +75,9 @@ def process_dut(raw_data_file, output_filename=None, output_filenames=None, anal
 def format_hit_table(input_filename, output_filenames=None, analyze_m26_header_ids=None, chunk_size=1000000):
     ''' Selects and renames important columns for test beam analysis and stores them into a new file.
 
+    All planes are formatted in one pass over the input hit table and the output files are written
+    concurrently by one process per plane (see analysis_utils.HitTableWriter).
+
     Parameters
     ----------
     input_filename : string
@@ -86,7 +89,7 @@ def format_hit_table(input_filename, output_filenames=None, analyze_m26_header_i
         List of Mimosa26 header IDs that will be interpreted.
         If None, the value defaults to the global value pyBAR_mimosa26_interpreter.raw_data_interpreter.DEFAULT_PYMOSA_M26_HEADER_IDS.
     chunk_size : uint
-        Chunk size of the data when reading from file.
+        Chunk size of the data when reading from file, rounded to a multiple of the HDF5 chunkshape.
 
     Returns
     -------
@@ -105,46 +108,34 @@ def format_hit_table(input_filename, output_filenames=None, analyze_m26_header_i
             raise ValueError('Output filenames must be a list of length %d.' % len(analyze_m26_header_ids))
     else:
         output_filenames = [(os.path.splitext(input_filename)[0] + '_header_id_' + str(plane_header_id) + '.h5') for plane_header_id in analyze_m26_header_ids]
+    n_planes = len(analyze_m26_header_ids)
+    # Output index of every plane header id, -1 for planes which are not converted
+    plane_index_lut = np.full(256, -1, dtype=np.int16)
+    plane_index_lut[np.asarray(analyze_m26_header_ids)] = np.arange(n_planes)
     with tb.open_file(filename=input_filename, mode='r') as in_file_h5:
         last_event_number = np.zeros(shape=1, dtype=np.int64)
         input_hits_table = in_file_h5.root.Hits
-        with ExitStack() as output_files_stack:
-            out_files_h5 = [output_files_stack.enter_context(tb.open_file(filename=filename, mode='w')) for filename in output_filenames]
-            output_hits_tables = []
-            for out_file_h5 in out_files_h5:
-                output_hits_table = out_file_h5.create_table(
-                    where=out_file_h5.root,
-                    name='Hits',
-                    description=beam_telescope_analysis_dtype,
-                    title='Hits for test beam analysis',
-                    filters=tb.Filters(
-                        complib='blosc',
-                        complevel=5,
-                        fletcher32=False))
-                output_hits_tables.append(output_hits_table)
-
+        chunk_size = au.get_chunk_size(input_hits_table, chunk_size)
+        with au.HitTableWriter(output_filenames, description=beam_telescope_analysis_dtype, title='Hits for test beam analysis',
+                               expectedrows=max(1, input_hits_table.nrows // n_planes)) as writer:
             pbar = tqdm(total=input_hits_table.nrows, ncols=80)
             for read_index in range(0, input_hits_table.nrows, chunk_size):
                 hits_chunk = input_hits_table.read(read_index, read_index + chunk_size)
-                if np.any(np.diff(np.concatenate((last_event_number, hits_chunk['event_number']))) < 0):
+                if hits_chunk['event_number'][0] < last_event_number[0] or np.any(np.diff(hits_chunk['event_number']) < 0):
                     raise RuntimeError('The event number does not increase.')
                 last_event_number = hits_chunk['event_number'][-1:]
-                for plane_index, output_hits_table in enumerate(output_hits_tables):
-                    plane_header_id = analyze_m26_header_ids[plane_index]
-                    selected_hits = (hits_chunk['plane'] == plane_header_id)
-                    hits_data_formatted = np.zeros(shape=np.count_nonzero(selected_hits), dtype=beam_telescope_analysis_dtype)
-                    # Format data for testbeam analysis
-                    hits_data_formatted['event_number'] = hits_chunk[selected_hits]['event_number']
-                    hits_data_formatted['frame'] = 0
-                    hits_data_formatted['column'] = hits_chunk[selected_hits]['column'] + 1
-                    hits_data_formatted['row'] = hits_chunk[selected_hits]['row'] + 1
-                    hits_data_formatted['charge'] = 0
-                    # hits_data_formatted['tdc_value'] = 0
-                    # hits_data_formatted['tdc_timestamp'] = 0
-                    # hits_data_formatted['tdc_status'] = 0
-                    # Append data to table
-                    output_hits_table.append(hits_data_formatted)
-                    output_hits_table.flush()
+                # Group the hits by plane, the stable sort keeps the event order within every plane
+                plane_index = plane_index_lut[hits_chunk['plane']]
+                n_hits = np.bincount(plane_index[plane_index >= 0], minlength=n_planes)
+                selection = np.argsort(plane_index, kind='stable')[plane_index.shape[0] - n_hits.sum():]  # Skip planes which are not converted (sorted first)
+                # Format data for testbeam analysis
+                hits_data_formatted = np.zeros(shape=selection.shape[0], dtype=beam_telescope_analysis_dtype)
+                hits_data_formatted['event_number'] = hits_chunk['event_number'][selection]
+                hits_data_formatted['column'] = hits_chunk['column'][selection] + 1
+                hits_data_formatted['row'] = hits_chunk['row'][selection] + 1
+                # frame and charge are 0
+                for index, plane_hits in enumerate(np.split(hits_data_formatted, np.cumsum(n_hits)[:-1])):
+                    writer.append(index, plane_hits)
                 pbar.update(hits_chunk.shape[0])
             pbar.close()
 
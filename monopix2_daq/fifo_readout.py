@@ -7,12 +7,13 @@
 
 import logging
 import sys
-import datetime
 import logging
-from time import sleep, time, mktime
-from threading import Thread, Event, Lock
+from math import exp
+from time import sleep, time, monotonic
+from threading import Thread, Event, Lock, Condition
 from collections import deque
-from queue import Queue, Empty
+
+import numpy as np
 
 data_iterable = ("data", "timestamp_start", "timestamp_stop", "error")
 
@@ -36,6 +37,139 @@ class StopTimeout(Exception):
     pass
 
 
+class RingBuffer(object):
+    '''Preallocated, fixed-capacity uint32 ring buffer between the readout thread (single producer)
+    and the worker thread (single consumer).
+
+    Every chunk is stored contiguously, so the consumer gets a view into the buffer instead of a copy.
+    The space of a chunk is only reused after release() has been called, i.e. a view must not be used
+    after the callback returned. Chunks which do not fit into the free space (or which are larger than
+    the buffer) or which arrive while all max_chunks chunk descriptors are in use are queued as they are,
+    so the readout thread never blocks and no data is lost.
+    '''
+
+    def __init__(self, size=2 ** 22, max_chunks=2 ** 16):
+        self.size = int(size)
+        self.max_chunks = int(max_chunks)
+        self._buffer = np.empty(self.size, dtype=np.uint32)
+        # Chunk descriptors, indexed by chunk number % max_chunks
+        self._chunk_start = np.zeros(self.max_chunks, dtype=np.int64)
+        self._chunk_length = np.zeros(self.max_chunks, dtype=np.int64)
+        self._chunk_extent = np.zeros(self.max_chunks, dtype=np.int64)  # length + unused words at the end of the buffer
+        self._chunk_meta = [None] * self.max_chunks
+        self._spilled = {}  # (data, meta) of the chunks not copied into the buffer, by chunk number
+        self._popped_extent = deque()  # extent of the popped chunks until they are released (consumer side)
+        self._cond = Condition(Lock())
+        self.reset()
+
+    def reset(self):
+        with self._cond:
+            self._head = 0  # next free word
+            self._n_pushed = 0
+            self._n_popped = 0
+            self._n_released = 0
+            self._used = 0
+            self._closed = False
+            self._spilled.clear()
+            self._popped_extent.clear()
+            self.reset_stats()
+
+    def reset_stats(self):
+        self.high_water_mark = 0
+        self.high_water_chunks = 0
+        self.wraps = 0
+        self.spills = 0
+        self.spilled_words = 0
+
+    def __len__(self):
+        return self._n_pushed - self._n_popped
+
+    @property
+    def used(self):
+        return self._used
+
+    def push(self, data, *meta):
+        '''Copy a chunk into the buffer (producer side). meta is handed back together with the chunk.
+        '''
+        n = data.shape[0]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Ring buffer closed')
+            free = self.size - self._used
+            slot_free = self._n_pushed - self._n_released < self.max_chunks
+            head = self._head
+        if head + n <= self.size:
+            start, extent = head, n
+        else:
+            start, extent = 0, self.size - head + n
+        if extent > free or not slot_free:  # kept as it is, without a chunk descriptor
+            self._spilled[self._n_pushed] = (data, meta)
+            start, extent = -1, 0
+            self.spills += 1
+            self.spilled_words += n
+        else:
+            self._buffer[start:start + n] = data
+            if start == 0 and head != 0:
+                self.wraps += 1
+            slot = self._n_pushed % self.max_chunks
+            self._chunk_start[slot] = start
+            self._chunk_length[slot] = n
+            self._chunk_extent[slot] = extent
+            self._chunk_meta[slot] = meta
+        with self._cond:
+            if start >= 0:
+                self._head = start + n
+                self._used += extent
+                if self._used > self.high_water_mark:
+                    self.high_water_mark = self._used
+            self._n_pushed += 1
+            if self._n_pushed - self._n_released > self.high_water_chunks:
+                self.high_water_chunks = self._n_pushed - self._n_released
+            self._cond.notify_all()
+
+    def pop(self, timeout=None):
+        '''Wait for the next chunk (consumer side) and return (data, *meta).
+        data is a view into the buffer and stays valid until release() is called.
+        Returns None if the buffer is closed and empty or if the timeout expired.
+        '''
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._n_pushed > self._n_popped or self._closed, timeout):
+                return None
+            if self._n_pushed == self._n_popped:
+                return None
+            idx = self._n_popped
+            self._n_popped += 1
+        if idx in self._spilled:
+            data, meta = self._spilled.pop(idx)
+            self._popped_extent.append(0)
+        else:
+            slot = idx % self.max_chunks
+            start = self._chunk_start[slot]
+            data = self._buffer[start:start + self._chunk_length[slot]]
+            meta = self._chunk_meta[slot]
+            self._chunk_meta[slot] = None
+            self._popped_extent.append(self._chunk_extent[slot])
+        return (data,) + meta
+
+    def release(self):
+        '''Give the space of the oldest popped chunk back to the producer.
+        '''
+        with self._cond:
+            if self._n_released < self._n_popped:
+                self._used -= self._popped_extent.popleft()
+                self._n_released += 1
+                if self._n_released == self._n_pushed:
+                    self._head = 0  # empty: start again from the beginning, avoids needless wrapping
+                self._cond.notify_all()
+
+    def close(self):
+        '''Wake up the consumer, pop() returns None when all remaining chunks are processed.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class FifoReadout(object):
     def __init__(self, dut, logLevel=logging.INFO, logHandlers=None):
         self.dut = dut
@@ -54,21 +188,30 @@ class FifoReadout(object):
         self.watchdog_thread = None
         self.fill_buffer = False
         self.readout_interval = 0.05
-        self._moving_average_time_period = 10.0
+        # Adaptive readout interval: shortened when the reads return many words, lengthened when idle,
+        # between min_readout_interval and max_readout_interval (None: readout_interval)
+        self.adaptive_interval = False
+        self.min_readout_interval = 0.0005
+        self.max_readout_interval = None
+        self.target_words_per_read = 2 ** 16
+        self._interval = self.readout_interval
+        self.rate_time_constant = 1.0  # Time constant (s) of the data rates in get_readout_metrics()
         self._data_deque = deque()
         self._data_buffer = deque()
-        self._words_per_read = deque(maxlen=int(self._moving_average_time_period / self.readout_interval))
-        self._result = Queue(maxsize=1)
-        self._calculate = Event()
         self.stop_readout = Event()
         self.force_stop = Event()
+        self.ring_buffer = False
+        self.ring_buffer_size = 2 ** 22  # words, allocated once on first use
+        self._ring_buffer = None
         self.timestamp = None
         self.update_timestamp()
         self._is_running = False
         self.reset_rx()
         self.reset_sram_fifo()
-        self._record_count_lock = Lock()
         self.set_record_count(0,reset=True)
+        self.reset_readout_metrics()
+        self.reset_buffer_stats()
+        self.reset_interval_stats()
         
     @property
     def is_running(self):
@@ -89,17 +232,9 @@ class FifoReadout(object):
             self.logger.warning('Data requested but software data buffer not active')
 
     def data_words_per_second(self):
-        if self._result.full():
-            self._result.get()
-        self._calculate.set()
-        try:
-            result = self._result.get(timeout=2 * self.readout_interval)
-        except Empty:
-            self._calculate.clear()
-            return None
-        return result / float(self._moving_average_time_period)
+        return self._words_rate
 
-    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None):
+    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None, ring_buffer=False):
         if self._is_running:
             raise RuntimeError('Readout already running: use stop() before start()')
         self._is_running = True
@@ -107,7 +242,15 @@ class FifoReadout(object):
         self.callback = callback
         self.errback = errback
         self.fill_buffer = fill_buffer
-        self._record_count = 0
+        self.ring_buffer = ring_buffer
+        self.reset_readout_metrics()
+        if self.ring_buffer:
+            if self._ring_buffer is None or self._ring_buffer.size != self.ring_buffer_size:
+                self._ring_buffer = RingBuffer(size=self.ring_buffer_size)
+            else:
+                self._ring_buffer.reset()
+        self.reset_buffer_stats()
+        self.reset_interval_stats()
         if reset_rx:
             self.reset_rx()
         if reset_sram_fifo:
@@ -116,7 +259,8 @@ class FifoReadout(object):
             fifo_size = self.dut['fifo']['FIFO_SIZE']
             if fifo_size != 0:
                 self.logger.warning('SRAM FIFO not empty when starting FIFO readout: size = %i', fifo_size)
-        self._words_per_read.clear()
+        self._n_reads_last_data = 0
+        self._last_data_time = time()
         if clear_buffer:
             self._data_deque.clear()
             self._data_buffer.clear()
@@ -134,6 +278,27 @@ class FifoReadout(object):
         self.readout_thread.daemon = True
         self.readout_thread.start()
 
+    def wait_for_data(self, quiet_time=0.01, timeout=1.0, min_empty_reads=2):
+        '''
+        Waits until the readout thread received no more data, e.g. after the last injection of a mask step.
+        The data is complete when nothing arrived for quiet_time seconds (counted from the call at the earliest)
+        and at least min_empty_reads reads returned no data.
+
+        Returns
+        -------
+        drained : bool
+            False if data was still arriving after timeout seconds.
+        '''
+        t_call = time()
+        while True:
+            now = time()
+            if (self._n_reads - self._n_reads_last_data >= min_empty_reads and
+                    now - max(self._last_data_time, t_call) >= quiet_time):
+                return True
+            if now - t_call >= timeout or not self.readout_thread.is_alive():
+                return False
+            sleep(self.readout_interval)
+
     def stop(self, timeout=10.0):
         if not self._is_running:
             raise RuntimeError('Readout not running: use start() before stop()')
@@ -161,11 +326,17 @@ class FifoReadout(object):
         self.callback = None
         self.errback = None
         self.logger.debug('Stopped FIFO readout')
+        self.logger.debug('Buffer statistics: %s', self.get_buffer_stats())
+        if self.adaptive_interval:
+            self.logger.debug('Readout interval statistics: %s', self.get_interval_stats())
 
     def print_readout_status(self):
         ret = self.get_discard_count()
         self.logger.info('Received words: %d', self._record_count)
-        self.logger.info('Data queue size: %d', len(self._data_deque))
+        if self.ring_buffer:
+            self.logger.info('Data queue size: %d', len(self._ring_buffer))
+        else:
+            self.logger.info('Data queue size: %d', len(self._data_deque))
         self.logger.info('SRAM FIFO size: %d', self.dut['fifo']['FIFO_SIZE'])
         self.logger.info('Channel:                     %s', " | ".join(['MONO','T_INJ',"T_MON","T_TLU","T_RX1","TLU"]))
         self.logger.info('Discard counter:             %s', " | ".join([str(ret['data_rx']).rjust(4),
@@ -185,13 +356,17 @@ class FifoReadout(object):
         self.logger.debug('Starting %s', self.readout_thread.name)
         curr_time = self.get_float_time()
         time_wait = 0.0
+        self._interval = self.readout_interval
         while not self.force_stop.wait(time_wait if time_wait >= 0.0 else 0.0):
+            interval = self._interval
             try:
                 time_read = time()
                 if no_data_timeout and curr_time + no_data_timeout < self.get_float_time():
                     raise NoDataTimeout('Received no data for %0.1f second(s)' % no_data_timeout)
                 data = self.read_data()
-                self._record_count += len(data)
+                self._update_readout_metrics(len(data))
+                if self.adaptive_interval:
+                    interval = self._adapt_interval(data.shape[0])  # Reads the FIFO size, errors are handled as read errors
             except Exception:
                 no_data_timeout = None  # raise exception only once
                 if self.errback:
@@ -203,46 +378,174 @@ class FifoReadout(object):
             else:
                 data_words = data.shape[0]
                 if data_words > 0:
+                    self._n_reads_last_data = self._n_reads
+                    self._last_data_time = time()
                     last_time, curr_time = self.update_timestamp()
                     status = 0
                     if self.callback:
-                        self._data_deque.append((data, last_time, curr_time, status))
+                        if self.ring_buffer:
+                            self._ring_buffer.push(data, last_time, curr_time, status)
+                        else:
+                            self._data_deque.append((data, last_time, curr_time, status))
+                            self._queued_words += data_words
+                            if self._queued_words > self._peak_queued_words:
+                                self._peak_queued_words = self._queued_words
                     if self.fill_buffer:
                         self._data_buffer.append((data, last_time, curr_time, status))
-                    self._words_per_read.append(data_words)
                 elif self.stop_readout.is_set():
                     break
-                else:
-                    self._words_per_read.append(0)
             finally:
-                time_wait = self.readout_interval - (time() - time_read)
-            if self._calculate.is_set():
-                self._calculate.clear()
-                self._result.put(sum(self._words_per_read))
+                time_wait = interval - (time() - time_read)
         if self.callback:
-            self._data_deque.append(None)  # last item, will stop worker
+            if self.ring_buffer:
+                self._ring_buffer.close()  # worker stops after the remaining chunks
+            else:
+                self._data_deque.append(None)  # last item, will stop worker
         self.logger.debug('Stopped %s', self.readout_thread.name)
 
+    def _adapt_interval(self, data_words):
+        '''
+        Adjusts the readout interval to the data rate, using the number of words of the last read and the
+        number of words arrived in the FIFO since then. Returns the time until the next read, which is zero
+        if the FIFO already holds target_words_per_read words.
+        '''
+        fifo_words = self.dut['fifo']['FIFO_SIZE'] // 4
+        max_interval = self.readout_interval if self.max_readout_interval is None else self.max_readout_interval
+        if data_words + fifo_words > 2 * self.target_words_per_read:
+            self._interval = max(self._interval / 2., self.min_readout_interval)
+        elif data_words + fifo_words < self.target_words_per_read // 4:
+            self._interval = min(self._interval * 1.25, max_interval)
+
+        stats = self._interval_stats
+        stats['reads'] += 1
+        stats['interval_sum'] += self._interval
+        stats['interval_min'] = min(stats['interval_min'], self._interval)
+        stats['interval_max'] = max(stats['interval_max'], self._interval)
+        stats['fifo_words_max'] = max(stats['fifo_words_max'], fifo_words)
+        stats['words_per_read_max'] = max(stats['words_per_read_max'], data_words)
+        if fifo_words >= self.target_words_per_read:
+            stats['immediate_reads'] += 1
+            return 0.0
+        return self._interval
+
+    @property
+    def current_readout_interval(self):
+        '''
+        Time between two reads currently used by the readout thread (s).
+        '''
+        return self._interval
+
+    def reset_interval_stats(self):
+        self._interval_stats = {'reads': 0, 'immediate_reads': 0, 'interval_sum': 0.0, 'interval_min': float('inf'),
+                                'interval_max': 0.0, 'fifo_words_max': 0, 'words_per_read_max': 0}
+
+    def get_interval_stats(self):
+        '''
+        Statistics of the adaptive readout interval since the start of the readout.
+
+        Returns
+        -------
+        stats : dict
+            interval: current readout interval (s), interval_avg/min/max: readout interval over all reads (s).
+            fifo_words_max: maximum number of words found in the FIFO right after a read.
+            words_per_read_max: maximum number of words of one read.
+            immediate_reads: reads done without waiting, since the FIFO was already filled.
+        '''
+        stats = dict(self._interval_stats)
+        interval_sum = stats.pop('interval_sum')
+        stats['interval'] = self._interval
+        stats['interval_avg'] = interval_sum / stats['reads'] if stats['reads'] else self._interval
+        if stats['reads'] == 0:
+            stats['interval_min'] = stats['interval_max'] = self._interval
+        return stats
+
     def worker(self):
         '''Worker thread continuously calling callback function when data is available.
         '''
         self.logger.debug('Starting %s', self.worker_thread.name)
-        while True:
-            try:
-                data = self._data_deque.popleft()
-            except IndexError:
-                self.stop_readout.wait(self.readout_interval)  # sleep a little bit, reducing CPU usage
-            else:
-                if data is None:  # if None then exit
-                    break
+        if self.ring_buffer:
+            self._ring_buffer_worker()
+        else:
+            while True:
+                try:
+                    data = self._data_deque.popleft()
+                except IndexError:
+                    self.stop_readout.wait(self.readout_interval)  # sleep a little bit, reducing CPU usage
                 else:
-                    try:
-                        self.callback(data)
-                    except Exception:
-                        self.errback(sys.exc_info())
+                    if data is None:  # if None then exit
+                        break
+                    else:
+                        self._queued_words -= data[0].shape[0]
+                        self._update_latency(data[2])
+                        try:
+                            self.callback(data)
+                        except Exception:
+                            self.errback(sys.exc_info())
 
         self.logger.debug('Stopped %s', self.worker_thread.name)
 
+    def _ring_buffer_worker(self):
+        '''Worker loop for the ring buffer mode. Blocks until data is available, no polling.
+        The callback gets a view into the ring buffer, which is only valid until the callback returns.
+        '''
+        while True:
+            data = self._ring_buffer.pop()
+            if data is None:  # buffer closed and empty
+                break
+            self._update_latency(data[2])
+            try:
+                self.callback(data)
+            except Exception:
+                self.errback(sys.exc_info())
+            finally:
+                self._ring_buffer.release()
+
+    def _update_latency(self, read_time):
+        latency = self.get_float_time() - read_time
+        self._n_callbacks += 1
+        self._latency_sum += latency
+        if latency > self._latency_max:
+            self._latency_max = latency
+
+    def reset_buffer_stats(self):
+        self._n_callbacks = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._queued_words = 0
+        self._peak_queued_words = 0
+        if self._ring_buffer is not None:
+            self._ring_buffer.reset_stats()
+
+    def get_buffer_stats(self):
+        '''
+        Statistics of the buffer between readout and worker thread, for comparing the deque and the ring buffer mode.
+
+        Returns
+        -------
+        stats : dict
+            latency_avg/latency_max: time between reading a chunk and calling the callback (s).
+            peak_queued_words: maximum number of words waiting for the callback.
+            allocations: number of chunks kept alive in their own array until the callback (every chunk
+            in deque mode, only spilled chunks in ring buffer mode).
+        '''
+        stats = {'mode': 'ring_buffer' if self.ring_buffer else 'deque',
+                 'callbacks': self._n_callbacks,
+                 'latency_avg': self._latency_sum / self._n_callbacks if self._n_callbacks else 0.0,
+                 'latency_max': self._latency_max}
+        if self.ring_buffer:
+            rb = self._ring_buffer
+            stats.update({'peak_queued_words': rb.high_water_mark,
+                          'peak_queued_chunks': rb.high_water_chunks,
+                          'fill_max': rb.high_water_mark / float(rb.size),
+                          'size': rb.size,
+                          'wraps': rb.wraps,
+                          'allocations': rb.spills,
+                          'spilled_words': rb.spilled_words})
+        else:
+            stats.update({'peak_queued_words': self._peak_queued_words,
+                          'allocations': self._n_callbacks})
+        return stats
+
     def watchdog(self):
         self.logger.debug('Starting %s', self.watchdog_thread.name)
         while True:
@@ -279,18 +582,61 @@ class FifoReadout(object):
         raise NotImplementedError()
         
     def get_record_count(self):
-        self._record_count_lock.acquire()
-        cnt=self._record_count
-        self._record_count_lock.release()
-        return cnt
+        return self._record_count
 
     def set_record_count(self,cnt,reset=False):
-        self._record_count_lock.acquire()
+        # Only call while the readout is stopped, the counter is written by the readout thread without a lock
         if reset:
             self._record_count=cnt
         else:
             self._record_count=self._record_count+cnt
-        self._record_count_lock.release()
+
+    def reset_readout_metrics(self):
+        self._record_count = 0
+        self._n_reads = 0
+        self._t_start = monotonic()
+        self._t_last_read = self._t_start
+        self._words_rate = 0.0
+        self._reads_rate = 0.0
+
+    def _update_readout_metrics(self, data_words):
+        '''
+        Called by the readout thread after every read. The counters and rates are only written here, so they can be
+        read from any thread without a lock. The rates are exponentially weighted moving averages with the time
+        constant rate_time_constant.
+        '''
+        now = monotonic()
+        dt = now - self._t_last_read
+        self._t_last_read = now
+        self._record_count += data_words
+        self._n_reads += 1
+        if dt > 0:
+            alpha = 1.0 - exp(-dt / self.rate_time_constant)
+            self._words_rate += alpha * (data_words / dt - self._words_rate)
+            self._reads_rate += alpha * (1.0 / dt - self._reads_rate)
+
+    def get_readout_metrics(self):
+        '''
+        Counters and data rates of the current (or last) readout. Does not wait for the readout thread.
+
+        Returns
+        -------
+        metrics : dict
+            words/bytes/reads: totals since the start of the readout.
+            words_per_second/bytes_per_second/reads_per_second: moving averages over about rate_time_constant seconds.
+            words_per_second_avg: average over the whole readout.
+            elapsed: time since the start of the readout (s).
+        '''
+        words, reads, words_rate = self._record_count, self._n_reads, self._words_rate
+        elapsed = monotonic() - self._t_start
+        return {'words': words,
+                'bytes': 4 * words,
+                'reads': reads,
+                'words_per_second': words_rate,
+                'bytes_per_second': 4 * words_rate,
+                'reads_per_second': self._reads_rate,
+                'words_per_second_avg': words / elapsed if elapsed > 0 else 0.0,
+                'elapsed': elapsed}
 
     def reset_sram_fifo(self):
         fifo_size = self.dut['fifo']['FIFO_SIZE']
@@ -327,9 +673,7 @@ class FifoReadout(object):
         
     def get_float_time(self):
         '''
-        Returns time as double precision floats - Time64 in pytables - mapping to and from python datetime's
+        Returns time as double precision floats - Time64 in pytables
         '''
-        t1 = time()
-        t2 = datetime.datetime.fromtimestamp(t1)
-        return mktime(t2.timetuple()) + 1e-6 * t2.microsecond
+        return time()
     
@@ -7,6 +7,7 @@ import bitarray
 import tables
 import yaml
 import socket
+from array import array
 
 from basil.dut import Dut
 import basil.RL.StdRegister
@@ -28,6 +29,8 @@ class Monopix2(Dut):
     """
     # Default path for Monopix2 yaml file
     default_yaml = os.path.dirname(os.path.abspath(__file__)) + os.sep + "monopix2.yaml"
+    # Yaml file for the software emulation of the DAQ and the chip (no hardware needed)
+    emu_yaml = os.path.dirname(os.path.abspath(__file__)) + os.sep + "monopix2_emu.yaml"
 
     def __init__(self, conf=None, no_power_reset=True, logLevel=logging.DEBUG, logHandlers=None):
         """
@@ -98,11 +101,19 @@ class Monopix2(Dut):
                        }
         self.SET_VALUE = {}
 
+        # Shadow of the last written registers and GPAC set-points. Writes which would not change anything are skipped.
+        self._shadow = {}
+        self._pixel_conf_valid = set()  # (bit, bit_pos) of PIXEL_CONF known to be on the chip
+        self.write_stats = {reg: {"issued": 0, "skipped": 0} for reg in ["CONF", "CONF_SR", "CONF_DC", "GPAC"]}
+        for reg in ["CONF", "CONF_SR", "CONF_DC"]:
+            self._track_writes(reg)
+
     def init(self):
         """
         Initialization of the chip.
         """
         super(Monopix2, self).init()
+        self._invalidate_shadow()
 
         # Get firmware version and log it.
         fw_version = self.get_fw_version()
@@ -114,7 +125,7 @@ class Monopix2(Dut):
         # Load default configuration.
         self['CONF_SR'].set_size(self["CONF_SR"]._conf['size'])
         self['CONF']['Def_Conf'] = 1
-        self['CONF'].write()
+        self._write_reg('CONF')
 
         # Power on the chip
         self.power_on()
@@ -133,7 +144,7 @@ class Monopix2(Dut):
         # Disable the default configuration.
         # (Maybe this is not necessary as it was done already in write_global_conf, but doesn't hurt)
         self['CONF']['Def_Conf'] = 0
-        self['CONF'].write()
+        self._write_reg('CONF')
 
         self.set_global_reg(EnTestPattern=0)
         
@@ -230,6 +241,9 @@ class Monopix2(Dut):
         self.SET_VALUE['INJ_HI']=VHi
         self['INJ_LO'].set_voltage(VHi, unit='V')
         self.SET_VALUE['INJ_LO']=VHi
+        for k in self.VLT_CONF + self.CRR_CONF + ['INJ_HI', 'INJ_LO']:
+            self._shadow[k] = self.SET_VALUE[k]
+            self.write_stats["GPAC"]["issued"] += 1
 
         time.sleep(0.2)
         self.logger.info("LF-Monopix2 Powered ON.")
@@ -247,6 +261,8 @@ class Monopix2(Dut):
         # Disable power sources
         for pwr in self.PWR_CONF:
             self.disable_global_power(pwr)
+        # The chip configuration is lost.
+        self._invalidate_shadow()
         self.logger.info("LF-Monopix2 Powered OFF.")
     
     def set_global_power(self, **kwarg):
@@ -302,8 +318,14 @@ class Monopix2(Dut):
         """
         for k in kwarg.keys():
             if k in self.VLT_CONF:
+                if self._shadow.get(k) == kwarg[k]:
+                    self.write_stats["GPAC"]["skipped"] += 1
+                    self.logger.debug("{0:s}={1:.4f} V unchanged".format(k, kwarg[k]))
+                    continue
                 self[k].set_voltage(kwarg[k], unit='V')
                 self.SET_VALUE[k]=kwarg[k]
+                self._shadow[k]=kwarg[k]
+                self.write_stats["GPAC"]["issued"] += 1
                 feedback=[self[k].get_voltage(unit='V'), self[k].get_current(unit='mA')]
                 self.logger.debug("Set {0:s}={1:.4f} V | Read {2:s}={3:.4f} V ({4:.4f} mA)".format(k, kwarg[k], k, feedback[0], feedback[1]))
             else:
@@ -321,8 +343,14 @@ class Monopix2(Dut):
         """
         for k in kwarg.keys():
             if k in self.CRR_CONF:
+                if self._shadow.get(k) == kwarg[k]:
+                    self.write_stats["GPAC"]["skipped"] += 1
+                    self.logger.debug("{0:s}={1:.4f} uA unchanged".format(k, kwarg[k]))
+                    continue
                 self[k].set_current(kwarg[k],unit="uA")
                 self.SET_VALUE[k]=kwarg[k]
+                self._shadow[k]=kwarg[k]
+                self.write_stats["GPAC"]["issued"] += 1
                 feedback=[self[k].get_current(unit='uA'), self[k].get_voltage(unit='V')]
                 self.logger.info("Set {0:s}={1:.4f} uA | Read {2:s}={3:.4f} uA ({4:.4f} V)".format(k, kwarg[k], k, feedback[0], feedback[1]))
             else:
@@ -453,10 +481,14 @@ class Monopix2(Dut):
         """
         A function that sets a given VHi value to both 'INJ_HI' and 'INJ_LO' on the GPAC.
         """
-        self['INJ_HI'].set_voltage(VHi, unit='V')
-        self.SET_VALUE['INJ_HI']=VHi
-        self['INJ_LO'].set_voltage(VHi, unit='V')
-        self.SET_VALUE['INJ_LO']=VHi
+        for k in ['INJ_HI', 'INJ_LO']:
+            if self._shadow.get(k) == VHi:
+                self.write_stats["GPAC"]["skipped"] += 1
+            else:
+                self[k].set_voltage(VHi, unit='V')
+                self.SET_VALUE[k]=VHi
+                self._shadow[k]=VHi
+                self.write_stats["GPAC"]["issued"] += 1
         self.logger.debug("VHi set to {0:.4f} V".format(VHi))
 
     def set_inj_all(self, inj_high=0.6,
@@ -525,12 +557,12 @@ class Monopix2(Dut):
         (Disables the pixel coonfiguration signal En_Cnfg_Pix and the default configuration Def_Conf )
         """
         self['CONF']['En_Cnfg_Pix'] = 0
-        self['CONF'].write()
-        self['CONF_SR'].write() 
+        self._write_reg('CONF')
+        self._write_reg('CONF_SR')
         while not self['CONF_SR'].is_ready:
             time.sleep(0.001)
         self['CONF']['Def_Conf'] = 0
-        self['CONF'].write()
+        self._write_reg('CONF')
 
     def set_global_reg(self,**kwarg):
         """
@@ -582,7 +614,7 @@ class Monopix2(Dut):
         # Log registers changed
         self.logger.info(s)
 
-    def _write_pixel_mask(self, bit, mask, bit_pos=0, ro_off=True, overwrite=False):
+    def _write_pixel_mask(self, bit, mask, bit_pos=0, ro_off=True, overwrite=False, plan=None):
         #TODO: CHECK FUNCTION
         """
         Writes a mask for pixel configuration.
@@ -600,99 +632,50 @@ class Monopix2(Dut):
             A flag to determine if the read-out clocks should be turned off while the pixel mask is written. 
         overwrite: boolean
             A flag to determine if the current pixel configuration bits mask should be overwritten by the one given as input.
+        plan: dict or None
+            The result of prepare_pixel_masks() for this mask. Used if it is still valid, otherwise the mask is prepared again.
         """
-        if bit=="Trim":
-            trim_bits = np.unpackbits(self.PIXEL_CONF["Trim"])
-            matrix_trim_in_bits = np.reshape(trim_bits, (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"], 8)).astype(np.bool)
-            pixel_conf_bitpos = matrix_trim_in_bits[:, :, 7-bit_pos]
-        else:
-            signal_bits = np.unpackbits(self.PIXEL_CONF[bit])
-            matrix_in_bits = np.reshape(signal_bits, (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"], 8)).astype(np.bool)
-            pixel_conf_bitpos = matrix_in_bits[:, :, 7-bit_pos]
+        self._write_pixel_masks(bit, {bit_pos: mask}, ro_off=ro_off, overwrite=overwrite, plan=plan)
+
+    def _write_pixel_masks(self, bit, masks, ro_off=True, overwrite=False, plan=None):
+        """
+        Writes masks for several bits of one pixel configuration (e.g. all "Trim" bits) in one pass.
+        Every double column is shifted in once per different data, loading all bits which get this data at the same time.
+
+        Parameters
+        ----------
+        bit: string
+            A string with the name of the mask to be modified in the pixel configuration.
+            (Options: "EnPre", "EnInj", "EnMonitor", "Trim")
+        masks: dict
+            The position of the bit to be configured as keys and numpy.ndarrays with binary values of dimensions "self.COL_SIZE X self.ROW_SIZE" as values.
+        ro_off: boolean
+            A flag to determine if the read-out clocks should be turned off while the pixel masks are written.
+        overwrite: boolean
+            A flag to determine if the current pixel configuration bits should be overwritten by the ones given as input.
+            Only has an effect if the bits on the chip are not known (e.g. after init), otherwise only changed double columns are written.
+        plan: dict or None
+            The result of prepare_pixel_masks() for these masks. Used if it is still valid, otherwise the masks are prepared again.
+        """
+        if plan is None or not self._is_plan_valid(plan, bit, masks, overwrite):
+            plan = self.prepare_pixel_masks(bit, masks, overwrite=overwrite)
+        self.write_stats["CONF_DC"]["skipped"] += plan["skipped"]
 
         # Turn Read-out related clocks off
+        ro_off = ro_off and len(plan["dc_groups"]) > 0
         if ro_off:
             ClkBX = self['CONF']['ClkBX'].tovalue()
             ClkOut = self['CONF']['ClkOut'].tovalue()
             self['CONF']['ClkOut'] = 0
             self['CONF']['ClkBX'] = 0
-        # Enable the corresponding "...Ld" register (Active Low)
-        if bit=="Trim":
-            self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 0  # active low
-            #print(self['CONF_SR']["{0:s}Ld".format(bit)])
-        else:
-            ###self['CONF_SR']["{0:s}Ld".format(bit)]= 0  # active low
-            self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 0
-
-        # Check if the mask given as input will overwrite completely the current configuration, or only specific values will be written.    
-        if overwrite:
-            defval = np.all(mask)
-            self['CONF_DC'].setall(defval)
-            self['CONF_SR']['EnSRDCol'].setall(True)
-            #Data going to the global configuration
-            self['CONF']['En_Cnfg_Pix'] = 0
-            self['CONF'].write()
-            self['CONF_SR'].write()
-            while not self['CONF_SR'].is_ready:
-                time.sleep(0.001)
-            # Data going to the matrix
-            self['CONF']['En_Cnfg_Pix'] = 1
-            self['CONF'].write()
-            self['CONF_DC'].write()
-            while not self['CONF_DC'].is_ready:
-                time.sleep(0.001)
-            #Data going to the global configuration    
-            self['CONF']['En_Cnfg_Pix'] = 0
-            arg = np.argwhere(mask != defval)
-        else:
-            if bit=="Trim":
-                arg = np.argwhere(pixel_conf_bitpos!= mask)
-            else:
-                ###arg = np.argwhere(self.PIXEL_CONF[bit]!= mask)
-                arg = np.argwhere(pixel_conf_bitpos!= mask)
 
-        # Calculate the double column indexes from the pixels that want to be changed. 
-        uni = np.unique(arg[:, 0]//2)
-        
-        # Wirte the mask per double column. 
-        for dcol in uni:
-            self['CONF_SR']['EnSRDCol'].setall(False)
-            self['CONF_SR']['EnSRDCol'][dcol] = '1'
-            #Data going to the global configuration
-            self['CONF']['En_Cnfg_Pix'] = 0
-            self['CONF'].write()
-            self['CONF_SR'].write()
-            while not self['CONF_SR'].is_ready:
-                time.sleep(0.001)
-            # Index the double column as 2 columns
-            
-            # print ("col_0", bitarray.bitarray(list(mask[dcol*2+1, :])))
-            # print ("col_0", len(bitarray.bitarray(list(mask[dcol*2+1, :]))))
-            # print ("col_1", bitarray.bitarray(list(mask[dcol*2, ::-1])))
-            # print ("col_1", len(bitarray.bitarray(list(mask[dcol*2, ::-1]))))
-            self['CONF_DC']['Col0'] = bitarray.bitarray(list(mask[dcol*2+1, :]))
-            self['CONF_DC']['Col1'] = bitarray.bitarray(list(mask[dcol*2, ::-1]))
-            # print(self['CONF_DC']['Col0'], len(self['CONF_DC']['Col0']))
-            # print(self['CONF_DC']['Col1'], len(self['CONF_DC']['Col1']))
-            # Data going to the matrix
-            self['CONF']['En_Cnfg_Pix'] = 1
-            self['CONF'].write()
-            self['CONF_DC'].write()
-            while not self['CONF_DC'].is_ready:
-                time.sleep(0.001)
-            self['CONF_SR']['EnSRDCol'][dcol] = '0'
-            self['CONF']['En_Cnfg_Pix'] = 0
-        self['CONF'].write()
+        if plan["dc_groups"]:
+            self._write_dc_bitstreams(bit, plan["dc_groups"])
 
         # Disable the in-pixel configuration
-        if bit=="Trim":
+        for bit_pos in masks:
             self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 1  # active low
-            #print(self['CONF_SR']["{0:s}Ld".format(bit)])
-            #print ("-----")
-        else:
-            ###self['CONF_SR']["{0:s}Ld".format(bit)]= 1  # active low
-            self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 1  # active low
-        self['CONF_SR'].write()
+        self._write_reg('CONF_SR')
         while not self['CONF_SR'].is_ready:
             time.sleep(0.001)
 
@@ -700,18 +683,188 @@ class Monopix2(Dut):
         if ro_off:
             self['CONF']['ClkOut'] = ClkOut  # Readout OFF
             self['CONF']['ClkBX'] = ClkBX
-        self['CONF'].write()
+        self._write_reg('CONF')
 
         # Update Pixel Configuration.
-        if bit=="Trim":
-            matrix_trim_in_bits[:, :, 7-bit_pos]=mask
-            pixconf_exchanged_bit= np.reshape(np.packbits(matrix_trim_in_bits),(self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"]))
-            self.PIXEL_CONF[bit] = pixconf_exchanged_bit
+        self.PIXEL_CONF[bit] = plan["pixel_conf"]
+        # Only bits which were written completely, or only changed on top of known bits, match the chip.
+        for bit_pos in masks:
+            if bit_pos in plan["compared"] and (bit, bit_pos) not in self._pixel_conf_valid:
+                continue
+            self._pixel_conf_valid.add((bit, bit_pos))
+
+    def prepare_pixel_masks(self, bit, masks, overwrite=False, after=None):
+        """
+        Computes which double columns have to be written with which data for the given masks, without accessing the chip.
+        Can be called ahead of time (e.g. for the next mask step during the read-out of the current one) and passed to the writing functions as "plan".
+
+        Parameters
+        ----------
+        bit: string
+            A string with the name of the mask to be modified in the pixel configuration.
+            (Options: "EnPre", "EnInj", "EnMonitor", "Trim")
+        masks: dict
+            The position of the bit to be configured as keys and numpy.ndarrays with binary values of dimensions "self.COL_SIZE X self.ROW_SIZE" as values.
+        overwrite: boolean
+            A flag to determine if the current pixel configuration bits should be overwritten by the ones given as input.
+        after: dict or None
+            A plan of the same bit which will be written before this one. The masks are compared to its result instead of the current pixel configuration.
+
+        Returns
+        ----------
+        plan: dict
+            The data of the changed double columns ("dc_groups") and the resulting pixel configuration ("pixel_conf").
+        """
+        masks = {bit_pos: np.asarray(mask, dtype=bool) for bit_pos, mask in masks.items()}
+        base = self.PIXEL_CONF[bit] if after is None else after["pixel_conf"]
+        valid = set(self._pixel_conf_valid)
+        if after is not None:
+            valid.update((bit, bit_pos) for bit_pos in after["masks"] if bit_pos not in after["compared"])
+        n_dcols = self.chip_props["COL_SIZE"] // 2
+        matrix_in_bits = np.reshape(np.unpackbits(base), (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"], 8)).astype(bool)
+
+        dc_data = {}
+        skipped = 0
+        compared = []
+        for bit_pos, mask in masks.items():
+            # Check if the mask given as input will overwrite completely the current configuration, or only specific values will be written.
+            if overwrite and (bit, bit_pos) not in valid:
+                changed = np.ones(n_dcols, dtype=bool)
+            else:
+                changed = np.any(np.reshape(matrix_in_bits[:, :, 7-bit_pos] != mask, (n_dcols, -1)), axis=1)
+                compared.append(bit_pos)
+            skipped += n_dcols - np.count_nonzero(changed)
+            dc_data[bit_pos] = ([data.tobytes() for data in self._get_dc_bitstreams(mask)], changed)
+            matrix_in_bits[:, :, 7-bit_pos] = mask
+
+        # Double columns with the same data are written together, loading all bits which get this data.
+        dc_groups = {}
+        for dcol in range(n_dcols):
+            for data in set(dc_data[bit_pos][0][dcol] for bit_pos in masks if dc_data[bit_pos][1][dcol]):
+                bit_positions = tuple(bit_pos for bit_pos in masks if dc_data[bit_pos][0][dcol] == data)
+                dc_groups.setdefault((data, bit_positions), []).append(dcol)
+
+        pixel_conf = np.reshape(np.packbits(matrix_in_bits), (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"]))
+        return {"bit": bit, "masks": masks, "overwrite": overwrite, "base": base, "compared": compared,
+                "dc_groups": dc_groups, "skipped": skipped, "pixel_conf": pixel_conf}
+
+    def _is_plan_valid(self, plan, bit, masks, overwrite):
+        """
+        Checks if a plan from prepare_pixel_masks() was made for these masks and the current pixel configuration.
+        """
+        if plan["bit"] != bit or plan["overwrite"] != overwrite:
+            return False
+        if plan["base"] is not self.PIXEL_CONF[bit] and not np.array_equal(plan["base"], self.PIXEL_CONF[bit]):
+            return False
+        # Only compared to the pixel configuration if it is known to be on the chip.
+        if overwrite and any((bit, bit_pos) not in self._pixel_conf_valid for bit_pos in plan["compared"]):
+            return False
+        return plan["masks"].keys() == masks.keys() and all(np.array_equal(plan["masks"][bit_pos], np.asarray(mask, dtype=bool)) for bit_pos, mask in masks.items())
+
+    def _get_dc_bitstreams(self, mask):
+        """
+        Returns the CONF_DC data (bytes) of all double columns for a mask, as an array of dimensions "number of double columns X bytes".
+        Same as CONF_DC.tobytes() with Col0 = mask[2*dcol+1, :] and Col1 = mask[2*dcol, ::-1].
+        """
+        dc_mask = np.reshape(np.asarray(mask, dtype=bool), (self.chip_props["COL_SIZE"] // 2, 2, self.chip_props["ROW_SIZE"]))
+        # Shifted in: the even column from the first row on, then the odd column from the last row on.
+        return np.packbits(np.concatenate((dc_mask[:, 0, :], dc_mask[:, 1, ::-1]), axis=1), axis=1)
+
+    def _write_dc_bitstreams(self, bit, dc_groups):
+        """
+        Writes CONF_DC data to the pixel matrix.
+
+        Parameters
+        ----------
+        bit: string
+            A string with the name of the mask to be modified in the pixel configuration.
+        dc_groups: dict
+            Tuples of CONF_DC data (bytes) and the positions of the bits to be loaded as keys,
+            lists of double columns to be written with this data as values.
+        """
+        spi_dc = self[self['CONF_DC']._conf['hw_driver']]
+        for (data, bit_positions), dcols in dc_groups.items():
+            # Enable the corresponding "...Ld" register (Active Low)
+            for bit_pos in bit_positions:
+                self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 0
+            self['CONF_SR']['EnSRDCol'].setall(False)
+            for dcol in dcols:
+                self['CONF_SR']['EnSRDCol'][int(dcol)] = 1
+            #Data going to the global configuration
+            self['CONF']['En_Cnfg_Pix'] = 0
+            self._write_reg('CONF')
+            self._write_reg('CONF_SR')
+            # Upload the data for the matrix while the global configuration is shifted in.
+            if self._shadow.get('CONF_DC') != data:
+                spi_dc.set_data(array('B', data))
+                self._shadow['CONF_DC'] = data
+            self._wait_ready('CONF_SR')
+            # Data going to the matrix
+            self['CONF']['En_Cnfg_Pix'] = 1
+            self._write_reg('CONF')
+            spi_dc.start()
+            self.write_stats["CONF_DC"]["issued"] += 1
+            self._wait_ready('CONF_DC')
+            for bit_pos in bit_positions:
+                self['CONF_SR']["{0:s}Ld".format(bit)][bit_pos] = 1
+        self['CONF_SR']['EnSRDCol'].setall(False)
+        self['CONF']['En_Cnfg_Pix'] = 0
+        self._write_reg('CONF')
+
+    def _wait_ready(self, reg):
+        while not self[reg].is_ready:
+            time.sleep(0.001)
+
+    def _track_writes(self, reg):
+        """
+        Keeps the shadow of a register up to date on every write, also when it is written directly (e.g. self['CONF'].write()).
+        """
+        write = self[reg].write
+
+        def tracked_write(*args, **kwargs):
+            write(*args, **kwargs)
+            self._shadow[reg] = self[reg].tobytes()
+            self.write_stats[reg]["issued"] += 1
+            if reg == 'CONF_DC':
+                # Pixels written outside of _write_pixel_masks, PIXEL_CONF does not match the chip anymore.
+                self._pixel_conf_valid.clear()
+
+        self[reg].write = tracked_write
+
+    def _write_reg(self, reg):
+        """
+        Writes a register ("CONF" or "CONF_SR") only if its content differs from the last written one.
+        """
+        if self._shadow.get(reg) == self[reg].tobytes():
+            self.write_stats[reg]["skipped"] += 1
         else:
-            ###self.PIXEL_CONF[bit] = mask
-            matrix_in_bits[:, :, 7-bit_pos]=mask
-            pixconf_exchanged_bit= np.reshape(np.packbits(matrix_in_bits),(self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"]))
-            self.PIXEL_CONF[bit] = pixconf_exchanged_bit
+            self[reg].write()
+
+    def _invalidate_shadow(self):
+        """
+        Forgets the shadow of all registers, pixel configurations and GPAC set-points. The next writes will be issued.
+        """
+        self._shadow.clear()
+        self._pixel_conf_valid.clear()
+
+    def get_write_stats(self, log=False):
+        """
+        Returns the number of issued and skipped (unchanged) writes for every register.
+
+        Parameters
+        ----------
+        log: boolean
+            A flag to determine if the write statistics are logged.
+
+        Returns
+        ----------
+        write_stats: dict
+            Dictionary with the number of issued and skipped writes of "CONF", "CONF_SR", "CONF_DC" (double columns) and "GPAC" (set-points).
+        """
+        write_stats = {reg: dict(stats) for reg, stats in self.write_stats.items()}
+        if log==True:
+            self.logger.info("Register writes: {0:s}".format(str(write_stats)))
+        return write_stats
 
     def create_shift_pattern(self, step):
         """ Creates "classic" shift pattern for injection mask
@@ -775,7 +928,7 @@ class Monopix2(Dut):
             raise TypeError("You have not specified a valid input for mask creation. Please check the code documentation.")
         return mask
 
-    def set_preamp_en(self, pix="all", EnColRO="auto", Out='autoCMOS', overwrite=False):
+    def set_preamp_en(self, pix="all", EnColRO="auto", Out='autoCMOS', overwrite=False, plan=None):
         #TODO: Check after write_pixel_mask
         mask = self._create_mask(pix)
         if EnColRO == "auto":
@@ -809,7 +962,7 @@ class Monopix2(Dut):
             elif ('auto' not in Out):
                 self['CONF_SR']['EnDataLVDS'] = 1
 
-        self._write_pixel_mask(bit="EnPre", mask=mask, overwrite=overwrite)
+        self._write_pixel_mask(bit="EnPre", mask=mask, overwrite=overwrite, plan=plan)
         
         """
         self['CONF']['Rst'] = 1
@@ -819,7 +972,7 @@ class Monopix2(Dut):
         self['CONF'].write()
         """
 
-    def set_mon_en(self, pix="none", overwrite=False):
+    def set_mon_en(self, pix="none", overwrite=False, plan=None):
         """
         Creates a mask based on the pixels given as parameter and writes it to the chip in order to enable MONITOR.
 
@@ -833,17 +986,19 @@ class Monopix2(Dut):
                 - A list of pixels: e.g. pix=[[20,60],[20,61],[20,62]]
         overwrite: boolean
             A flag to determine if the current pixel configuration bits mask should be overwritten by the one given as input.
+        plan: dict or None
+            The result of prepare_pixel_masks() for the mask, e.g. prepared during the previous mask step.
         """   
         mask = self._create_mask(pix)
         self['CONF_SR']['EnMonitorCol'].setall(False)
         for i in range(self.chip_props["COL_SIZE"]):
             self['CONF_SR']['EnMonitorCol'][i] = bool(np.any(mask[i,:]))
-        self._write_pixel_mask(bit="EnMonitor", mask=mask, overwrite=overwrite)
+        self._write_pixel_mask(bit="EnMonitor", mask=mask, overwrite=overwrite, plan=plan)
       
         arg = np.argwhere(self.PIXEL_CONF["EnMonitor"][:, :])
         self.logger.debug("Enabling Monitor for {0:d} pixels:  {1:s}".format(len(arg), str(arg).replace("\n", " ")))
 
-    def set_inj_en(self, pix="none", overwrite=False):
+    def set_inj_en(self, pix="none", overwrite=False, plan=None):
         """
         Creates a mask based on the pixels given as parameter and writes it to the chip in order to enable INJECTION.
 
@@ -857,19 +1012,20 @@ class Monopix2(Dut):
                 - A list of pixels: e.g. pix=[[20,60],[20,61],[20,62]]
         overwrite: boolean
             A flag to determine if the current pixel configuration bits mask should be overwritten by the one given as input.
+        plan: dict or None
+            The result of prepare_pixel_masks() for the mask, e.g. prepared during the previous mask step.
         """   
         mask = self._create_mask(pix)
         self['CONF_SR']['InjEnCol'].setall(True)
         for i in range(self.chip_props["COL_SIZE"]):
             # The mask is negative as InjEnCol is active Low, unlike EnColRO or EnMonitorCol
             self['CONF_SR']['InjEnCol'][i] = not bool(np.any(mask[i,:]))
-        self._write_pixel_mask(bit="EnInj",mask=mask, overwrite=overwrite)
+        self._write_pixel_mask(bit="EnInj",mask=mask, overwrite=overwrite, plan=plan)
         
         arg = np.argwhere(self.PIXEL_CONF["EnInj"][:,:])
         self.logger.debug("Enabling Injection for {0:d} pixels: {1:s}".format(len(arg), str(arg).replace("\n", " ")))
         
     def set_tdac(self, tdac, overwrite=False):
-        #TODO: Maybe better to make this function write all the bit masks only after all four have been changed, and not one by one. 
         """
         Writes the 4-bit mask of trim values to the whole pixel matrix.
 
@@ -890,11 +1046,9 @@ class Monopix2(Dut):
 
         # Unpack the mask as 8 different masks, where the first 4 masks correspond to the 4 Trim bits.
         trim_bits = np.unpackbits(mask)
-        trim_bits_array = np.reshape(trim_bits, (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"], 8)).astype(np.bool)
-        # Write the mask for every trim bit.
-        for bit in range(4):
-            trim_bits_sel_mask = trim_bits_array[:, :, 7-bit]
-            self._write_pixel_mask(bit='Trim', mask=trim_bits_sel_mask, bit_pos=bit, overwrite=overwrite)
+        trim_bits_array = np.reshape(trim_bits, (self.chip_props["COL_SIZE"], self.chip_props["ROW_SIZE"], 8)).astype(bool)
+        # Write the masks of all trim bits in one pass.
+        self._write_pixel_masks(bit='Trim', masks={bit: trim_bits_array[:, :, 7-bit] for bit in range(4)}, overwrite=overwrite)
 
     def get_conf_sr(self, mode='mwr'):
         #TODO: Check if this is properly implemented
@@ -942,33 +1096,36 @@ class Monopix2(Dut):
         """  
         return self['fifo'].get_data()
 
-    def get_data(self, wait=0.05):
+    def get_data(self, wait=0.05, callback=None):
         """
         Returns data on the FIFO generated by injected pulses.
-        
+
         Parameters
         ----------
         wait: float
             Period of time (in seconds) between the last injection and read-out of the last batch of data.
-        
+        callback: function or None
+            If given, every FIFO read is passed to callback as it arrives instead of being collected.
+
         Return
         ----------
-        raw: numpy.ndarray 
-            Read-out data
-        """  
+        raw: numpy.ndarray
+            Read-out data (empty if a callback is given)
+        """
         self["inj"].start()
         i = 0
-        raw = np.empty(0,dtype='uint32')
+        chunks = []
+        if callback is None:
+            callback = chunks.append
         while self["inj"].is_done() != 1:
             time.sleep(0.001)
-            raw = np.append(raw, self['fifo'].get_data())
+            callback(self['fifo'].get_data())
             i = i+1
             if i > 10000:
                 break
-        for i in range(10):
-            pass
         time.sleep(wait)
-        raw = np.append(raw, self['fifo'].get_data())
+        callback(self['fifo'].get_data())
+        raw = np.concatenate(chunks) if len(chunks) > 0 else np.empty(0, dtype='uint32')
         if i > 10000:
             self.logger.info("get_data: error timeout len={0:d}".format(len(raw)))
         lost_cnt = self["data_rx"]["LOST_COUNT"]
@@ -997,18 +1154,18 @@ class Monopix2(Dut):
             self['CONF']['Rst'] = 0
 
         self['CONF']['ResetBcid'] = 1
-        self['CONF'].write()
+        self._write_reg('CONF')
 
         if not bcid_only:
             time.sleep(wait)
             self['CONF']['Rst'] = 0
-            self['CONF'].write()
+            self._write_reg('CONF')
         else:
             pass
         time.sleep(wait)
 
         self['CONF']['ResetBcid'] = 0
-        self['CONF'].write()
+        self._write_reg('CONF')
 
     def set_monoread(self, start_freeze=90, start_read=90+2, stop_read=90+2+2,
                      stop_freeze=90+40, stop=90+40+24, read_shift=(27+4)*2,
@@ -1088,7 +1245,7 @@ class Monopix2(Dut):
         self['CONF']['ResetBcid'] = 1
         self['CONF']['ClkOut'] = 0
         self['CONF']['ClkBX'] = 0
-        self['CONF'].write()
+        self._write_reg('CONF')
         return lost_cnt
 
     def set_tlu(self,tlu_delay=8):
@@ -1210,6 +1367,8 @@ class Monopix2(Dut):
             for i in np.arange(200,-200,-2):
                 self["NTC"].set_current(i,unit="uA")
                 self.SET_VALUE["NTC"]=i
+                self._shadow["NTC"]=i
+                self.write_stats["GPAC"]["issued"] += 1
                 time.sleep(0.1)
                 vol=self["NTC"].get_voltage()
                 if vol>0.7 and vol<1.3:
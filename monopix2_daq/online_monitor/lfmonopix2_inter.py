@@ -1,35 +1,35 @@
+import logging
+import pickle
+import time
+
 import numpy as np
+import zmq
 from numba import njit
 
 from online_monitor.converter.transceiver import Transceiver
 from online_monitor.utils import utils
 
-from monopix2_daq.analysis.interpreter import RawDataInterpreter
+from monopix2_daq.analysis.interpreter import RawDataInterpreter, has_open_sequence, hit_dtype
 from monopix2_daq.analysis import analysis_utils as au
 
-# copied from interpreter.py
-hit_dtype = [
-    ('col', 'u1'),
-    ('row', '<u2'),
-    ('le', 'u1'),
-    ('te', 'u1'),
-    ('cnt', '<u4'),
-    ('timestamp', '<i8'),
-    ('scan_param_id', '<i4'),
-]
 
+@njit(cache=True)
+def hist_occupancy(occ, tot, tot_all, hits):
+    ''' Fill the pixel hits (cnt < 2) into the occupancy map, the ToT cube and the ToT histogram of all pixels
 
-# @njit(cache=True)
-def hist_occupancy(occ, tot, hits):
+        Returns the number of histogrammed hits.
+    '''
+    n_hits = 0
     for hit_i in range(hits.shape[0]):
-        if hits[hit_i]["col"] < occ.shape[0] and hits[hit_i]["row"] < occ.shape[1]:
-            occ[hits[hit_i]["col"], hits[hit_i]["row"]] += 1
-            tot[hits[hit_i]["col"], hits[hit_i]["row"], (hits[hit_i]["te"] - hits[hit_i]["le"]) & 0x3F] += 1
-
-        # if pix[0] == 0xFFFF and pix[1] == 0xFFFF:
-        #     tot[hits[hit_i]["tot"]] += 1
-        # if pix[0] == hits[hit_i]["col"] and pix[1] == hits[hit_i]["row"]:
-            # tot[hits[hit_i]["tot"]] += 1
+        col = hits[hit_i]["col"]
+        row = hits[hit_i]["row"]
+        if hits[hit_i]["cnt"] < 2 and col < occ.shape[0] and row < occ.shape[1]:
+            tot_value = (np.int32(hits[hit_i]["te"]) - np.int32(hits[hit_i]["le"])) & 0x3F
+            occ[col, row] += 1
+            tot[col, row, tot_value] += 1
+            tot_all[tot_value] += 1
+            n_hits += 1
+    return n_hits
 
 
 class LFMonopix2(Transceiver):
@@ -52,6 +52,19 @@ class LFMonopix2(Transceiver):
         # self.rx_id = int(self.config.get('rx', 'rx0')[2])
         # Mask pixels that have a higher occupancy than 3 * the median of all firering pixels
         self.noisy_threshold = self.config.get('noisy_threshold', 3)
+        # Maximum number of published frames per second (0: publish every readout).
+        # Readouts in between are histogrammed, but not sent.
+        self.max_refresh_rate = self.config.get('max_refresh_rate', 20.)
+        # Time between two complete occupancy maps, in between only changed pixels are sent if that is smaller
+        self.full_frame_interval = self.config.get('full_frame_interval', 2.)
+        self.ts_last_publish = 0.
+        self.ts_last_full_frame = 0.
+        # Readouts histogrammed but not published yet, they are published when the refresh interval expired,
+        # also if no more data arrives (recv_data queues None to trigger the publish). The request is repeated
+        # if it was not handled within a refresh interval, it is omitted if too many messages are queued (max_buffer).
+        self.publish_pending = False
+        self.ts_publish_request = 0.
+        self.last_meta_data = None
 
         self.mask_noisy_pixel = False
         self.pix_col = None
@@ -70,13 +83,44 @@ class LFMonopix2(Transceiver):
         self.hps = 0.  # Hits per second
         # self.trigger_id = -1  # Last chunk trigger id
         # self.ext_trg_num = -1  # external trigger number
-        self.last_rawdata = None  # Leftover from last chunk
+        self.last_index_stop = None  # Raw data index after the last received readout
 
+        # Incomplete hits (word sequences) are continued with the next readout
         self.interpreter = RawDataInterpreter()
+        # Reused for every readout, grows if a readout has more words
+        self.hit_buffer = np.zeros(shape=self.chunk_size, dtype=hit_dtype)
+
+    def recv_data(self):
+        ''' Receives all frames of a message without copying them, see Transceiver.recv_data '''
+        while not self.fe_stop.is_set():
+            self.fe_poller.poll(1)  # max block 1 ms
+            raw_data = []
+            # Loop over all frontends
+            for actual_frontend in self.frontends:
+                try:
+                    frames = actual_frontend[1].recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                    raw_data.append((actual_frontend[0], self.deserialize_data(frames)))
+                except zmq.Again:  # no data
+                    pass
+            if raw_data:
+                self.raw_data.put_nowait(raw_data)
+            elif self.publish_pending:
+                now = time.time()
+                if now - max(self.ts_last_publish, self.ts_publish_request) >= 1. / self.max_refresh_rate:
+                    self.ts_publish_request = now
+                    self.raw_data.put_nowait(None)
 
     def deserialize_data(self, data):
-        ''' Inverse of LF-Monopix2 serialization '''
-        return utils.simple_dec(data)
+        ''' Inverse of LF-Monopix2 serialization
+
+            Either one frame (scan_base.send_data) or a meta data frame and a raw data frame (scan_base.send_data_multipart).
+            The raw data of the latter is not copied.
+        '''
+        if len(data) == 1:
+            return utils.simple_dec(data[0].bytes)
+        meta_data = pickle.loads(data[0].bytes)
+        raw_data = np.frombuffer(data[1].buffer, dtype=meta_data.pop('dtype')).reshape(meta_data.pop('shape'))
+        return raw_data, meta_data
 
     def _add_to_meta_data(self, meta_data):
         ''' Meta data interpratation is deducing timings '''
@@ -98,47 +142,105 @@ class LFMonopix2(Transceiver):
         meta_data.update(
             {'fps': self.fps,
              'hps': self.hps,
-             'total_hits': self.total_hits})
+             'total_hits': self.total_hits,
+             'dropped_words': self.dropped_words,
+             'error_words': self.error_words,
+             'partial_hits': self.partial_hits})
         return meta_data
 
+    def _check_continuity(self, meta_data):
+        ''' Detects readouts which were not received (e.g. dropped by the sender at high rates)
+
+            An incomplete hit from the last readout cannot be continued after a gap, it is discarded.
+        '''
+        index_start, index_stop = meta_data.get('index_start'), meta_data.get('index_stop')
+        if index_start is None or index_stop is None:
+            return
+        if self.last_index_stop is not None and index_start != self.last_index_stop:
+            if has_open_sequence(self.interpreter.get_state()):
+                self.partial_hits += 1
+            self.interpreter.reset()
+            if index_start > self.last_index_stop:
+                self.dropped_words += index_start - self.last_index_stop
+                logging.warning('%d raw data words not received', index_start - self.last_index_stop)
+        self.last_index_stop = index_stop
+
     def interpret_data(self, data):
-        ''' Called for every chunk received '''
+        ''' Called for every chunk received, and with None to publish the readouts held back by the rate limit '''
+        if data is None:
+            if not self.publish_pending:
+                return None
+            return self._publish(self.last_meta_data, reset=False)
+
         raw_data, meta_data = data[0][1]
+        self._check_continuity(meta_data)
+
+        # A readout never gives more hits than words
+        if self.hit_buffer.shape[0] < raw_data.shape[0]:
+            self.hit_buffer = np.zeros(shape=max(raw_data.shape[0], 2 * self.hit_buffer.shape[0]), dtype=hit_dtype)
+        error_cnt = self.interpreter.get_error_count()
+        hits = self.interpreter.interpret(raw_data, None, self.hit_buffer)  # No meta_data needed for online_monitor
+        self.error_words += self.interpreter.get_error_count() - error_cnt
+
+        n_hits = hist_occupancy(self.hist_occ, self.hist_tot, self.hist_tot_all, hits)
+        self.hits_last_readout = n_hits
+        self.total_hits += n_hits
+        self.readout += 1
         meta_data = self._add_to_meta_data(meta_data)
+        self.last_meta_data = meta_data
 
-        # hit_buffer = np.zeros(4 * len(raw_data), dtype=au.hit_dtype)
-        hit_buffer = np.zeros(shape=self.chunk_size, dtype=hit_dtype)
-        hits = self.interpreter.interpret(raw_data, None, hit_buffer)  # No meta_data needed for online_monitor
-        hits = hits[np.logical_and(hits['cnt'] < 2, hits['col'] < 60)]
+        # The histograms are reset after this readout, the integrated data has to be published
+        reset = self.int_readouts != 0 and self.readout % self.int_readouts == 0  # = 0 for infinite integration
 
-        self.hits_last_readout = len(hits)
-        self.total_hits += len(hits)
-        self.readout += 1
+        if not reset and self.max_refresh_rate > 0 and time.time() - self.ts_last_publish < 1. / self.max_refresh_rate:
+            self.publish_pending = True
+            return None
+        return self._publish(meta_data, reset)
+
+    def _publish(self, meta_data, reset):
+        ''' Histograms and meta data of the last readout to be sent, the histograms are reset afterwards if reset is set '''
+        now = time.time()
+        self.ts_last_publish = now
+        self.publish_pending = False
 
-        hist_occupancy(self.hist_occ, self.hist_tot, hits)
-        occupancy_hist = self.hist_occ[:, :]
+        interpreted_data = self._get_published_hists(now)
+        interpreted_data['meta_data'] = meta_data
+
+        if reset:
+            self.reset_hists()
+
+        return [interpreted_data]
+
+    def _get_published_hists(self, now):
+        ''' Occupancy and ToT histogram to be sent to the receiver
+
+            The occupancy is sent as changed pixels (flat indices and values) since the last published frame,
+            if that is smaller than the complete map and a complete map was sent recently.
+        '''
+        occupancy_hist = self.hist_occ
         # Mask Noisy pixels
         if self.mask_noisy_pixel:
             sel = occupancy_hist > self.noisy_threshold * np.median(occupancy_hist[occupancy_hist > 0])
-            occupancy_hist[sel] = 0
+            occupancy_hist = np.where(sel, 0, occupancy_hist)
 
         # Select individual pixel for ToT plotting
         if self.pix_col is None or self.pix_row is None:
-            tot_hist = self.hist_tot.sum(axis=(0, 1))
+            tot_hist = self.hist_tot_all
         else:
             tot_hist = self.hist_tot[int(self.pix_col), int(self.pix_row), :]
 
-        interpreted_data = {
-            'meta_data': meta_data,
-            'occupancy': occupancy_hist,
-            'tot_hist': tot_hist,  # self.hist_tot.sum(axis=(0, 1)),
-        }
-
-        if self.int_readouts != 0:  # = 0 for infinite integration
-            if self.readout % self.int_readouts == 0:
-                self.reset_hists()
-
-        return [interpreted_data]
+        hists = {'tot_hist': tot_hist}
+        if self.published_occ is not None and now - self.ts_last_full_frame < self.full_frame_interval:
+            changed = np.flatnonzero(occupancy_hist != self.published_occ).astype(np.uint32)
+            if changed.nbytes + changed.shape[0] * occupancy_hist.itemsize < occupancy_hist.nbytes:
+                values = occupancy_hist.ravel()[changed]
+                self.published_occ.ravel()[changed] = values
+                hists['occupancy_delta'] = (changed, values)
+                return hists
+        self.published_occ = occupancy_hist.copy()
+        self.ts_last_full_frame = now
+        hists['occupancy'] = occupancy_hist
+        return hists
 
     def serialize_data(self, data):
         ''' Serialize data from interpretation '''
@@ -155,6 +257,7 @@ class LFMonopix2(Transceiver):
                 self.mask_noisy_pixel = False
             else:
                 self.mask_noisy_pixel = True
+            self.published_occ = None
         elif 'COL' in command[0]:
             if '-1' in command[0]:
                 self.pix_col = None
@@ -171,8 +274,15 @@ class LFMonopix2(Transceiver):
     def reset_hists(self):
         ''' Reset the histograms '''
         self.total_hits = 0
+        # Words lost between readouts, words not belonging to a valid hit and hits discarded because of lost words
+        self.dropped_words = 0
+        self.error_words = 0
+        self.partial_hits = 0
         # Readout number
         self.readout = 0
+        # Occupancy as known by the receiver, None: next publish is a complete map
+        self.published_occ = None
 
-        self.hist_tot = np.zeros((56, 340, 64), dtype=np.int64)
+        self.hist_tot = np.zeros((56, 340, 64), dtype=np.uint32)
+        self.hist_tot_all = np.zeros(64, dtype=np.int64)  # ToT histogram of all pixels, filled together with hist_tot
         self.hist_occ = np.zeros((56, 340), dtype=np.int64)
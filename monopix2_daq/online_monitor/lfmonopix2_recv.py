@@ -14,6 +14,7 @@ class LFMonopix2(Receiver):
         self.occupancy_data = None
         self.tot_data = None
         self.tdc_data = None
+        self.new_data = False  # plots are only updated if new data was received
         # We want to change converter settings
         self.set_bidirectional_communication()
 
@@ -133,9 +134,14 @@ class LFMonopix2(Receiver):
             self.plot.getViewBox().invertY(True)
 
     def handle_data(self, data):
-        # Hist data
-        self.occupancy_data = data['occupancy']
+        # Hist data, the converter sends either the complete occupancy or the changed pixels
+        if 'occupancy' in data:
+            self.occupancy_data = data['occupancy']
+        elif self.occupancy_data is not None:
+            changed, values = data['occupancy_delta']
+            self.occupancy_data.ravel()[changed] = values
         self.tot_data = data['tot_hist']
+        self.new_data = True
         # self.tdc_data = data['tdc_hist']
         
         # Meta data
@@ -150,6 +156,10 @@ class LFMonopix2(Receiver):
         self.plot_delay_label.setText("Plot Delay\n%s" % 'not realtime' if abs(self.plot_delay) > 5 else "Plot Delay\n%1.2f ms" % (self.plot_delay * 1.e3))
 
     def refresh_data(self):
+        self._update_inverted_axis()
+        if not self.new_data:
+            return
+        self.new_data = False
 
         if self.occupancy_data is not None:
             self.occupancy_img.setImage(self.occupancy_data[:, :], autoDownsample=True)
@@ -162,4 +172,3 @@ class LFMonopix2(Receiver):
                                   y=self.tdc_data,
                                   stepMode='center',
                                   fillLevel=0, brush=(0, 0, 255, 150))
-        self._update_inverted_axis()
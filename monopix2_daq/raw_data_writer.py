@@ -0,0 +1,230 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from time import time
+
+import numpy as np
+import tables as tb
+
+
+class RawDataWriter(object):
+    '''
+    Collects readout chunks and writes raw data and meta data to the h5 file in bulk.
+
+    The chunks are copied into a preallocated buffer (so views, e.g. from the FIFO ring buffer, can be passed)
+    and written together with their meta data rows when the buffer is full or the last write is older than the
+    given interval. Every chunk still gets its own meta data row, the content of the file is the same as
+    when writing every chunk separately.
+    '''
+
+    def __init__(self, raw_data_earray, meta_data_table, buffer_size=4 * 1024 ** 2, interval=1.0, max_rows=10000):
+        '''
+        Parameters
+        ----------
+        raw_data_earray: tables.EArray
+            Raw data array (uint32) in the output file.
+        meta_data_table: tables.Table
+            Meta data table (scan_base.MetaTable) in the output file.
+        buffer_size: int
+            Size of the raw data buffer in bytes. The buffer is written when it is full.
+        interval: float
+            Maximum time (in seconds) between two writes. Checked when a chunk is added.
+        max_rows: int
+            Maximum number of meta data rows kept before writing.
+        '''
+        self.logger = logging.getLogger(name='RawDataWriter')
+        self.raw_data_earray = raw_data_earray
+        self.meta_data_table = meta_data_table
+        self.interval = interval
+        self._raw_buffer = np.empty(max(int(buffer_size) // 4, 1), dtype=np.uint32)
+        self._meta_buffer = np.zeros(int(max_rows), dtype=meta_data_table.dtype)
+        self._n_words = 0
+        self._n_rows = 0
+        self.total_words = raw_data_earray.nrows
+        self.n_writes = 0
+        self._last_write = time()
+
+    def append(self, data, timestamp_start, timestamp_stop, error, scan_param_id):
+        '''
+        Add one readout chunk and its meta data.
+
+        Returns
+        -------
+        index_start, index_stop: int
+            Position of the chunk in the raw data array.
+        '''
+        n_words = data.shape[0]
+        if self._n_words + n_words > self._raw_buffer.shape[0] or self._n_rows == self._meta_buffer.shape[0]:
+            self.write()
+
+        index_start = self.total_words
+        self.total_words += n_words
+        row = self._meta_buffer[self._n_rows]
+        row['index_start'] = index_start
+        row['index_stop'] = self.total_words
+        row['data_length'] = n_words
+        row['timestamp_start'] = timestamp_start
+        row['timestamp_stop'] = timestamp_stop
+        row['scan_param_id'] = scan_param_id
+        row['error'] = error
+        self._n_rows += 1
+
+        if n_words > self._raw_buffer.shape[0]:  # chunk larger than the buffer, buffer is empty here
+            self.raw_data_earray.append(data)
+            self.write()
+        else:
+            self._raw_buffer[self._n_words:self._n_words + n_words] = data
+            self._n_words += n_words
+            if self._n_words == self._raw_buffer.shape[0] or time() - self._last_write >= self.interval:
+                self.write()
+        return index_start, self.total_words
+
+    def write(self):
+        '''
+        Write and flush the collected raw data and meta data.
+        '''
+        if self._n_rows == 0:
+            return
+        if self._n_words > 0:
+            self.raw_data_earray.append(self._raw_buffer[:self._n_words])
+        self.raw_data_earray.flush()
+        self.meta_data_table.append(self._meta_buffer[:self._n_rows])
+        self.meta_data_table.flush()
+        self.n_writes += 1
+        self._n_words = 0
+        self._n_rows = 0
+        self._last_write = time()
+
+    def close(self):
+        self.write()
+
+
+class RawDataWriterProcess(object):
+    '''
+    Runs a RawDataWriter in a child process, which owns the h5 file during the readout.
+
+    Chunks are copied into a shared memory ring buffer and only their position and meta data are sent to the
+    child process, so PyTables I/O and compression do not compete with the readout thread for the GIL.
+    Chunks which do not fit into the free part of the shared memory are sent through the queue instead.
+    The file must not be opened by the main process until close() returned.
+    '''
+
+    def __init__(self, filename, buffer_size=4 * 1024 ** 2, interval=1.0, shm_size=64 * 1024 ** 2):
+        '''
+        Parameters
+        ----------
+        filename: string
+            Output h5 file, which already contains the raw_data array and the meta_data table.
+        buffer_size: int
+            Write buffer size in bytes of the RawDataWriter in the child process.
+        interval: float
+            Maximum time (in seconds) between two writes.
+        shm_size: int
+            Size of the shared memory in bytes.
+        '''
+        self.logger = logging.getLogger(name='RawDataWriter')
+        self.size = shm_size // 4
+        with tb.open_file(filename, mode='r') as h5_file:
+            self.total_words = h5_file.root.raw_data.nrows
+        ctx = multiprocessing.get_context('spawn')
+        self._shm = shared_memory.SharedMemory(create=True, size=self.size * 4)
+        self._buffer = np.ndarray(self.size, dtype=np.uint32, buffer=self._shm.buf)
+        self._written = 0  # words written to the shared memory, including unused words at the end when wrapping around
+        self._released = ctx.RawValue('Q', 0)  # words released by the child process
+        self._queue = ctx.Queue()
+        self.spills = 0
+        self._process = ctx.Process(target=_writer_process, name='RawDataWriterProcess',
+                                    args=(filename, self._shm.name, self.size, self._queue, self._released, buffer_size, interval))
+        self._process.start()
+
+    def append(self, data, timestamp_start, timestamp_stop, error, scan_param_id):
+        '''
+        Hand one readout chunk to the child process.
+
+        Returns
+        -------
+        index_start, index_stop: int
+            Position of the chunk in the raw data array.
+        '''
+        if self._shm is None:
+            raise RuntimeError('RawDataWriterProcess is closed')
+        n_words = data.shape[0]
+        index_start = self.total_words
+        self.total_words += n_words
+        meta = (timestamp_start, timestamp_stop, error, scan_param_id)
+        pos = self._written % self.size
+        if pos + n_words <= self.size:
+            start, extent = pos, n_words
+        else:
+            start, extent = 0, self.size - pos + n_words
+        if self._written + extent - self._released.value <= self.size:
+            self._buffer[start:start + n_words] = data
+            self._written += extent
+            self._queue.put(('shm', (start, n_words, extent), meta))
+        else:
+            self._queue.put(('array', np.array(data), meta))
+            self.spills += 1
+        return index_start, self.total_words
+
+    def write(self):
+        '''
+        Ask the child process to write and flush the collected data. Does not wait.
+        '''
+        self._queue.put(('write', None, None))
+
+    def close(self, timeout=None):
+        '''
+        Write the remaining data, close the file and stop the child process. Does nothing if already closed.
+        '''
+        if self._shm is None:
+            return
+        if self._process.is_alive():
+            self._queue.put(None)
+            self._process.join(timeout)
+        if self._process.is_alive():
+            self.logger.error('Writer process did not stop, terminating')
+            self._process.terminate()
+            self._process.join()
+        elif self._process.exitcode != 0:
+            self.logger.error('Writer process failed with exit code %s', self._process.exitcode)
+        if self._process.exitcode != 0:
+            self._queue.cancel_join_thread()  # Chunks not received by the child process are lost, do not block at exit
+        self._queue.close()
+        if self.spills > 0:
+            self.logger.warning('Shared memory full: %d chunk(s) sent through the queue', self.spills)
+        self._buffer = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+
+def _writer_process(filename, shm_name, size, queue, released, buffer_size, interval):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = np.ndarray(size, dtype=np.uint32, buffer=shm.buf)
+    try:
+        with tb.open_file(filename, mode='a') as h5_file:
+            writer = RawDataWriter(h5_file.root.raw_data, h5_file.root.meta_data, buffer_size=buffer_size, interval=interval)
+            while True:
+                item = queue.get()
+                if item is None:
+                    writer.close()
+                    break
+                cmd, data, meta = item
+                if cmd == 'shm':
+                    start, n_words, extent = data
+                    writer.append(buffer[start:start + n_words], *meta)  # copied by the writer
+                    released.value += extent
+                elif cmd == 'array':
+                    writer.append(data, *meta)
+                elif cmd == 'write':
+                    writer.write()
+    finally:
+        del buffer
+        shm.close()
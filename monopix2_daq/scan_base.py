@@ -1,4 +1,5 @@
 import os,sys,time
+import pickle
 import numpy as np
 from numpy.core.defchararray import array
 import bitarray
@@ -10,6 +11,7 @@ import zmq
 
 from monopix2_daq import monopix2
 from monopix2_daq.fifo_readout import FifoReadout
+from monopix2_daq.raw_data_writer import RawDataWriter, RawDataWriterProcess
 from contextlib import contextmanager
 from monopix2_daq.analysis import analysis_utils as au
 
@@ -42,6 +44,72 @@ def send_data(socket, data, scan_param_id, index_start, index_stop, data_length,
     except zmq.Again:
         pass
 
+
+def send_data_multipart(socket, data, scan_param_id, index_start, index_stop, data_length, copy=False, name='ReadoutData'):
+    '''
+    Sends the data of every read out via ZeroMQ as a two-part message, same content as send_data.
+
+    The first frame is the pickled meta data dict, including dtype and shape of the raw data.
+    The second frame is the raw data buffer itself, sent without copying it (copy=False), so the
+    array must not be changed afterwards (use copy=True for views into reused buffers).
+    See deserialize_data of the online monitor converter (LFMonopix2) for the decoding.
+    '''
+    raw_data = np.ascontiguousarray(data[0])
+    header = dict(
+        index_start=index_start,
+        index_stop=index_stop,
+        data_length=data_length,
+        timestamp_start=data[1],
+        timestamp_stop=data[2],
+        scan_param_id=scan_param_id,
+        error=data[3],
+        dtype=raw_data.dtype.str,
+        shape=raw_data.shape
+    )
+
+    try:
+        socket.send(pickle.dumps(header), flags=zmq.SNDMORE | zmq.NOBLOCK)
+        socket.send(raw_data, flags=zmq.NOBLOCK, copy=copy)
+    except zmq.Again:
+        pass
+
+
+def benchmark_send_data(n_words=2 ** 26, chunk_size=2 ** 16):
+    '''
+    Compare the CPU time (sender and receiver, in s/MB raw data) of send_data (simple_enc) and send_data_multipart
+    by sending random raw data through a local PUB/SUB socket pair.
+    '''
+    context = zmq.Context.instance()
+    raw_data = np.random.randint(0, 2 ** 32, n_words, dtype=np.uint64).astype(np.uint32)
+    chunks = [raw_data[i:i + chunk_size].copy() for i in range(0, n_words, chunk_size)]
+    results = {}
+    for name, send in (('simple_enc', send_data), ('multipart', send_data_multipart)):
+        pub = context.socket(zmq.PUB)
+        sub = context.socket(zmq.SUB)
+        pub.setsockopt(zmq.SNDHWM, 0)
+        sub.setsockopt(zmq.RCVHWM, 0)
+        port = pub.bind_to_random_port('tcp://127.0.0.1')
+        sub.connect('tcp://127.0.0.1:%d' % port)
+        sub.setsockopt(zmq.SUBSCRIBE, b'')
+        time.sleep(0.5)  # wait for the subscription
+
+        t0 = time.process_time()
+        index = 0
+        for chunk in chunks:
+            send(pub, (chunk, 0., 0., 0), scan_param_id=0, index_start=index, index_stop=index + chunk.shape[0], data_length=chunk.shape[0])
+            index += chunk.shape[0]
+            if name == 'simple_enc':
+                ou.simple_dec(sub.recv())
+            else:
+                frames = sub.recv_multipart(copy=False)
+                header = pickle.loads(frames[0].bytes)
+                np.frombuffer(frames[1].buffer, dtype=header['dtype']).reshape(header['shape'])
+        results[name] = (time.process_time() - t0) / (raw_data.nbytes / 1e6)
+        pub.close()
+        sub.close()
+        print('{0:12s} {1:8.3f} ms CPU / MB'.format(name, results[name] * 1e3))
+    return results
+
 class MetaTable(tb.IsDescription):
     index_start = tb.UInt32Col(pos=0)
     index_stop = tb.UInt32Col(pos=1)
@@ -118,7 +186,9 @@ class ScanBase(object):
 
         # Assign the socket where the data will be sent (For online monitoring)
         self.socket = self.configuration['bench']['module']['chip']['send_data']
+        self.send_multipart = self.configuration['bench']['module']['chip'].get('send_data_multipart', False)
         self.context = zmq.Context.instance()
+        self.raw_data_writer = None
             
         # Define filters for table output data
         self.filter_raw_data = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
@@ -165,6 +235,19 @@ class ScanBase(object):
         for name, value in self.monopix.PIXEL_CONF.items():
             self.h5_file.create_carray(self.pixel_masks_before, name=name, title=name, obj=value, filters=self.filter_raw_data)
         self.meta_data_table.attrs.firmware_before = yaml.dump(self.monopix.get_configuration())
+
+        # Raw data writer. In process mode the writer process owns the file until the scan is finished.
+        general_cfg = self.configuration['bench']['general']
+        self.writer_process = general_cfg.get('raw_data_writer_process', False)
+        if self.writer_process:
+            self.h5_file.close()
+            self.raw_data_writer = RawDataWriterProcess(filename,
+                                                        buffer_size=general_cfg.get('raw_data_write_size', 4 * 1024 ** 2),
+                                                        interval=general_cfg.get('raw_data_write_interval', 1.0))
+        else:
+            self.raw_data_writer = RawDataWriter(self.raw_data_earray, self.meta_data_table,
+                                                 buffer_size=general_cfg.get('raw_data_write_size', 4 * 1024 ** 2),
+                                                 interval=general_cfg.get('raw_data_write_interval', 1.0))
         
         # Open socket for the online monitor.
         if (self.socket==""): 
@@ -185,19 +268,32 @@ class ScanBase(object):
         self.logger.info('Power Status: %s', str(self.monopix.power_status()))
         self.logger.info('DAC Status: %s', str(self.monopix.dac_status()))
         self.monopix.show("none")
-        self.scan(**kwargs) 
-        self.fifo_readout.print_readout_status()
-        self.monopix.show("none")
-        self.logger.info('Power Status: %s', str(self.monopix.power_status()))
-        self.logger.info('DAC Status: %s', str(self.monopix.dac_status()))
-        
+        self.scan_data = {}  # Additional arrays of the scan, stored in the output file
+        try:
+            self.scan(**kwargs) 
+            self.fifo_readout.print_readout_status()
+            self.monopix.show("none")
+            self.logger.info('Power Status: %s', str(self.monopix.power_status()))
+            self.logger.info('DAC Status: %s', str(self.monopix.dac_status()))
+        finally:
+            # Write remaining data, also if the scan failed (the readout is stopped first, if the scan left it running)
+            if self.fifo_readout.is_running:
+                self.fifo_readout.stop()
+            self.raw_data_writer.close()
+
         # Save chip configurations
+        if self.writer_process:
+            self.h5_file = tb.open_file(filename, mode='a')
+            self.raw_data_earray = self.h5_file.root.raw_data
+            self.meta_data_table = self.h5_file.root.meta_data
         self.meta_data_table.attrs.power_status = yaml.dump(self.monopix.power_status())
         self.meta_data_table.attrs.dac_status = yaml.dump(self.monopix.dac_status())
         self.pixel_masks=self.h5_file.create_group(self.h5_file.root, 'pixel_conf', 'Pixel configuration at the end of the scan')
         for name, value in self.monopix.PIXEL_CONF.items():
             self.h5_file.create_carray(self.pixel_masks, name=name, title=name, obj=value, filters=self.filter_raw_data)
         self.meta_data_table.attrs.firmware = yaml.dump(self.monopix.get_configuration())
+        for name, value in self.scan_data.items():
+            self.h5_file.create_carray(self.h5_file.root, name=name, title=name, obj=value, filters=self.filter_tables)
 
         # Close file
         self.h5_file.close()
@@ -232,6 +328,7 @@ class ScanBase(object):
         """
         timeout = kwargs.pop('timeout', 10.0)
         self.fifo_readout.readout_interval=kwargs.pop('readout_interval', 0.003)
+        self.fifo_readout.adaptive_interval=kwargs.pop('adaptive_interval', False)
         if not self._first_read:
             time.sleep(0.1)
             self.fifo_readout.print_readout_status()
@@ -240,6 +337,7 @@ class ScanBase(object):
         self.start_readout(*args, **kwargs)
         yield
         self.fifo_readout.stop(timeout=timeout)
+        self.raw_data_writer.write()
 
     def start_readout(self, scan_param_id = 0, *args, **kwargs):
         """
@@ -259,34 +357,115 @@ class ScanBase(object):
         reset_sram_fifo = kwargs.pop('reset_sram_fifo', False)
         errback = kwargs.pop('errback', self.handle_err)
         no_data_timeout = kwargs.pop('no_data_timeout', None)
+        ring_buffer = kwargs.pop('ring_buffer', False)
         self.scan_param_id = scan_param_id
         self.fifo_readout.start(reset_sram_fifo=reset_sram_fifo, fill_buffer=fill_buffer, clear_buffer=clear_buffer, 
-                                callback=callback, errback=errback, no_data_timeout=no_data_timeout)
+                                callback=callback, errback=errback, no_data_timeout=no_data_timeout, ring_buffer=ring_buffer)
+
+    def clear_fifo(self, wait=0.002, max_resets=10):
+        """
+        Resets the FIFO to clear trash hits (e.g. after changing the pixel configuration).
+        The FIFO is reset again while new data arrives, at most max_resets times.
+
+        Parameters
+        ----------
+        wait: float
+            Time (in seconds) after every reset before checking for new data.
+        max_resets: int
+            Maximum number of resets.
+        """
+        for _ in range(max_resets):
+            self.monopix["fifo"]["RESET"]
+            time.sleep(wait)
+            if self.monopix["fifo"]["FIFO_SIZE"] == 0:
+                break
+
+    def inject_masks(self, mask_list, scan_param_id, with_mon=False, disable_noninjected_pixel=True, pbar=None, quiet_time=0.01, timeout=1.0):
+        """
+        Injects the pixels of every mask in mask_list (mask stepping), enabling only the pixels of the current mask.
+
+        The pixel configuration of the next mask is prepared while the hits of the current mask are read out.
+        The read-out of a mask stops as soon as no more data arrives, instead of after a fixed time.
+
+        Parameters
+        ----------
+        mask_list: list of numpy.ndarray
+            Masks of pixels to be injected together. Pixels outside of self.enable_mask are not injected.
+        scan_param_id: int
+            Scan parameter ID of the recorded data.
+        with_mon: boolean
+            A flag to enable the monitor of the first pixel of every mask.
+        disable_noninjected_pixel: boolean
+            A flag to determine if non-injected pixels are disabled while injecting.
+        pbar: tqdm or None
+            Progress bar, updated after every mask.
+        quiet_time: float
+            Time (in seconds) without new data after which the read-out of a mask is complete.
+        timeout: float
+            Maximum time (in seconds) to wait for the data of a mask after the injection.
+        """
+        masks = [np.logical_and(mask_i, self.enable_mask) for mask_i in mask_list]
+        # Skip masks with zero enabled pixels
+        steps = [mask_i for mask_i in masks if np.any(mask_i)]
+        if pbar is not None:
+            pbar.update(len(masks) - len(steps))
+        if len(steps) == 0:
+            return
+        plans = self._prepare_mask_step(steps[0], disable_noninjected_pixel)
+        for i, mask_i in enumerate(steps):
+            self.monopix.set_preamp_en("none", plan=plans["EnPre_none"])
+            self.logger.debug('Injecting: Mask {0:d} with {1:d} pixels, scan parameter ID {2:d}'.format(i, np.count_nonzero(mask_i), scan_param_id))
+
+            # Enable monitors and wait a bit, since the setting seems to couple into the CSA output
+            if with_mon:
+                monitor_pix = [int(np.argwhere(mask_i == True)[0][0]), int(np.argwhere(mask_i == True)[0][1])]
+                self.monopix.set_mon_en(monitor_pix, overwrite=True)
+                time.sleep(0.05)
+            self.monopix.set_inj_en(mask_i, overwrite=True, plan=plans["EnInj"])
+            if disable_noninjected_pixel:
+                self.monopix.set_preamp_en(mask_i, overwrite=True, plan=plans["EnPre"])
+
+            # Reset and clear trash hits before injecting.
+            self.clear_fifo()
+            # Inject pixels in the mask, prepare the next mask while the data is read out.
+            with self.readout(scan_param_id=scan_param_id, fill_buffer=False, clear_buffer=True, readout_interval=0.001, timeout=0):
+                self.monopix.start_inj()
+                if i + 1 < len(steps):
+                    next_plans = self._prepare_mask_step(steps[i + 1], disable_noninjected_pixel, previous=plans)
+                if not self.fifo_readout.wait_for_data(quiet_time=quiet_time, timeout=timeout):
+                    self.logger.warning('Data of mask {0:d} still arriving after {1:.2f} s'.format(i, timeout))
+            if i + 1 < len(steps):
+                plans = next_plans
+            if pbar is not None:
+                pbar.update(1)
+
+    def _prepare_mask_step(self, mask, disable_noninjected_pixel, previous=None):
+        '''
+        Prepares the pixel configuration writes of one mask step, following the writes of the previous step.
+        '''
+        plans = {}
+        after_pre = None if previous is None else previous["EnPre" if disable_noninjected_pixel else "EnPre_none"]
+        plans["EnPre_none"] = self.monopix.prepare_pixel_masks("EnPre", {0: np.zeros_like(mask)}, after=after_pre)
+        plans["EnInj"] = self.monopix.prepare_pixel_masks("EnInj", {0: mask}, overwrite=True, after=None if previous is None else previous["EnInj"])
+        if disable_noninjected_pixel:
+            plans["EnPre"] = self.monopix.prepare_pixel_masks("EnPre", {0: mask}, overwrite=True, after=plans["EnPre_none"])
+        return plans
 
     def handle_data(self, data_tuple):
         '''
-        Data handling.
+        Data handling. Raw data and meta data are written in bulk by the RawDataWriter.
         '''
-        total_words = self.raw_data_earray.nrows
-        
-        self.raw_data_earray.append(data_tuple[0])
-        self.raw_data_earray.flush()
-        
         len_raw_data = data_tuple[0].shape[0]
-        self.meta_data_table.row['timestamp_start'] = data_tuple[1]
-        self.meta_data_table.row['timestamp_stop'] = data_tuple[2]
-        self.meta_data_table.row['error'] = data_tuple[3]
-        self.meta_data_table.row['data_length'] = len_raw_data
-        self.meta_data_table.row['index_start'] = total_words
-        temp_index=total_words
-        total_words += len_raw_data
-        self.meta_data_table.row['index_stop'] = total_words
-        self.meta_data_table.row['scan_param_id'] = self.scan_param_id
-        self.meta_data_table.row.append()
-        self.meta_data_table.flush()
+        index_start, index_stop = self.raw_data_writer.append(data_tuple[0], timestamp_start=data_tuple[1], timestamp_stop=data_tuple[2],
+                                                              error=data_tuple[3], scan_param_id=self.scan_param_id)
         
         if self.socket:
-            send_data(self.socket, data=data_tuple, scan_param_id=self.scan_param_id,index_start=temp_index, index_stop=total_words, data_length=len_raw_data)
+            if self.send_multipart:
+                # Chunks from the ring buffer are only valid until this function returns, they have to be copied
+                send_data_multipart(self.socket, data=data_tuple, scan_param_id=self.scan_param_id, index_start=index_start, index_stop=index_stop,
+                                    data_length=len_raw_data, copy=self.fifo_readout.ring_buffer)
+            else:
+                send_data(self.socket, data=data_tuple, scan_param_id=self.scan_param_id,index_start=index_start, index_stop=index_stop, data_length=len_raw_data)
 
     def handle_err(self, exc):
         '''
@@ -365,6 +544,9 @@ class ScanBase(object):
             self.fifo_readout.stop(timeout=0)
         except RuntimeError:
             self.logger.info("Fifo has been already closed")
+        # Stop the writer (process) if the scan did not get to it, e.g. after an exception
+        if self.raw_data_writer is not None:
+            self.raw_data_writer.close()
         self.monopix.close()
         self._close_logfiles()
         self._close_sockets()
@@ -32,7 +32,6 @@ class ScanSource(scan_base.ScanBase):
             This scan enables the chip read-out for a defined period of time and acquires all data generated by any source during that time frame. 
         """
         cnt=0
-        scanned=0
 
         # Enable pixels.
         self.monopix.set_preamp_en(self.enable_mask)
@@ -56,7 +55,7 @@ class ScanSource(scan_base.ScanBase):
         self.monopix.set_monoread()
         self.logger.info("***** %s is running ***** Don't forget to start the TLU *****"%self.__class__.__name__)
 
-        with self.readout(scan_param_id=0, fill_buffer=False, clear_buffer=True, readout_interval=0.2, timeout=0):
+        with self.readout(scan_param_id=0, fill_buffer=False, clear_buffer=True, readout_interval=0.2, adaptive_interval=True, timeout=0, ring_buffer=True):
 
             pbar = tqdm(total=scan_time, unit='seconds')
             # Record the initial time.
@@ -65,12 +64,10 @@ class ScanSource(scan_base.ScanBase):
             # Monitor the scan time while acquiring data.
             while time.time() - t_0 < scan_time:
                 time.sleep(1)
-                pre_cnt = cnt
-                cnt = self.fifo_readout.get_record_count()
-                pre_scanned = scanned
-                scanned = time.time() - t_0
-                data_rate = (cnt - pre_cnt) / (scanned - pre_scanned) / 1024
-                self.logger.debug('Elapsed time = {0:.0f}s dat = {1} rate={2:.3f}k/s'.format(scanned, cnt, data_rate))
+                metrics = self.fifo_readout.get_readout_metrics()
+                cnt = metrics['words']
+                data_rate = metrics['words_per_second'] / 1024
+                self.logger.debug('Elapsed time = {0:.0f}s dat = {1} rate={2:.3f}k/s reads={3:.0f}/s'.format(time.time() - t_0, cnt, data_rate, metrics['reads_per_second']))
                 pbar.set_postfix_str('Dat: {0:9} | Rate: {1:.2f}k/s'.format(cnt, data_rate))
                 pbar.update(1)
 
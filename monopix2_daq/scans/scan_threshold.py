@@ -4,6 +4,7 @@ import numpy as np
 from tqdm import tqdm
 
 import monopix2_daq.scan_base as scan_base
+import monopix2_daq.analysis.interpreter as interpreter
 import monopix2_daq.analysis.scan_utils as scan_utils
 from monopix2_daq.analysis import analysis_dataproc
 from monopix2_daq.analysis import plotting
@@ -25,6 +26,9 @@ local_configuration={
     "inj_n_param": 100,                     # Number of injection pulses per pixel and step
     "trim_mask": None,                      # TRIM mask (None: Go with TRIM limit, 'middle': Middle TRIM)
     "trim_limit": None,                     # TRIM limit (True: High, False: Lowest, "unbiased": Unbiased)
+    "adaptive": False,                      # Adaptive s-curve sampling: Coarse scan, then only injection steps around the threshold of every pixel
+    "adaptive_coarse": 8,                   # Adaptive mode: Every n-th injection step is scanned in the coarse scan
+    "adaptive_window": 4,                   # Adaptive mode: Number of injection steps scanned on both sides of the threshold of every pixel
     "with_calibration": True,               # Determine if calibration is used in the output plots
     "c_inj": 2.76e-15,                      # Injection capacitance value in F
 
@@ -37,10 +41,11 @@ local_configuration={
 class ScanThreshold(scan_base.ScanBase):
     scan_id = "scan_threshold"
 
-    def scan(self, with_inj=False, with_mon=False, inj_lo=0.2, injlist_param=[0.0, 0.7, 0.005], thlist=None, phaselist_param=None, n_mask_pix=170, disable_noninjected_pixel=True, mask_step=None, inj_n_param=100, trim_mask=None, trim_limit=None, **kwargs):
+    def scan(self, with_inj=False, with_mon=False, inj_lo=0.2, injlist_param=[0.0, 0.7, 0.005], thlist=None, phaselist_param=None, n_mask_pix=170, disable_noninjected_pixel=True, mask_step=None, inj_n_param=100, trim_mask=None, trim_limit=None, adaptive=False, adaptive_coarse=8, adaptive_window=4, **kwargs):
         """
             Execute a threshold scan.
             This script scans the injection amplitude over a chip with fixed DAC settings and fits the results to determine the current effective threshold.  
+            In adaptive mode, every mask is first scanned with a coarse injection grid. Then only the injection steps around the threshold of every pixel are scanned.
         """
 
         # Set a hard-coded limit on the maximum  number of pixels injected simultaneously.
@@ -122,6 +127,16 @@ class ScanThreshold(scan_base.ScanBase):
         # Start Read-out.
         self.monopix.set_monoread()
 
+        if adaptive:
+            if len(phaselist) > 1:
+                self.logger.warning('Adaptive mode does not support phase scans, scanning the full injection grid.')
+            else:
+                self._scan_adaptive(injlist, inj_mask_list, inj_lo=inj_lo, inj_n_param=inj_n_param, coarse=adaptive_coarse, window=adaptive_window,
+                                    n_mask_pix=min(n_mask_pix, n_mask_pix_limit), with_mon=with_mon, disable_noninjected_pixel=disable_noninjected_pixel)
+                self.monopix.stop_all_data()
+                self.monopix.set_preamp_en(self.enable_mask)
+                return
+
         pbar = tqdm(total=len(inj_th_phase) * len(inj_mask_list), unit=' Masks')
         # Scan over injection steps and record the corresponding hits.
         for inj, phase in inj_th_phase.tolist():
@@ -141,39 +156,10 @@ class ScanThreshold(scan_base.ScanBase):
                 self.monopix.set_inj_all(inj_high=inj_high, inj_n=inj_n_param, ext_trigger=False)
 
             # Reset and clear trash hits before injecting.
-            for _ in range(10):
-                self.monopix["fifo"]["RESET"]
-                time.sleep(0.002)
+            self.clear_fifo()
 
             # Go through the masks.
-            for mask_i in inj_mask_list:
-                mask_i = np.logical_and(mask_i, self.enable_mask)
-                # Skip masks with zero enabled pixels
-                if not np.any(mask_i):
-                    pbar.update(1)
-                    continue
-
-                self.monopix.set_preamp_en("none")
-                self.logger.debug('Injecting: Mask {0}, from {1:.3f} to {2:.3f} V'.format(scan_param_id,injlist[0], injlist[-1]))
-
-                # Enable monitors and wait a bit, since the setting seems to couple into the CSA output
-                if with_mon:
-                    monitor_pix = [int(np.argwhere(mask_i == True)[0][0]), int(np.argwhere(mask_i == True)[0][1])]
-                    self.monopix.set_mon_en(monitor_pix, overwrite=True)
-                    time.sleep(0.05)
-                self.monopix.set_inj_en(mask_i, overwrite=True)
-                if disable_noninjected_pixel:
-                    self.monopix.set_preamp_en(mask_i, overwrite=True)
-
-                # Reset and clear trash hits before injecting.
-                for _ in range(10):
-                    self.monopix["fifo"]["RESET"] 
-                    time.sleep(0.002)
-                # Inject pixels in the mask with the current injection value.
-                with self.readout(scan_param_id=scan_param_id,fill_buffer=False,clear_buffer=True, readout_interval=0.001, timeout=0):
-                    self.monopix.start_inj()
-                    time.sleep(0.05)
-                pbar.update(1)
+            self.inject_masks(inj_mask_list, scan_param_id, with_mon=with_mon, disable_noninjected_pixel=disable_noninjected_pixel, pbar=pbar)
             
             # Increase scan parameter ID counter.
             scan_param_id=scan_param_id+1
@@ -185,6 +171,103 @@ class ScanThreshold(scan_base.ScanBase):
         # Enable all originally enabled pixels.
         self.monopix.set_preamp_en(self.enable_mask)
 
+    def _scan_adaptive(self, injlist, inj_mask_list, inj_lo, inj_n_param, coarse, window, n_mask_pix=170, with_mon=False, disable_noninjected_pixel=True):
+        """
+            Adaptive s-curve sampling. Every mask is first injected on the coarse grid (every "coarse"-th injection step).
+            The 50% point of every pixel is estimated from the occupancy on the coarse grid, then the "window" steps on both sides
+            of it are injected. For these fine steps, only the pixels which need a step are enabled and pixels of masks with the same rows
+            are injected together (at most n_mask_pix pixels).
+            The scan parameter ID is the index of the injection step in injlist, as in the full scan. The injected steps of every pixel are
+            stored as "InjectedSteps", the analysis fills the other steps of the s-curves from the injected ones.
+        """
+        n_steps = len(injlist)
+        shape = (self.monopix.chip_props["COL_SIZE"], self.monopix.chip_props["ROW_SIZE"])
+        coarse_steps = np.union1d(np.arange(0, n_steps, max(int(coarse), 1)), [n_steps - 1])
+        masks = [mask_i for mask_i in (np.logical_and(mask_i, self.enable_mask) for mask_i in inj_mask_list) if np.any(mask_i)]
+        occupancy = interpreter.OccupancyAccumulator(shape=shape)
+
+        # Coarse grid, mask by mask.
+        occ_coarse = np.zeros((len(coarse_steps),) + shape)
+        pbar = tqdm(total=len(masks), unit=' Masks')
+        for mask_i in masks:
+            self.logger.debug('Adaptive scan: Mask with {0:d} pixels'.format(np.count_nonzero(mask_i)))
+            self._set_adaptive_mask(mask_i, with_mon=with_mon, disable_noninjected_pixel=disable_noninjected_pixel)
+            for i, step in enumerate(coarse_steps):
+                occ_coarse[i][mask_i] = self._inject_step(step, injlist[step] + inj_lo, inj_n_param, occupancy)[mask_i]
+            pbar.update(1)
+        pbar.close()
+        injected = np.zeros(shape + (n_steps,), dtype=bool)
+        injected[:, :, coarse_steps] = np.any(masks, axis=0)[:, :, np.newaxis]
+
+        # Estimate the 50% point of every pixel from the first coarse step with at least 50% occupancy.
+        above = occ_coarse >= inj_n_param / 2.
+        first = np.argmax(above, axis=0)
+        has_threshold = np.logical_and(np.any(above, axis=0), first > 0)
+        occ_lo = np.take_along_axis(occ_coarse, np.maximum(first - 1, 0)[np.newaxis], axis=0)[0]
+        occ_hi = np.take_along_axis(occ_coarse, first[np.newaxis], axis=0)[0]
+        frac = np.clip((inj_n_param / 2. - occ_lo) / np.maximum(occ_hi - occ_lo, 1), 0, 1)
+        step_lo = coarse_steps[np.maximum(first - 1, 0)]
+        step_50 = step_lo + frac * (coarse_steps[first] - step_lo)
+
+        # Fine steps around the 50% points, only the pixels which need a step are injected.
+        need = np.abs(np.arange(n_steps) - np.round(step_50)[:, :, np.newaxis]) <= window
+        need[~has_threshold] = False
+        need[:, :, coarse_steps] = False
+        # Masks with the same rows can be injected together.
+        mask_groups = {}
+        for mask_i in masks:
+            rows = np.any(mask_i, axis=0)
+            mask_groups[rows.tobytes()] = np.logical_or(mask_groups.get(rows.tobytes(), False), mask_i)
+        fine_steps = np.flatnonzero(np.any(need, axis=(0, 1)))
+        pbar = tqdm(total=len(fine_steps), unit=' Steps')
+        n_bursts = 0
+        for step in fine_steps:
+            for group in mask_groups.values():
+                pixels = np.argwhere(np.logical_and(group, need[:, :, step]))
+                for start in range(0, len(pixels), n_mask_pix):
+                    sub_pixels = pixels[start:start + n_mask_pix]
+                    sub_mask = np.zeros(shape, dtype=bool)
+                    sub_mask[sub_pixels[:, 0], sub_pixels[:, 1]] = True
+                    self._set_adaptive_mask(sub_mask, disable_noninjected_pixel=disable_noninjected_pixel)
+                    self._inject_step(step, injlist[step] + inj_lo, inj_n_param, occupancy)
+                    n_bursts += 1
+            injected[:, :, step] |= need[:, :, step]
+            pbar.update(1)
+        pbar.close()
+        self.monopix.set_preamp_en("none")
+
+        self.logger.info('Adaptive scan: {0:d} coarse and {1:d} fine injections, {2:.1f} of {3:d} injection steps per pixel'.format(
+            len(masks) * len(coarse_steps), n_bursts, np.sum(injected) / max(np.count_nonzero(np.any(injected, axis=2)), 1), n_steps))
+        self.scan_data["InjectedSteps"] = injected
+
+    def _set_adaptive_mask(self, mask, with_mon=False, disable_noninjected_pixel=True):
+        self.monopix.set_preamp_en("none")
+        # Enable monitors and wait a bit, since the setting seems to couple into the CSA output
+        if with_mon:
+            monitor_pix = [int(np.argwhere(mask == True)[0][0]), int(np.argwhere(mask == True)[0][1])]
+            self.monopix.set_mon_en(monitor_pix, overwrite=True)
+            time.sleep(0.05)
+        self.monopix.set_inj_en(mask, overwrite=True)
+        if disable_noninjected_pixel:
+            self.monopix.set_preamp_en(mask, overwrite=True)
+        else:
+            self.monopix.set_preamp_en(self.enable_mask, overwrite=True)
+
+    def _inject_step(self, scan_param_id, inj_high, inj_n_param, occupancy):
+        """
+            Injects the enabled pixels once with the given VHi and returns the occupancy map of the step.
+            The map belongs to the OccupancyAccumulator "occupancy" and is overwritten by the next step.
+        """
+        self.monopix.set_inj_all(inj_high=inj_high, inj_n=inj_n_param, ext_trigger=False)
+        self.clear_fifo()
+        with self.readout(scan_param_id=scan_param_id, fill_buffer=True, clear_buffer=True, readout_interval=0.001, timeout=0):
+            self.monopix.start_inj()
+            self.fifo_readout.wait_for_data()
+        occupancy.reset()
+        for data in self.fifo_readout.data:
+            occupancy.add(data[0])
+        return occupancy.occupancy
+
     def analyze(self, data_file=None, cluster_hits=False, build_events=False, build_events_simple=False):
         if data_file is None:
             data_file = self.output_filename + '.h5'
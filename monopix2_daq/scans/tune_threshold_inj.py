@@ -119,10 +119,13 @@ class TuneTHinj(scan_base.ScanBase):
                 trim_increase_sign[col,0:self.monopix.chip_props["ROW_SIZE"]] = -1
         self.monopix.set_tdac(trim_ref, overwrite=True)
 
+        # Occupancy of the current tune step, filled while the data is read out.
+        occupancy = interpreter.OccupancyAccumulator(shape=(self.monopix.chip_props["COL_SIZE"], self.monopix.chip_props["ROW_SIZE"]))
+
         # Run the tuning logic with binary search.
         pbar = tqdm(total=int(len(tune_steps) * len(inj_mask_list)), unit=' Masks')
         for scan_param_id, t_step in enumerate(tune_steps):
-            data=np.array([],dtype=np.int32)
+            occupancy.reset()
             # Start Read-out.
             self.monopix.set_monoread()
             # Go through the masks.
@@ -151,8 +154,7 @@ class TuneTHinj(scan_base.ScanBase):
                     time.sleep(0.002)
 
                 # Inject and get data.
-                buf = self.monopix.get_data()
-                data = np.concatenate((data,buf), axis=None)
+                self.monopix.get_data(callback=occupancy.add)
                 # Disable the pixel masks.
                 self.monopix.set_mon_en("none")
                 self.monopix.set_preamp_en("none")
@@ -162,11 +164,8 @@ class TuneTHinj(scan_base.ScanBase):
             # Stop read-out.
             self.monopix.stop_monoread()
 
-            # Interpret data and look at the occupancy map.
-            fast_interpreter=interpreter.Interpreter()
-            int_data, _=fast_interpreter.interpret_data(raw_data=data, meta_data=None)
-            int_cleardata = int_data[np.bitwise_and(int_data["cnt"]<2, int_data["col"]<self.monopix.chip_props["COL_SIZE"])]
-            occupancy_map = np.histogram2d(int_cleardata["col"],int_cleardata["row"], bins=[np.arange(0,self.monopix.chip_props["COL_SIZE"]+1,1),np.arange(0,self.monopix.chip_props["ROW_SIZE"]+1,1)])[0]
+            # Look at the occupancy map.
+            occupancy_map = occupancy.occupancy
 
             # Compare the occupancy map to the occupancy target value.
             diff_mtx = np.abs(occupancy_map - occ_target)
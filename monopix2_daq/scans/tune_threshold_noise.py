@@ -109,10 +109,13 @@ class TuneTHnoise(scan_base.ScanBase):
                 trim_increase_sign[col,0:self.monopix.chip_props["ROW_SIZE"]] = -1
         self.monopix.set_tdac(trim_ref, overwrite=True)
 
+        # Occupancy of the current tune step, filled while the data is read out.
+        occupancy = interpreter.OccupancyAccumulator(shape=(self.monopix.chip_props["COL_SIZE"], self.monopix.chip_props["ROW_SIZE"]))
+
         # Run the tuning logic with binary search. 
         cnt=0
         for scan_param_id, t_step in enumerate(tune_steps):
-            data=np.array([],dtype=np.int32)
+            occupancy.reset()
             # Start Read-out.
             self.monopix.set_monoread()  
             for _ in range(10):
@@ -145,9 +148,9 @@ class TuneTHnoise(scan_base.ScanBase):
                 time.sleep(exp_time)
                 buf = self.monopix.get_data_now()
                 self.logger.info("Amount of buf: {}".format(len(buf)))
-                data = np.concatenate((data,buf), axis=None)
+                occupancy.add(buf)
 
-                self.logger.info("Amount of data: {}".format(len(data)))
+                self.logger.info("Amount of data: {}".format(occupancy.n_words))
                 # Disable the pixel masks.
                 self.monopix.set_mon_en("none")
                 pre_cnt=cnt
@@ -156,12 +159,9 @@ class TuneTHnoise(scan_base.ScanBase):
             # Stop read-out.
             self.monopix.stop_monoread()
 
-            # Interpret data and look at the occupancy map.
-            fast_interpreter=interpreter.Interpreter()
-            int_data, _=fast_interpreter.interpret_data(raw_data=data, meta_data=None)
-            int_cleardata = int_data[np.bitwise_and(int_data["cnt"]<2, int_data["col"]<=self.monopix.chip_props["COL_SIZE"])]
-            self.logger.info("Original words: {}, Expected hits: {}, Interpreted hits: {}, Filtered hits:{}".format(len(data),len(data)/3, len(int_data), len (int_cleardata)))
-            occupancy_map = np.histogram2d(int_cleardata["col"],int_cleardata["row"], bins=[np.arange(0,self.monopix.chip_props["COL_SIZE"]+1,1),np.arange(0,self.monopix.chip_props["ROW_SIZE"]+1,1)])[0]
+            # Look at the occupancy map.
+            occupancy_map = occupancy.occupancy
+            self.logger.info("Original words: {}, Expected hits: {}, Filtered hits:{}".format(occupancy.n_words, occupancy.n_words/3, int(np.sum(occupancy_map))))
 
             # If the occupancy is larger than target, increase the pixel threshold value in the right direction and update the best TDAC value.
             larger_occ = (occupancy_map > ( occ_target ) )
@@ -169,7 +169,7 @@ class TuneTHnoise(scan_base.ScanBase):
             best_results_map[larger_occ] = trim_ref[larger_occ] + trim_increase_sign[larger_occ]
             
             occupied_counter = np.count_nonzero(np.argwhere(occupancy_map > occ_target))
-            self.logger.info("Pixels with occupancy larger than threshold: {1}".format(occupied_counter))
+            self.logger.info("Pixels with occupancy larger than threshold: {0}".format(occupied_counter))
 
             trim_ref[larger_occ] += ( trim_increase_sign[larger_occ] )
             tuned_flags = np.logical_or(larger_occ, tuned_flags)
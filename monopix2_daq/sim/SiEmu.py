@@ -0,0 +1,229 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+# A transfer layer emulating the MIO3 firmware and the LF-Monopix2 chip
+# in software, to run scans without hardware or simulator.
+#
+
+import array
+import logging
+import os
+import struct
+import time
+from threading import Lock
+
+import numpy as np
+import yaml
+
+from basil.TL.SiTransferLayer import SiTransferLayer
+from monopix2_daq.sim.chip_emulator import ChipEmulator
+
+logger = logging.getLogger(__name__)
+
+
+def decode_register(data, size, fields):
+    '''
+    Decodes the bytes written by a StdRegister (StdRegister.tobytes()) into its fields.
+
+    Returns
+    -------
+    values: dict
+        Bits of every field as boolean array (index 0: least significant bit).
+    '''
+    reg = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8))[:size][::-1].astype(bool)
+    return {name: reg[offset - field_size + 1:offset + 1] for name, (offset, field_size) in fields.items()}
+
+
+def bits_to_int(bits):
+    return int(np.dot(bits.astype(np.int64), 1 << np.arange(bits.shape[0], dtype=np.int64)))
+
+
+class SiEmu(SiTransferLayer):
+    '''
+    Software emulation of the MIO3 firmware modules and of an LF-Monopix2 chip (see ChipEmulator).
+
+    The registers of all firmware modules are kept in memory, so the basil drivers read back what they wrote.
+    Writes to CONF (gpio), CONF_SR (spi) and CONF_DC (spi_dc) configure the emulated chip, starting the injection
+    pulser (inj) generates the hits of the injected pixels. Noise and source hits are generated while the chip is
+    read out (data_rx enabled). The data is read with the sitcp_fifo driver, like from the SiTcp transfer layer.
+    The GPAC is emulated by the gpac_emu driver, which forwards its set-points to this transfer layer.
+
+    All init parameters are optional:
+        chip_conf: chip yaml file with the CONF, CONF_SR and GPAC register definitions (default: monopix2.yaml)
+        base_addr: base addresses of the firmware modules (default: as in monopix2.yaml)
+        fw_version: emulated firmware version
+        chip: parameters of the ChipEmulator (thresholds, noise, rates, seed)
+    '''
+
+    # Firmware modules: default base address, module version, address of the READY bit (None: no READY bit)
+    _modules = {'gpio': (0x10010, 0, None),
+                'inj': (0x10300, 1, 1),
+                'gate': (0x10400, 3, 1),
+                'data_rx': (0x10500, 3, 18),
+                'tlu': (0x10600, 1, None),
+                'timestamp_rx1': (0x10700, 3, None),
+                'timestamp_tlu': (0x10800, 3, None),
+                'timestamp_inj': (0x10900, 3, None),
+                'timestamp_mon': (0x10a00, 3, None),
+                'spi_dc': (0x10b00, 2, 1),
+                'spi': (0x15000, 2, 1)}
+    _mem_offset = 0x10000  # Firmware version
+    _mem_size = 0x10000
+    _spi_mem_offset = 16
+    _spi_mem_bytes = 1024
+
+    def __init__(self, conf):
+        super(SiEmu, self).__init__(conf)
+        self._lock = Lock()
+
+    def init(self):
+        super(SiEmu, self).init()
+        chip_conf = self._init.get('chip_conf', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'monopix2.yaml'))
+        with open(chip_conf) as f:
+            registers = {reg['name']: reg for reg in yaml.safe_load(f)['registers']}
+        self._reg_conf = {}
+        for name in ['CONF', 'CONF_SR']:
+            self._reg_conf[name] = (registers[name]['size'], {field['name']: (field['offset'], field['size']) for field in registers[name]['fields']})
+        self._gpac_channels = {reg['arg_add']['channel']: name for name, reg in registers.items() if reg.get('hw_driver') == 'GPAC'}
+
+        self._base_addr = {name: self._init.get('base_addr', {}).get(name, module[0]) for name, module in self._modules.items()}
+        self._mem = bytearray(self._mem_size)
+        self._read_override = {self._mem_offset: (0xFF, self._init.get('fw_version', 0))}  # address: (mask, value)
+        for name, (_, version, ready_addr) in self._modules.items():
+            self._read_override[self._base_addr[name]] = (0xFF, version)
+            if ready_addr is not None:
+                self._read_override[self._base_addr[name] + ready_addr] = (0x01, 0x01)  # Always ready, everything is done on the write
+        for name in ['spi', 'spi_dc']:
+            self._write_mem(self._base_addr[name] + 14, struct.pack('<H', self._spi_mem_bytes))  # MEM_BYTES
+        self._write_handlers = {self._base_addr['gpio'] + 3: self._write_conf,  # OUTPUT
+                                self._base_addr['spi'] + 1: self._write_conf_sr,  # START
+                                self._base_addr['spi_dc'] + 1: self._write_conf_dc,  # START
+                                self._base_addr['inj'] + 1: self._start_inj}  # START
+
+        self.chip = ChipEmulator(**self._init.get('chip', {}))
+        self._gpio_conf = {}
+        self._sr_conf = None
+        self._fifo = []
+        self._fifo_words = 0
+        self._t0 = time.time()
+        self._last_update = self._t0
+
+    def _write_mem(self, addr, data):
+        start = addr - self._mem_offset
+        if start < 0 or start + len(data) > self._mem_size:
+            raise IOError('Address 0x%x not emulated' % addr)
+        self._mem[start:start + len(data)] = bytes(data)
+
+    def _read_mem(self, addr, size):
+        start = addr - self._mem_offset
+        if start < 0 or start + size > self._mem_size:
+            raise IOError('Address 0x%x not emulated' % addr)
+        return self._mem[start:start + size]
+
+    def _get_bit(self, module, addr, bit=0):
+        return (self._mem[self._base_addr[module] + addr - self._mem_offset] >> bit) & 0x1
+
+    def _get_value(self, module, addr, size):
+        return int.from_bytes(self._read_mem(self._base_addr[module] + addr, size), byteorder='little')
+
+    def write(self, addr, data):
+        with self._lock:
+            self._write_mem(addr, data)
+            handler = self._write_handlers.get(addr)
+            if handler is not None:
+                handler()
+
+    def read(self, addr, size):
+        with self._lock:
+            ret = array.array('B', self._read_mem(addr, size))
+        for i in range(size):
+            if addr + i in self._read_override:
+                mask, value = self._read_override[addr + i]
+                ret[i] = (ret[i] & ~mask & 0xFF) | value
+        return ret
+
+    def set_gpac_value(self, channel, value):
+        '''
+        Forwards a GPAC set-point (in V or A) to the emulated chip (called by the gpac_emu driver).
+        '''
+        name = self._gpac_channels.get(channel)
+        if name is not None:
+            with self._lock:
+                self.chip.set_analog(name, value)
+
+    def _get_timestamp(self):
+        return int((time.time() - self._t0) * 40e6)
+
+    def _is_readout_enabled(self):
+        return self._get_bit('data_rx', 2) == 1 and not self._gpio_conf.get('Rst', False)
+
+    def _write_conf(self):
+        size, fields = self._reg_conf['CONF']
+        conf = {name: bool(bits[0]) for name, bits in decode_register(self._read_mem(self._base_addr['gpio'] + 3, (size + 7) // 8), size, fields).items()}
+        if conf['ResetBcid'] and not self._gpio_conf.get('ResetBcid', False):
+            self._t0 = time.time()
+        self._gpio_conf = conf
+
+    def _write_conf_sr(self):
+        size, fields = self._reg_conf['CONF_SR']
+        self._sr_conf = decode_register(self._read_mem(self._base_addr['spi'] + self._spi_mem_offset, (size + 7) // 8), size, fields)
+        self.chip.set_global_conf({'EnColRO': self._sr_conf['EnColRO'].copy(),
+                                   'InjEnCol': self._sr_conf['InjEnCol'].copy(),
+                                   'EnDataCMOS': bits_to_int(self._sr_conf['EnDataCMOS']),
+                                   'EnDataLVDS': bits_to_int(self._sr_conf['EnDataLVDS']),
+                                   'TDAC_LSB': bits_to_int(self._sr_conf['TDAC_LSB'])})
+
+    def _write_conf_dc(self):
+        if not self._gpio_conf.get('En_Cnfg_Pix', False) or self._sr_conf is None:
+            return
+        bits = [('Trim', i) for i in range(self._sr_conf['TrimLd'].shape[0]) if not self._sr_conf['TrimLd'][i]]
+        bits += [(name, 0) for name in ['EnInj', 'EnMonitor', 'EnPre'] if not self._sr_conf[name + 'Ld'][0]]  # Active low
+        self.chip.load_pixel_conf(self._read_mem(self._base_addr['spi_dc'] + self._spi_mem_offset, 2 * self.chip.ROW_SIZE // 8),
+                                  np.flatnonzero(self._sr_conf['EnSRDCol']), bits)
+
+    def _start_inj(self):
+        if not self._is_readout_enabled():
+            return
+        self._update()
+        n_pulses = self._get_value('inj', 11, 4)  # REPEAT
+        if n_pulses == 0:
+            n_pulses = 1  # Permanent injection is not emulated
+        period = max(self._get_value('inj', 3, 4) + self._get_value('inj', 7, 4), 1)  # DELAY + WIDTH
+        self._append(self.chip.inject(n_pulses, period, self._get_timestamp(), with_timestamp=bool(self._get_bit('timestamp_inj', 2))))
+
+    def _update(self):
+        ''' Generates the noise and source hits since the last update.
+        '''
+        now = time.time()
+        if self._is_readout_enabled():
+            self._append(self.chip.generate(now - self._last_update, int((self._last_update - self._t0) * 40e6)))
+        self._last_update = now
+
+    def _append(self, raw_data):
+        if raw_data.shape[0] > 0:
+            self._fifo.append(raw_data)
+            self._fifo_words += raw_data.shape[0]
+
+    def reset(self):
+        with self._lock:
+            self._update()
+            self._fifo = []
+            self._fifo_words = 0
+
+    def _get_tcp_data_size(self):
+        with self._lock:
+            self._update()
+            return self._fifo_words * 4
+
+    def _get_tcp_data(self, size):
+        with self._lock:
+            n_words = min(size // 4, self._fifo_words)
+            if n_words == 0:
+                return np.zeros(0, dtype=np.uint32).tobytes()
+            data = np.concatenate(self._fifo) if len(self._fifo) > 1 else self._fifo[0]
+            self._fifo = [data[n_words:]] if n_words < data.shape[0] else []
+            self._fifo_words -= n_words
+            return data[:n_words].tobytes()
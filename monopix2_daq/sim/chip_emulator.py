@@ -0,0 +1,300 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+
+
+def encode_hits(col, row, le, te, timestamp):
+    '''
+    Encodes hits as Monopix data words (3 words per hit), the inverse of the RawDataInterpreter.
+
+    Parameters
+    ----------
+    col, row, le, te: numpy.ndarray
+        Column, row, leading and trailing edge (6 bit) of every hit.
+    timestamp: numpy.ndarray
+        Token timestamp in 640 MHz units (the 4 lowest bits are not transmitted).
+
+    Returns
+    -------
+    raw_data: numpy.ndarray
+        Array of uint32 words.
+    '''
+    timestamp = np.asarray(timestamp, dtype=np.uint64)
+    raw_data = np.empty(3 * len(timestamp), dtype=np.uint32)
+    raw_data[0::3] = ((np.asarray(col, dtype=np.uint32) & 0x3F) << 21) | ((np.asarray(le, dtype=np.uint32) & 0x3F) << 15) | \
+                     ((np.asarray(te, dtype=np.uint32) & 0x3F) << 9) | (np.asarray(row, dtype=np.uint32) & 0x1FF)
+    raw_data[1::3] = 0x08000000 | ((timestamp >> np.uint64(2)) & np.uint64(0x1FFFFFC)).astype(np.uint32)
+    raw_data[2::3] = 0x0A000000 | ((timestamp >> np.uint64(27)) & np.uint64(0x1FFFFFF)).astype(np.uint32)
+    return raw_data
+
+
+def encode_timestamp640(timestamp, header=0x50):
+    '''
+    Encodes timestamps of a timestamp640 module (3 words per timestamp, leading edge, default: injection).
+    '''
+    timestamp = np.asarray(timestamp, dtype=np.uint64)
+    raw_data = np.empty(3 * len(timestamp), dtype=np.uint32)
+    raw_data[0::3] = ((header | 0x3) << 24) | ((timestamp >> np.uint64(48)) & np.uint64(0xFF)).astype(np.uint32)
+    raw_data[1::3] = ((header | 0x2) << 24) | ((timestamp >> np.uint64(24)) & np.uint64(0xFFFFFF)).astype(np.uint32)
+    raw_data[2::3] = ((header | 0x1) << 24) | (timestamp & np.uint64(0xFFFFFF)).astype(np.uint32)
+    return raw_data
+
+
+class ChipEmulator(object):
+    '''
+    Software model of the LF-Monopix2 pixel matrix, used by the SiEmu transfer layer.
+
+    Every pixel has a threshold and a noise (in V of injection amplitude). The effective threshold depends on the
+    global threshold, the baseline and the TRIM DAC of the pixel, so threshold scans and tunings behave like on a chip:
+
+        threshold = th_gain * (TH1 - BL) + threshold_offset[col, row] + sign(col) * trim_step * TDAC_LSB / 24 * (Trim - 7.5)
+
+    where sign(col) is +1 for the columns with unipolar and -1 for the columns with bipolar tuning circuitry.
+    A pixel fires with the probability of an s-curve (error function) of the injected amplitude INJ_HI - inj_lo.
+    Noise hits (for pixels with a threshold close to the baseline) and source hits are generated with a rate.
+    '''
+    COL_SIZE = 56
+    ROW_SIZE = 340
+    COLS_TUNING_UNI = list(range(16, 48))
+
+    def __init__(self, seed=0, threshold=0.05, threshold_dispersion=0.01, th_gain=2.0, noise=0.004, noise_dispersion=0.0005,
+                 trim_step=0.004, inj_lo=0.2, tot_gain=150., noise_rate=1e6, source_rate=0., source_charge=0.6, latency=1):
+        '''
+        Parameters
+        ----------
+        seed: int
+            Seed of the random generator, the emulated chip (thresholds, noise) and its hits are reproducible.
+        threshold, threshold_dispersion: float
+            Mean and standard deviation (in V) of the threshold offsets of the pixels.
+        th_gain: float
+            Change of the threshold per V of TH1 - BL.
+        noise, noise_dispersion: float
+            Mean and standard deviation (in V) of the noise of the pixels.
+        trim_step: float
+            Threshold change (in V) per TRIM DAC step at TDAC_LSB=24.
+        inj_lo: float
+            VLo of the injection (set on the chip card), the injected amplitude is INJ_HI - inj_lo.
+        tot_gain: float
+            ToT (in 40 MHz clocks) per V above threshold.
+        noise_rate: float
+            Noise hit rate (in Hz) of a pixel with its threshold at the baseline.
+        source_rate: float
+            Rate (in Hz) of source hits on the full matrix. Hits on pixels which are not read out are lost.
+        source_charge: float
+            Mean amplitude (in V of injection amplitude) of the source hits.
+        latency: int
+            Delay (in 40 MHz clocks) between a hit and its leading edge.
+        '''
+        self.rng = np.random.default_rng(seed)
+        shape = (self.COL_SIZE, self.ROW_SIZE)
+        self.threshold_offset = threshold + threshold_dispersion * self.rng.standard_normal(shape)
+        self.noise = np.abs(noise + noise_dispersion * self.rng.standard_normal(shape))
+        self.th_gain = th_gain
+        self.trim_step = trim_step
+        self.inj_lo = inj_lo
+        self.tot_gain = tot_gain
+        self.noise_rate = noise_rate
+        self.source_rate = source_rate
+        self.source_charge = source_charge
+        self.latency = latency
+        self.trim_sign = np.full(self.COL_SIZE, -1, dtype=np.int8)
+        self.trim_sign[self.COLS_TUNING_UNI] = 1
+
+        self.pixel_conf = {'EnPre': np.zeros(shape, dtype=bool),
+                           'EnInj': np.zeros(shape, dtype=bool),
+                           'EnMonitor': np.zeros(shape, dtype=bool),
+                           'Trim': np.zeros(shape, dtype=np.uint8)}
+        self.global_conf = {'EnColRO': np.zeros(self.COL_SIZE, dtype=bool),
+                            'InjEnCol': np.ones(self.COL_SIZE, dtype=bool),  # Active low
+                            'EnDataCMOS': 0,
+                            'EnDataLVDS': 0,
+                            'TDAC_LSB': 24}
+        self.analog = {'BL': 0.75, 'TH1': 1.5, 'INJ_HI': 0.2}
+        self._threshold = None
+        self._noise_rate = None
+
+    def set_pixel_threshold(self, threshold_offset):
+        '''
+        Sets the threshold offsets (in V) of all pixels, e.g. measured on a real chip.
+        '''
+        self.threshold_offset = np.broadcast_to(np.asarray(threshold_offset, dtype=float), (self.COL_SIZE, self.ROW_SIZE)).copy()
+        self._threshold = None
+        self._noise_rate = None
+
+    def set_pixel_noise(self, noise):
+        '''
+        Sets the noise (in V) of all pixels.
+        '''
+        self.noise = np.broadcast_to(np.asarray(noise, dtype=float), (self.COL_SIZE, self.ROW_SIZE)).copy()
+        self._noise_rate = None
+
+    def set_analog(self, name, value):
+        if self.analog.get(name) != value:
+            self.analog[name] = value
+            self._threshold = None
+            self._noise_rate = None
+
+    def set_global_conf(self, conf):
+        '''
+        Updates the global configuration (CONF_SR fields).
+        '''
+        self.global_conf.update(conf)
+        self._threshold = None
+        self._noise_rate = None
+
+    def load_pixel_conf(self, data, dcols, bits):
+        '''
+        Loads CONF_DC data into the pixel matrix.
+
+        Parameters
+        ----------
+        data: bytes
+            CONF_DC data of one double column (680 bits).
+        dcols: iterable of int
+            Double columns which are loaded (EnSRDCol).
+        bits: list of tuples
+            (name, bit position) of the pixel configuration bits which are loaded (active "...Ld").
+        '''
+        bits_in = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8))[:2 * self.ROW_SIZE].astype(bool)
+        dc_mask = np.stack((bits_in[:self.ROW_SIZE], bits_in[self.ROW_SIZE:][::-1]))
+        for dcol in dcols:
+            cols = slice(2 * dcol, 2 * dcol + 2)
+            for name, bit_pos in bits:
+                if name == 'Trim':
+                    trim = self.pixel_conf['Trim'][cols]
+                    trim &= np.uint8(~(1 << bit_pos) & 0xFF)
+                    trim |= dc_mask.astype(np.uint8) << bit_pos
+                else:
+                    self.pixel_conf[name][cols] = dc_mask
+        self._threshold = None
+        self._noise_rate = None
+
+    def get_threshold(self):
+        '''
+        Returns the effective threshold (in V of injection amplitude) of all pixels.
+        '''
+        if self._threshold is None:
+            trim = self.pixel_conf['Trim'].astype(float) - 7.5
+            trim_step = self.trim_step * float(self.global_conf['TDAC_LSB']) / 24.
+            self._threshold = self.th_gain * (self.analog['TH1'] - self.analog['BL']) + self.threshold_offset + \
+                self.trim_sign[:, np.newaxis] * trim_step * trim
+        return self._threshold
+
+    def get_readout_mask(self):
+        '''
+        Returns the pixels whose hits are read out: preamplifier enabled, column read-out enabled and data output enabled.
+        '''
+        if not (self.global_conf['EnDataCMOS'] or self.global_conf['EnDataLVDS']):
+            return np.zeros((self.COL_SIZE, self.ROW_SIZE), dtype=bool)
+        return np.logical_and(self.pixel_conf['EnPre'], self.global_conf['EnColRO'][:, np.newaxis])
+
+    def get_injection_mask(self):
+        return np.logical_and(self.get_readout_mask(), np.logical_and(self.pixel_conf['EnInj'], ~self.global_conf['InjEnCol'][:, np.newaxis]))
+
+    def _get_noise_rate(self):
+        '''
+        Returns the pixels with noise hits and their noise hit rates.
+        '''
+        if self._noise_rate is None:
+            cols, rows = np.nonzero(self.get_readout_mask())
+            # Rice formula: rate of upward crossings of the threshold by the gaussian noise
+            thr = np.maximum(self.get_threshold()[cols, rows], 0)
+            rate = self.noise_rate * np.exp(-0.5 * (thr / self.noise[cols, rows]) ** 2)
+            sel = rate > 0
+            self._noise_rate = (cols[sel], rows[sel], rate[sel])
+        return self._noise_rate
+
+    def _get_tot(self, amplitude, threshold):
+        return np.clip(np.rint(self.tot_gain * (amplitude - threshold)), 1, 63).astype(np.uint32)
+
+    def inject(self, n_pulses, period, timestamp, with_timestamp=False):
+        '''
+        Injects all pixels enabled for injection.
+
+        Parameters
+        ----------
+        n_pulses: int
+            Number of injection pulses.
+        period: int
+            Time between two pulses (in 40 MHz clocks).
+        timestamp: int
+            Time of the first pulse (in 40 MHz clocks).
+        with_timestamp: boolean
+            Add the injection timestamp (timestamp640) of every pulse.
+
+        Returns
+        -------
+        raw_data: numpy.ndarray
+            Array of uint32 words.
+        '''
+        cols, rows = np.nonzero(self.get_injection_mask())
+        amplitude = self.analog['INJ_HI'] - self.inj_lo
+        if n_pulses <= 0:
+            return np.zeros(0, dtype=np.uint32)
+        threshold = self.get_threshold()[cols, rows]
+        signal = amplitude + self.noise[cols, rows] * self.rng.standard_normal((n_pulses, len(cols)))
+        pulse, pix = np.nonzero(signal > threshold)  # Sorted by pulse
+        pulse_time = timestamp + period * np.arange(n_pulses, dtype=np.int64)
+        tot = self._get_tot(signal[pulse, pix], threshold[pix])
+        le = pulse_time[pulse] + self.latency
+        hits = encode_hits(cols[pix], rows[pix], le, le + tot, (pulse_time[pulse] + self.latency + tot) << 4)
+        if not with_timestamp:
+            return hits
+        # Injection timestamp (3 words) before the hits of every pulse
+        n_hits = np.bincount(pulse, minlength=n_pulses)
+        start = 3 * (np.arange(n_pulses) + np.concatenate(([0], np.cumsum(n_hits)[:-1])))
+        raw_data = np.empty(3 * (n_pulses + len(pulse)), dtype=np.uint32)
+        ts_pos = (start[:, np.newaxis] + np.arange(3)).ravel()
+        raw_data[ts_pos] = encode_timestamp640(pulse_time << 4)
+        hit_mask = np.ones(raw_data.shape[0], dtype=bool)
+        hit_mask[ts_pos] = False
+        raw_data[hit_mask] = hits
+        return raw_data
+
+    def generate(self, duration, timestamp):
+        '''
+        Generates the noise and source hits of a time interval.
+
+        Parameters
+        ----------
+        duration: float
+            Length of the interval in seconds.
+        timestamp: int
+            Start of the interval (in 40 MHz clocks).
+
+        Returns
+        -------
+        raw_data: numpy.ndarray
+            Array of uint32 words.
+        '''
+        if duration <= 0:
+            return np.zeros(0, dtype=np.uint32)
+        readout_mask = self.get_readout_mask()
+        threshold = self.get_threshold()
+        cols, rows, rate = self._get_noise_rate()
+        n_noise = self.rng.poisson(rate * duration)
+        hit_cols, hit_rows = np.repeat(cols, n_noise), np.repeat(rows, n_noise)
+        hit_tot = self.rng.integers(1, 4, hit_cols.shape[0]).astype(np.uint32)
+        # Source: uniform over the matrix, amplitude from a gamma distribution
+        if self.source_rate > 0:
+            n_source = self.rng.poisson(self.source_rate * duration)
+            src_cols = self.rng.integers(0, self.COL_SIZE, n_source)
+            src_rows = self.rng.integers(0, self.ROW_SIZE, n_source)
+            amplitude = self.rng.gamma(4., self.source_charge / 4., n_source)
+            signal = amplitude + self.noise[src_cols, src_rows] * self.rng.standard_normal(n_source)
+            sel = np.logical_and(readout_mask[src_cols, src_rows], signal > threshold[src_cols, src_rows])
+            hit_cols = np.concatenate((hit_cols, src_cols[sel]))
+            hit_rows = np.concatenate((hit_rows, src_rows[sel]))
+            hit_tot = np.concatenate((hit_tot, self._get_tot(signal[sel], threshold[src_cols[sel], src_rows[sel]])))
+        if hit_cols.shape[0] == 0:
+            return np.zeros(0, dtype=np.uint32)
+        hit_time = timestamp + self.rng.integers(0, max(int(duration * 40e6), 1), hit_cols.shape[0])
+        order = np.argsort(hit_time, kind='stable')
+        hit_cols, hit_rows, hit_time, hit_tot = hit_cols[order], hit_rows[order], hit_time[order], hit_tot[order]
+        le = hit_time + self.latency
+        return encode_hits(hit_cols, hit_rows, le, le + hit_tot, (le + hit_tot) << 4)
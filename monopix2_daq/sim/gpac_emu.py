@@ -0,0 +1,84 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import logging
+
+from basil.HL.HardwareLayer import HardwareLayer
+
+logger = logging.getLogger(__name__)
+
+
+class gpac_emu(HardwareLayer):
+    '''
+    Emulation of the GPAC (same interface as basil.HL.GPAC) for the SiEmu transfer layer.
+
+    The set-points are kept in memory and read back as measured values. Power channels draw a fixed current
+    when enabled, current sources see a fixed load resistance (the NTC at 25 C). Every set-point is forwarded to
+    the transfer layer (SiEmu.set_gpac_value), so the emulated chip follows the thresholds and the injection.
+    '''
+    _units = {'V': 1., 'mV': 1e-3, 'A': 1., 'mA': 1e-3, 'uA': 1e-6}
+    _power_current = 0.01  # A
+    _load_resistance = 10e3  # Ohm
+
+    def __init__(self, intf, conf):
+        super(gpac_emu, self).__init__(intf, conf)
+        self._voltage = {}
+        self._current = {}
+        self._enable = {}
+        self._current_limit = 0.
+
+    def init(self):
+        super(gpac_emu, self).init()
+        logger.info('Emulated General Purpose Analog Card (GPAC)')
+
+    def _to_unit(self, value, unit):
+        if unit not in self._units:
+            raise TypeError("Invalid unit type.")
+        return value / self._units[unit]
+
+    def _from_unit(self, value, unit):
+        if unit not in self._units:
+            raise TypeError("Invalid unit type.")
+        return value * self._units[unit]
+
+    def get_id(self):
+        return 0
+
+    def set_voltage(self, channel, value, unit='V'):
+        self._voltage[channel] = self._from_unit(value, unit)
+        self._intf.set_gpac_value(channel, self._voltage[channel])
+
+    def get_voltage(self, channel, unit='V'):
+        if channel.startswith('PWR') and not self._enable.get(channel, False):
+            voltage = 0.
+        elif channel.startswith('ISRC'):
+            voltage = abs(self._current.get(channel, 0.)) * self._load_resistance
+        else:
+            voltage = self._voltage.get(channel, 0.)
+        return self._to_unit(voltage, unit)
+
+    def set_current(self, channel, value, unit='A'):
+        self._current[channel] = self._from_unit(value, unit)
+        self._intf.set_gpac_value(channel, self._current[channel])
+
+    def get_current(self, channel, unit='A'):
+        if channel.startswith('PWR'):
+            current = self._power_current if self._enable.get(channel, False) else 0.
+        else:
+            current = self._current.get(channel, 0.)
+        return self._to_unit(current, unit)
+
+    def set_enable(self, channel, value):
+        if not channel.startswith('PWR'):
+            raise ValueError('set_enable() not supported for channel %s' % channel)
+        self._enable[channel] = bool(value)
+
+    def get_over_current(self, channel):
+        return False
+
+    def set_current_limit(self, channel, value, unit='A'):
+        self._current_limit = self._from_unit(value, unit)
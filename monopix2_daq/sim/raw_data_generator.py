@@ -0,0 +1,391 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+# Writes synthetic scan files (raw_data, meta_data, kwargs, pixel_conf) of
+# arbitrary size, e.g. to benchmark the analysis without a chip.
+#
+
+import logging
+import re
+
+import numpy as np
+import tables as tb
+import yaml
+from scipy.special import erf
+
+from monopix2_daq.raw_data_writer import RawDataWriter
+from monopix2_daq.scan_base import MetaTable
+from monopix2_daq.sim.chip_emulator import encode_hits, encode_timestamp640
+
+logger = logging.getLogger(__name__)
+
+COL_SIZE = 56
+ROW_SIZE = 340
+
+# Expected number of sequences of every stream per event (injection pulse or trigger).
+# 'monopix' and 'noise' are Poisson distributed, the other streams occur with the given probability (at most 1).
+# In threshold scans the number of Monopix hits follows from the s-curves of the injected pixels instead.
+WORD_MIX = {'scan_threshold': {'monopix': 0., 'noise': 0., 'rx': 0., 'tlu': 0., 'tlu640': 0., 'inj': 1., 'mon': 0.},
+            'scan_source': {'monopix': 2., 'noise': 0.1, 'rx': 1., 'tlu': 1., 'tlu640': 1., 'inj': 0., 'mon': 0.}}
+WORDS_PER_SEQUENCE = {'monopix': 3, 'noise': 3, 'rx': 3, 'tlu': 1, 'tlu640': 3, 'inj': 3, 'mon': 3}
+TIMESTAMP640_HEADERS = {'rx': 0x40, 'inj': 0x50, 'mon': 0x60, 'tlu640': 0x70}
+READOUT_LATENCY = 20  # Monopix words arrive this many 40 MHz clock cycles after the token
+TRIGGER_DEAD_TIME = 40  # Minimum distance of two triggers in 40 MHz clock cycles
+
+# Hit table of the FE-I4 reference plane (pyBAR interpreted data)
+FE_HIT_DTYPE = [('event_number', '<i8'), ('trigger_number', '<u4'), ('trigger_time_stamp', '<u4'), ('relative_BCID', 'u1'),
+                ('LVL1ID', '<u2'), ('column', 'u1'), ('row', '<u2'), ('tot', 'u1'), ('BCID', '<u2'), ('TDC', '<u2'),
+                ('TDC_time_stamp', 'u1'), ('TDC_trigger_distance', 'u1'), ('trigger_status', 'u1'), ('service_record', '<u4'),
+                ('event_status', '<u2')]
+FE_COL_SIZE = 80
+FE_ROW_SIZE = 336
+
+
+def parse_size(size):
+    '''
+    Converts a size in bytes ('1MB', '2.5 GB', '4096', ...) to an int. Binary prefixes (1 kB = 1024 B).
+    '''
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*([0-9.]+)\s*([kKMGT]?)i?B?\s*$', size)
+    if match is None:
+        raise ValueError('Invalid size: %s' % size)
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def encode_tlu(trigger_number, timestamp):
+    '''
+    Encodes TLU words (format 2: 15 bit timestamp in 40 MHz units and 16 bit trigger number).
+    '''
+    return (0x80000000 | ((np.asarray(timestamp, dtype=np.uint64) & np.uint64(0x7FFF)) << np.uint64(16)) |
+            (np.asarray(trigger_number, dtype=np.uint64) & np.uint64(0xFFFF))).astype(np.uint32)
+
+
+def merge_sequences(sequences, return_times=False):
+    '''
+    Merges word sequences of several streams in time order.
+
+    Parameters
+    ----------
+    sequences: list of tuples (time, words)
+        time: sort key of every sequence (int64), words: 2D array (one row per sequence).
+    return_times: bool
+        Also return the sort key of every word.
+
+    Returns
+    -------
+    raw_data: numpy.ndarray
+        Array of uint32 words.
+    '''
+    sequences = [(t, w) for t, w in sequences if t.shape[0] > 0]
+    if len(sequences) == 0:
+        return (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64)) if return_times else np.zeros(0, dtype=np.uint32)
+    times = np.concatenate([t for t, _ in sequences])
+    lengths = np.concatenate([np.full(t.shape[0], w.shape[1], dtype=np.int64) for t, w in sequences])
+    order = np.argsort(times, kind='stable')
+    start = np.empty_like(lengths)
+    start[order] = np.cumsum(lengths[order]) - lengths[order]
+    raw_data = np.empty(np.sum(lengths), dtype=np.uint32)
+    offset = 0
+    for t, w in sequences:
+        raw_data[start[offset:offset + t.shape[0], np.newaxis] + np.arange(w.shape[1])] = w
+        offset += t.shape[0]
+    if return_times:
+        return raw_data, np.repeat(times[order], lengths[order])
+    return raw_data
+
+
+class RawDataGenerator(object):
+    '''
+    Generates synthetic raw data files with the layout of a scan (raw_data, meta_data, kwargs, pixel_conf_before and
+    pixel_conf), which can be analyzed like real data.
+
+    Two kinds of scans are supported:
+        scan_threshold: s-curves of pixels with a threshold and noise dispersion. Every scan parameter (injection
+            amplitude of injlist_param) is injected n_injections times. To reach the requested size the number of
+            injected pixels or the number of injections is scaled.
+        scan_source: triggered events with clusters of Monopix hits, RX1 and TLU timestamps and TLU words, as in a
+            test beam. Optionally the hits of an FE-I4 reference plane with the same trigger numbers are written.
+
+    The word mix (WORD_MIX) sets the number of sequences of every stream per event. Errors (corrupted, swapped and
+    missing words) are injected with error_rate.
+    '''
+
+    def __init__(self, scan_id='scan_source', word_mix=None, error_rate=0., seed=0, chunk_size=2 ** 20, readout_size=50000,
+                 injlist_param=(0.0, 0.7, 0.005), n_injections=100, threshold=0.25, threshold_dispersion=0.01, noise=0.008,
+                 noise_dispersion=0.001, inj_period=100, trigger_rate=20e3, tot_gain=150.):
+        '''
+        Parameters
+        ----------
+        scan_id: string
+            'scan_threshold' or 'scan_source'.
+        word_mix: dict
+            Sequences per event of the streams 'monopix', 'noise', 'rx', 'tlu', 'tlu640', 'inj', 'mon'.
+            Not given streams are taken from WORD_MIX.
+        error_rate: float
+            Fraction of words which are corrupted, swapped with the next word or dropped (in equal parts).
+        seed: int
+            Seed of the random generator, the same parameters give the same file.
+        chunk_size: int
+            Approximate number of words generated at once.
+        readout_size: int
+            Number of words per meta_data row (readout).
+        injlist_param, n_injections: list, int
+            Injection amplitudes [start, stop, step] and number of injections per amplitude of a threshold scan.
+        threshold, threshold_dispersion, noise, noise_dispersion: float
+            Mean and standard deviation of the pixel thresholds and noise (in units of the injection amplitude).
+        inj_period: int
+            Period of the injection pulses in 40 MHz clock cycles.
+        trigger_rate: float
+            Mean trigger rate (in Hz) of a source scan.
+        tot_gain: float
+            ToT (in 40 MHz clock cycles) per unit of charge above threshold.
+        '''
+        if scan_id not in WORD_MIX:
+            raise ValueError('Scan %s is not supported, use one of %s' % (scan_id, ', '.join(WORD_MIX)))
+        self.scan_id = scan_id
+        self.word_mix = dict(WORD_MIX[scan_id])
+        for name, value in (word_mix or {}).items():
+            if name not in self.word_mix:
+                raise ValueError('Unknown stream %s' % name)
+            self.word_mix[name] = float(value)
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.chunk_size = int(chunk_size)
+        self.readout_size = int(readout_size)
+        self.injlist_param = list(injlist_param)
+        self.n_injections = int(n_injections)
+        self.inj_period = int(inj_period)
+        self.trigger_rate = trigger_rate
+        self.tot_gain = tot_gain
+
+        self.threshold = self.rng.normal(threshold, threshold_dispersion, (COL_SIZE, ROW_SIZE))
+        self.noise = np.abs(self.rng.normal(noise, noise_dispersion, (COL_SIZE, ROW_SIZE)))
+        self.pixel_conf = {'EnPre': np.zeros((COL_SIZE, ROW_SIZE), dtype=np.uint8),
+                           'EnInj': np.zeros((COL_SIZE, ROW_SIZE), dtype=np.uint8),
+                           'EnMonitor': np.zeros((COL_SIZE, ROW_SIZE), dtype=np.uint8),
+                           'Trim': self.rng.integers(0, 16, (COL_SIZE, ROW_SIZE)).astype(np.uint8)}
+        self.n_errors = 0
+        self._t40 = 0  # 40 MHz clock
+        self._trigger_number = 1
+
+    def _get_tot(self, charge):
+        return np.clip(np.round(self.tot_gain * charge), 1, 63).astype(np.int64)
+
+    def _encode_hits(self, col, row, t_le, tot, token):
+        ''' Monopix words of hits with leading edge at t_le, token timestamp at token (40 MHz clock).
+        '''
+        return encode_hits(col, row, t_le & 0x3F, (t_le + tot) & 0x3F, token << 4).reshape(-1, 3)
+
+    def _get_stream_sequences(self, event_t640, monopix_t640):
+        ''' Timestamp, TLU and noise sequences of a batch of events (times in 640 MHz units).
+        '''
+        n_events = event_t640.shape[0]
+        tlu_t640 = event_t640 + 96 + self.rng.integers(0, 32, n_events)  # TLU latency to the RX1 signal
+        stream_t640 = {'rx': event_t640, 'inj': event_t640, 'mon': monopix_t640, 'tlu640': tlu_t640, 'tlu': tlu_t640}
+        sequences = []
+        for name in ['rx', 'inj', 'mon', 'tlu640', 'tlu']:
+            if self.word_mix[name] <= 0:
+                continue
+            sel = self.rng.random(n_events) < self.word_mix[name]
+            t = stream_t640[name][sel]
+            if name == 'tlu':
+                trigger_number = self._trigger_number + np.flatnonzero(sel)
+                sequences.append((t + 1, encode_tlu(trigger_number, t >> 4).reshape(-1, 1)))  # After the TLU timestamp
+            else:
+                sequences.append((t, encode_timestamp640(t, header=TIMESTAMP640_HEADERS[name]).reshape(-1, 3)))
+        n_noise = self.rng.poisson(self.word_mix['noise'] * n_events)
+        if n_noise > 0:
+            t_le = np.sort(self.rng.integers(event_t640[0] >> 4, (event_t640[-1] >> 4) + 1, n_noise))
+            tot = self.rng.integers(1, 8, n_noise)
+            sequences.append(((t_le + tot + 1 + READOUT_LATENCY) << 4, self._encode_hits(self.rng.integers(0, COL_SIZE, n_noise), self.rng.integers(0, ROW_SIZE, n_noise),
+                                                                      t_le, tot, t_le + tot + 1)))
+        return sequences
+
+    def _inject_errors(self, raw_data):
+        if self.error_rate <= 0:
+            return raw_data
+        n = raw_data.shape[0]
+        corrupt = self.rng.random(n) < self.error_rate / 3.
+        raw_data[corrupt] = self.rng.integers(0, 2 ** 32, np.count_nonzero(corrupt), dtype=np.uint32)
+        swap = np.flatnonzero(self.rng.random(n - 1) < self.error_rate / 3.)
+        raw_data[swap], raw_data[swap + 1] = raw_data[swap + 1].copy(), raw_data[swap].copy()
+        keep = self.rng.random(n) >= self.error_rate / 3.
+        self.n_errors += np.count_nonzero(corrupt) + swap.shape[0] + n - np.count_nonzero(keep)
+        return raw_data[keep]
+
+    def _scan_threshold(self, n_words):
+        ''' Yields (raw_data, scan_param_id) of a threshold scan with about n_words words.
+        '''
+        scan_param_range = np.arange(*self.injlist_param)
+        prob = 0.5 * (1 + erf((scan_param_range[np.newaxis, np.newaxis, :] - self.threshold[:, :, np.newaxis]) /
+                              (np.sqrt(2) * self.noise[:, :, np.newaxis])))
+        # Words per injection: of every injected pixel (all amplitudes) and of the other streams (every amplitude)
+        words_stream = sum(WORDS_PER_SEQUENCE[name] * min(self.word_mix[name], 1.) for name in ['rx', 'tlu', 'tlu640', 'inj', 'mon'])
+        words_stream = (words_stream + WORDS_PER_SEQUENCE['noise'] * self.word_mix['noise']) * scan_param_range.shape[0]
+        words_pixel = WORDS_PER_SEQUENCE['monopix'] * np.mean(np.sum(prob, axis=2))
+
+        n_injections = max(self.n_injections, int(np.ceil(n_words / (words_pixel * COL_SIZE * ROW_SIZE + words_stream))))
+        if n_injections > 0xFFFF:
+            raise ValueError('Size too large for a threshold scan (maximum %d injections)' % 0xFFFF)
+        n_pixels = int(np.clip((n_words / n_injections - words_stream) / words_pixel, 1, COL_SIZE * ROW_SIZE))
+        pixels = np.sort(self.rng.choice(COL_SIZE * ROW_SIZE, n_pixels, replace=False))
+        col, row = pixels // ROW_SIZE, pixels % ROW_SIZE
+        self.pixel_conf['EnPre'][col, row] = 1
+        self.pixel_conf['EnInj'][col, row] = 1
+        self.kwargs.update({'injlist_param': self.injlist_param, 'inj_n_param': n_injections, 'with_inj': True})
+        logger.info('Threshold scan: %d pixels, %d injections of %d amplitudes', n_pixels, n_injections, scan_param_range.shape[0])
+
+        prob = prob[col, row]
+        threshold = self.threshold[col, row]
+        words_pulse = WORDS_PER_SEQUENCE['monopix'] * np.sum(prob, axis=0) + words_stream / scan_param_range.shape[0]
+        for scan_param_id, amplitude in enumerate(scan_param_range):
+            batch_size = int(np.clip(self.chunk_size // max(words_pulse[scan_param_id], 1), 1, n_injections))
+            for pulse_start in range(0, n_injections, batch_size):
+                n_pulses = min(batch_size, n_injections - pulse_start)
+                event_t640 = (self._t40 + np.arange(n_pulses, dtype=np.int64) * self.inj_period) << 4
+                counts = self.rng.binomial(n_pulses, prob[:, scan_param_id])
+                hit_pixel = np.repeat(np.arange(n_pixels), counts)
+                pulse = self.rng.integers(0, n_pulses, hit_pixel.shape[0])
+                order = np.lexsort((hit_pixel, pulse))
+                hit_pixel, pulse = hit_pixel[order], pulse[order]
+                tot = self._get_tot(amplitude - threshold[hit_pixel])
+                t_le = self._t40 + pulse * self.inj_period + 2
+                token = t_le + tot + 1
+                sequences = [((token + READOUT_LATENCY) << 4, self._encode_hits(col[hit_pixel], row[hit_pixel], t_le, tot, token))]
+                sequences += self._get_stream_sequences(event_t640, event_t640 + 32)
+                self._t40 += n_pulses * self.inj_period
+                yield merge_sequences(sequences), scan_param_id
+
+    def _scan_source(self, n_words):
+        ''' Yields (raw_data, scan_param_id) of a source scan with up to n_words words (complete triggers).
+        '''
+        words_event = sum(WORDS_PER_SEQUENCE[name] * (value if name in ['monopix', 'noise'] else min(value, 1.)) for name, value in self.word_mix.items())
+        batch_size = max(int(self.chunk_size // max(words_event, 0.1)), 1)
+        n_events = 0
+        while n_words > 0:
+            event_t40 = self._t40 + np.cumsum(TRIGGER_DEAD_TIME + self.rng.exponential(40e6 / self.trigger_rate, batch_size).astype(np.int64))
+            event_t640 = (event_t40 << 4) + self.rng.integers(0, 16, batch_size)  # RX1 phase
+            n_hits = self.rng.poisson(self.word_mix['monopix'], batch_size)
+            event = np.repeat(np.arange(batch_size), n_hits)
+            # Clusters: hits around a center, the token is sent after the trailing edge of the shortest hit
+            center_col, center_row = self.rng.integers(0, COL_SIZE, batch_size), self.rng.integers(0, ROW_SIZE, batch_size)
+            hit_col = np.clip(center_col[event] + self.rng.integers(-1, 2, event.shape[0]), 0, COL_SIZE - 1)
+            hit_row = np.clip(center_row[event] + self.rng.integers(-1, 2, event.shape[0]), 0, ROW_SIZE - 1)
+            tot = self._get_tot(self.rng.gamma(4., 0.05, event.shape[0]))
+            t_le = event_t40[event] + 3 + (4 // tot)  # Time walk
+            token = np.zeros(batch_size, dtype=np.int64)
+            if event.shape[0] > 0:
+                first = np.flatnonzero(n_hits)
+                token[first] = np.minimum.reduceat(t_le + tot, np.cumsum(n_hits)[first] - n_hits[first]) + 1
+            sequences = [((token[event] + READOUT_LATENCY) << 4, self._encode_hits(hit_col, hit_row, t_le, tot, token[event]))]
+            sequences += self._get_stream_sequences(event_t640, (event_t40 + 4) << 4)
+            raw_data, word_times = merge_sequences(sequences, return_times=True)
+            if raw_data.shape[0] > n_words:  # Last batch: only complete triggers
+                event_start = np.searchsorted(word_times, event_t640)
+                batch_size = np.searchsorted(event_start, n_words, side='right') - 1
+                raw_data = raw_data[:event_start[batch_size]]
+                event_t40, center_col, center_row = event_t40[:batch_size + 1], center_col[:batch_size], center_row[:batch_size]
+                n_words = raw_data.shape[0]
+
+            if self._ref_hits is not None:
+                ref = np.zeros(batch_size, dtype=FE_HIT_DTYPE)
+                ref['event_number'] = self._trigger_number + np.arange(batch_size)
+                ref['trigger_number'] = ref['event_number'] & 0x7FFFFFFF
+                ref['column'] = np.clip(center_col * FE_COL_SIZE // COL_SIZE + 1, 1, FE_COL_SIZE)
+                ref['row'] = np.clip(center_row * FE_ROW_SIZE // ROW_SIZE + 1, 1, FE_ROW_SIZE)
+                ref['tot'] = self.rng.integers(1, 14, batch_size)
+                self._ref_hits.append(ref)
+
+            self._t40 = event_t40[-1]
+            self._trigger_number += batch_size
+            n_events += batch_size
+            n_words -= raw_data.shape[0]
+            yield raw_data, 0
+        self.kwargs.update({'scan_time': float(self._t40 / 40e6), 'n_triggers': int(n_events)})
+
+    def generate(self, raw_data_file, size, ref_file=None):
+        '''
+        Writes a synthetic scan file.
+
+        Parameters
+        ----------
+        raw_data_file: string
+            Output h5 file.
+        size: int or string
+            Size of the raw data in bytes (e.g. 1048576 or '50GB'). Approximate for threshold scans, source scans end
+            with the last complete trigger within the size.
+        ref_file: string
+            Output h5 file with the hits of an FE-I4 reference plane (only source scans).
+
+        Returns
+        -------
+        n_words: int
+            Number of raw data words.
+        '''
+        n_words = parse_size(size) // 4
+        if n_words >= 2 ** 32:
+            logger.warning('More than 2^32 words: the indices in meta_data (uint32) overflow, as for a scan of this size')
+        self.kwargs = {}
+        self._ref_hits = None
+        if ref_file is not None:
+            if self.scan_id != 'scan_source':
+                raise ValueError('Reference plane hits are only generated for source scans')
+            ref_h5 = tb.open_file(ref_file, mode='w')
+            self._ref_hits = ref_h5.create_table(ref_h5.root, name='Hits', description=np.dtype(FE_HIT_DTYPE), title='Hits',
+                                                 filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+
+        filter_raw_data = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+        filter_tables = tb.Filters(complib='zlib', complevel=5, fletcher32=False)
+        with tb.open_file(raw_data_file, mode='w', title=self.scan_id) as h5_file:
+            raw_data_earray = h5_file.create_earray(h5_file.root, name='raw_data', atom=tb.UIntAtom(), shape=(0,), title='raw_data',
+                                                    filters=filter_raw_data, expectedrows=n_words)
+            meta_data_table = h5_file.create_table(h5_file.root, name='meta_data', description=MetaTable, title='meta_data', filters=filter_tables)
+            meta_data_table.attrs.scan_id = self.scan_id
+            meta_data_table.attrs.chip_props = yaml.dump({'COL_SIZE': COL_SIZE, 'ROW_SIZE': ROW_SIZE})
+            raw_data_writer = RawDataWriter(raw_data_earray, meta_data_table, buffer_size=4 * self.chunk_size, interval=float('inf'))
+
+            scan = self._scan_threshold if self.scan_id == 'scan_threshold' else self._scan_source
+            timestamp_start = 0.
+            for raw_data, scan_param_id in scan(n_words):
+                raw_data = self._inject_errors(raw_data)
+                timestamp_stop = self._t40 / 40e6
+                for start in range(0, raw_data.shape[0], self.readout_size):
+                    raw_data_writer.append(raw_data[start:start + self.readout_size], timestamp_start, timestamp_stop, 0, scan_param_id)
+                timestamp_start = timestamp_stop
+            raw_data_writer.close()
+
+            kwargs = h5_file.create_vlarray(h5_file.root, 'kwargs', tb.VLStringAtom(), 'kwargs', filters=filter_tables)
+            kwargs.append(yaml.dump(self.kwargs))
+            for group_name in ['pixel_conf_before', 'pixel_conf']:
+                group = h5_file.create_group(h5_file.root, group_name, 'Pixel configuration')
+                for name, value in self.pixel_conf.items():
+                    h5_file.create_carray(group, name=name, title=name, obj=value, filters=filter_raw_data)
+            n_words = raw_data_earray.nrows
+
+        if ref_file is not None:
+            ref_h5.close()
+        logger.info('%s: %d words, %d injected errors', raw_data_file, n_words, self.n_errors)
+        return n_words
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(usage="python raw_data_generator.py raw_data.h5 -s 1GB --scan_id scan_threshold",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("raw_data_file", type=str, help="Output file.")
+    parser.add_argument("-s", "--size", type=str, default='100MB', help="Size of the raw data (1MB - 50GB).")
+    parser.add_argument("--scan_id", type=str, default='scan_source', choices=sorted(WORD_MIX))
+    parser.add_argument("--word_mix", type=str, default=None, help="Sequences per event, e.g. 'monopix: 3, mon: 0.5'.")
+    parser.add_argument("--error_rate", type=float, default=0.)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ref_file", type=str, default=None, help="Output file of the FE-I4 reference plane hits (scan_source).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    word_mix = yaml.safe_load('{%s}' % args.word_mix) if args.word_mix else None
+    RawDataGenerator(scan_id=args.scan_id, word_mix=word_mix, error_rate=args.error_rate, seed=args.seed).generate(args.raw_data_file, args.size, ref_file=args.ref_file)
@@ -0,0 +1,117 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables as tb
+
+from monopix2_daq.analysis import analysis_utils as au
+
+
+class TestAnalysisUtils(unittest.TestCase):
+
+    n_injections = 100
+    scan_param_range = np.arange(0, 100)
+
+    def create_scurves(self, n_channels, seed=0):
+        rng = np.random.default_rng(seed)
+        mu = rng.normal(50, 5, n_channels)
+        sigma = rng.normal(3, 0.5, n_channels)
+        p = 0.5 * (1 + au.erf((self.scan_param_range - mu[:, np.newaxis]) / (np.sqrt(2) * sigma[:, np.newaxis])))
+        return rng.binomial(self.n_injections, p).astype(np.uint16), mu, sigma
+
+    def test_fitless_threshold_noise(self):
+        scurves, _, _ = self.create_scurves(50)
+        mu, sigma = au.get_threshold_noise_vectorized(scurves, self.scan_param_range, self.n_injections)
+        for i, scurve in enumerate(scurves):
+            M = scurve.sum()
+            mu_i = self.scan_param_range.max() - M / self.n_injections
+            noise_i = (scurve[self.scan_param_range < mu_i].sum() + (self.n_injections - scurve[self.scan_param_range > mu_i]).sum()) / self.n_injections * np.sqrt(np.pi / 2.)
+            self.assertAlmostEqual(mu[i], mu_i)
+            self.assertAlmostEqual(sigma[i], noise_i)
+
+    def test_batched_fit(self):
+        scurves, mu_true, sigma_true = self.create_scurves(2000, seed=1)
+        scurves[:10] = 0  # Channels without data are not fitted
+        mu, sigma, chi2ndf, converged = au.fit_scurves_batched(scurves, self.scan_param_range, self.n_injections, sigma_0=3.)
+        self.assertTrue(np.all(converged))
+        self.assertTrue(np.all(mu[:10] == 0) and np.all(sigma[:10] == 0))
+        self.assertLess(np.max(np.abs(mu[10:] - mu_true[10:])), 1.)
+        self.assertLess(np.abs(np.mean(sigma[10:] - sigma_true[10:])), 0.3)
+        self.assertTrue(np.all(chi2ndf[10:] > 0))
+
+        # Same result for the x-axis inverted
+        mu_inv, sigma_inv, _, _ = au.fit_scurves_batched(scurves[:, ::-1], self.scan_param_range, self.n_injections, sigma_0=3., invert_x=True)
+        self.assertTrue(np.allclose(mu_inv[10:], self.scan_param_range.max() - mu[10:]))
+        self.assertTrue(np.allclose(sigma_inv[10:], sigma[10:]))
+
+    def test_fit_fallback(self):
+        scurves, mu_true, _ = self.create_scurves(2, seed=3)
+        noise = np.random.default_rng(0).integers(0, self.n_injections + 1, (3, self.scan_param_range.shape[0]))[2]
+        converged = au.fit_scurves_batched(np.vstack((scurves, noise)), self.scan_param_range, self.n_injections, sigma_0=3.)[3]
+        self.assertTrue(np.array_equal(converged, [True, True, False]))
+
+        # Channels which did not converge are fitted again with fit_scurve
+        scurves_all = np.zeros((au.COL_SIZE * au.ROW_SIZE, self.scan_param_range.shape[0]), dtype=np.uint16)
+        scurves_all[:2] = scurves
+        scurves_all[2] = noise
+        thr2D, sig2D, chi2ndf2D = au.fit_scurves_vectorized(scurves_all, self.scan_param_range, self.n_injections)
+        mu, sigma, chi2ndf = thr2D.ravel(), sig2D.ravel(), chi2ndf2D.ravel()
+        self.assertLess(np.max(np.abs(mu[:2] - mu_true)), 1.)
+        self.assertTrue(np.all(np.isfinite(mu[:3])) and np.all(np.isfinite(sigma[:3])) and np.all(np.isfinite(chi2ndf[:3])))
+        self.assertTrue(np.all(mu[3:] == 0) and np.all(sigma[3:] == 0))
+
+    def test_fill_unsampled_scurves(self):
+        scurves, mu_true, _ = self.create_scurves(500, seed=2)
+        # Coarse grid and a window around the threshold of every channel, as in the adaptive threshold scan
+        sampled = np.zeros(scurves.shape, dtype=bool)
+        sampled[:, ::8] = True
+        sampled[:, -1] = True
+        sampled[np.abs(self.scan_param_range - np.round(mu_true)[:, np.newaxis]) <= 8] = True
+        sampled[:5] = False  # Channels without injected steps are not changed
+        scurves_sampled = np.where(sampled, scurves, 0).astype(np.uint16)
+
+        filled = au.fill_unsampled_scurves(scurves_sampled, sampled)
+        self.assertEqual(filled.dtype, scurves.dtype)
+        self.assertTrue(np.array_equal(filled[sampled], scurves[sampled]))
+        self.assertTrue(np.all(filled[:5] == 0))
+        # Plateaus are filled
+        self.assertTrue(np.all(filled[5:, 0] == 0))
+        self.assertTrue(np.all(filled[5:, -1] == self.n_injections))
+
+        mu, _, _, converged = au.fit_scurves_batched(filled[5:], self.scan_param_range, self.n_injections, sigma_0=3.)
+        self.assertTrue(np.all(converged))
+        self.assertLess(np.max(np.abs(mu - mu_true[5:])), 1.)
+
+    def test_hit_table_writer(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filenames = [os.path.join(tmp_dir, 'plane_%d.h5' % i) for i in range(3)]
+            hits_dtype = np.dtype([('event_number', np.int64), ('column', np.uint16), ('row', np.uint16)])
+            hits = np.zeros(100000, dtype=hits_dtype)
+            hits['event_number'] = np.arange(hits.shape[0])
+            hits['column'] = np.random.default_rng(0).integers(0, 3, hits.shape[0])
+            for n_processes in [0, 2]:  # Written by the calling process, two processes for three files
+                with au.HitTableWriter(filenames, description=hits_dtype, expectedrows=hits.shape[0], n_processes=n_processes) as writer:
+                    for start in range(0, hits.shape[0], 7777):
+                        chunk = hits[start:start + 7777]
+                        for index in range(3):
+                            writer.append(index, chunk[chunk['column'] == index])
+                for index, filename in enumerate(filenames):
+                    with tb.open_file(filename) as in_file:
+                        self.assertTrue(np.array_equal(in_file.root.Hits[:], hits[hits['column'] == index]))
+                        self.assertEqual(au.get_chunk_size(in_file.root.Hits, 100000) % in_file.root.Hits.chunkshape[0], 0)
+                        self.assertEqual(au.get_chunk_size(in_file.root.Hits, 1), in_file.root.Hits.chunkshape[0])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import logging
+import types
+import unittest
+
+import numpy as np
+
+from monopix2_daq.analysis.interpreter import Interpreter
+from monopix2_daq.monopix2 import Monopix2
+from monopix2_daq.sim.chip_emulator import ChipEmulator, encode_hits
+from monopix2_daq.sim.SiEmu import SiEmu
+
+
+class TestEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.chip = ChipEmulator(seed=1)
+        self.chip.set_global_conf({'EnColRO': np.ones(56, dtype=bool), 'InjEnCol': np.zeros(56, dtype=bool), 'EnDataCMOS': 1})
+        self.chip.set_analog('TH1', 0.83)
+        self.mask = np.zeros((56, 340), dtype=bool)
+        self.mask[20:24, ::4] = True
+        self.chip.pixel_conf['EnPre'][:] = self.mask
+        self.chip.pixel_conf['EnInj'][:] = self.mask
+
+    def test_encode_hits(self):
+        rng = np.random.default_rng(0)
+        col, row, le, te = rng.integers(0, 56, 1000), rng.integers(0, 340, 1000), rng.integers(0, 64, 1000), rng.integers(0, 64, 1000)
+        timestamp = rng.integers(0, 2 ** 48, 1000) << 4
+        hits, error_cnt = Interpreter().interpret_data(encode_hits(col, row, le, te, timestamp))
+        self.assertEqual(error_cnt, 0)
+        for name, value in [('col', col), ('row', row), ('le', le), ('te', te), ('timestamp', timestamp)]:
+            self.assertTrue(np.array_equal(hits[name], value))
+
+    def test_load_pixel_conf(self):
+        tdac = np.random.default_rng(2).integers(0, 16, (56, 340)).astype(np.uint8)
+        dc_data = Monopix2._get_dc_bitstreams(types.SimpleNamespace(chip_props={'COL_SIZE': 56, 'ROW_SIZE': 340}), np.ones((56, 340)))
+        self.chip.load_pixel_conf(dc_data[0], range(28), [('EnMonitor', 0)])
+        self.assertTrue(np.all(self.chip.pixel_conf['EnMonitor']))
+        for bit in range(4):
+            dc_data = Monopix2._get_dc_bitstreams(types.SimpleNamespace(chip_props={'COL_SIZE': 56, 'ROW_SIZE': 340}), (tdac >> bit) & 1)
+            for dcol in range(28):
+                self.chip.load_pixel_conf(dc_data[dcol], [dcol], [('Trim', bit)])
+        self.assertTrue(np.array_equal(self.chip.pixel_conf['Trim'], tdac))
+
+    def test_scurve(self):
+        threshold = self.chip.get_threshold()
+        n_pulses = 200
+        for amplitude, occupancy in [(np.min(threshold[self.mask]) - 0.05, 0), (np.max(threshold[self.mask]) + 0.05, n_pulses)]:
+            self.chip.set_analog('INJ_HI', self.chip.inj_lo + amplitude)
+            hits, error_cnt = Interpreter().interpret_data(self.chip.inject(n_pulses, 100, 0, with_timestamp=True))
+            self.assertEqual(error_cnt, 0)
+            self.assertEqual(np.count_nonzero(hits['col'] == 0xFC), n_pulses)
+            hits = hits[hits['col'] < 56]
+            occ = np.histogram2d(hits['col'], hits['row'], bins=[np.arange(57), np.arange(341)])[0]
+            self.assertTrue(np.all(occ[self.mask] == occupancy))
+            self.assertTrue(np.all(occ[~self.mask] == 0))
+        # Pixels injected at their threshold fire in half of the pulses
+        self.chip.set_pixel_threshold(0.1)
+        self.chip.set_analog('INJ_HI', self.chip.inj_lo + self.chip.get_threshold()[20, 0])
+        hits, _ = Interpreter().interpret_data(self.chip.inject(n_pulses, 100, 0))
+        self.assertAlmostEqual(hits.shape[0] / float(n_pulses * np.count_nonzero(self.mask)), 0.5, delta=0.02)
+
+    def test_set_tdac_overwrite(self):
+        dut = Monopix2(Monopix2.emu_yaml, logLevel=logging.WARNING)
+        dut.init()
+        chip = dut['intf'].chip
+        chip.pixel_conf['Trim'][:] = np.random.default_rng(3).integers(0, 16, (56, 340))  # Unknown power-on state
+        tdac = np.zeros((56, 340), dtype=np.uint8)
+        tdac[:4] = 7
+        dut.set_tdac(tdac)  # Only the double columns which differ from PIXEL_CONF are written
+        dut.set_tdac(tdac, overwrite=True)
+        self.assertTrue(np.array_equal(chip.pixel_conf['Trim'], tdac))
+        # Now the chip is known, nothing is written again
+        issued = dut.get_write_stats()['CONF_DC']['issued']
+        dut.set_tdac(tdac, overwrite=True)
+        self.assertEqual(dut.get_write_stats()['CONF_DC']['issued'], issued)
+        dut.close()
+
+    def test_temperature_shadow(self):
+        dut = Monopix2(Monopix2.emu_yaml, logLevel=logging.WARNING)
+        dut.init()
+        ntc = dut.SET_VALUE['NTC']
+        dut.get_temperature()  # Searches an NTC current
+        self.assertNotEqual(dut['NTC'].get_current(unit='uA'), ntc)
+        dut.set_global_current(NTC=ntc)
+        self.assertEqual(dut['NTC'].get_current(unit='uA'), ntc)
+        dut.close()
+
+    def test_fifo(self):
+        intf = SiEmu({'name': 'intf', 'type': 'monopix2_daq.sim.SiEmu', 'init': {}})
+        intf.init()
+        self.assertEqual(intf.read(0x10000 + 0x500, 1)[0], 3)  # data_rx version
+        raw_data = np.arange(1000, dtype=np.uint32)
+        for start in range(0, 1000, 300):
+            intf._append(raw_data[start:start + 300])
+        data = [np.frombuffer(intf._get_tcp_data(size), dtype=np.uint32) for size in [400, 2000, 8000]]
+        self.assertTrue(np.array_equal(np.concatenate(data), raw_data))
+        self.assertEqual(intf._get_tcp_data_size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import tables as tb
+from numba.typed import List
+
+from monopix2_daq.analysis.interpreter import Interpreter
+from monopix2_daq.sim.raw_data_generator import RawDataGenerator
+
+# The event builder modules import each other as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'monopix2_daq', 'analysis'))
+import analysis_utils  # noqa: E402
+import event_builder  # noqa: E402
+import event_builder_utils  # noqa: E402
+
+
+def build_events_in_memory(fin, fref):
+    ''' Original event builder with all data in memory and the linear word search, as reference (without plots and output files).
+    '''
+    with tb.open_file(fin) as in_file:
+        dat = in_file.root.Dut[:]
+    with tb.open_file(fref) as in_file:
+        ref = in_file.root.Hits[:]
+    tlu_mask = dat["col"] == event_builder.TLU_TAG
+    event_builder.align_tlu_trigger_number(tlu_mask, np.int64(dat[tlu_mask]["cnt"]), dat)
+
+    tlu_match_table = np.empty(np.count_nonzero(dat["col"] == event_builder.TLU640_TAG),
+                               dtype=[("trigger_number", "<i8"), ("tlu_timestamp", "<i8"), ("rx1_timestamp", "<i8"), ("tlu_HR_timestamp", "<i8")])
+    event_builder_utils.assign_timestamps_to_tlu_hr(dat, tlu_match_table, event_builder.WORD_SEARCH_DISTANCE)
+    tlu_match_table = tlu_match_table[tlu_match_table["rx1_timestamp"] != event_builder.MAX_64BIT_TAG]
+    diff = np.int64(tlu_match_table["tlu_HR_timestamp"] - tlu_match_table["rx1_timestamp"])
+    hist = np.histogram(diff, bins=np.arange(-0x80000, 0x80000, 1))
+    amp, mean, width, sigma = analysis_utils.fit_boxfc(hist[1][:-1], hist[0])
+    diff_offset = mean - np.abs(width) / 2.0
+    lower_lim = round(diff_offset - 1 * np.abs(width) - 5 * np.abs(sigma), 0)
+    upper_lim = round(diff_offset + 2 * np.abs(width) + 5 * np.abs(sigma), 0)
+    tlu_match_table = tlu_match_table[np.bitwise_and(diff <= upper_lim, diff >= lower_lim)]
+
+    monopix_match_table = np.empty(np.count_nonzero(dat["col"] <= event_builder.MONO_COL_SIZE),
+                                   dtype=[("col", "u1"), ("row", "<u8"), ("le", "u1"), ("te", "u1"), ("tlu_timestamp", "<u8"),
+                                          ("trigger_number", "<i8"), ("token_timestamp", "<u8"), ("le_timestamp", "<u8"),
+                                          ("rx1_timestamp", "<u8"), ("tlu_HR_timestamp", "<u8"), ("flg", "u1")])
+    event_builder_utils.assign_tlu_to_monopix(dat, monopix_match_table, event_builder.WORD_SEARCH_DISTANCE)
+    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"] != event_builder.MAX_64BIT_TAG]
+    event_builder_utils.calculate_le_timestamp(monopix_match_table)
+    event_builder_utils.assign_rx1(monopix_match_table, tlu_match_table)
+    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"] != event_builder.MAX_64BIT_TAG]
+
+    ref_valid_table = np.empty(len(ref), dtype=ref.dtype)
+    ref_valid_table = ref_valid_table[:event_builder_utils.del_invalid_tlu_in_FE(ref, tlu_match_table, ref_valid_table)]
+    event_builder_utils.assign_rx1_to_FE(ref_valid_table, tlu_match_table)
+    ref_valid_table = ref_valid_table[ref_valid_table["trigger_number"] != event_builder.MAX_64BIT_TAG]
+
+    correlation_table = np.empty(len(monopix_match_table), dtype=[("event_number", "<i8"), ("dut_col", "u1"), ("dut_row", "u2"), ("ref_col", "u1"), ("ref_row", "u2")])
+    _, n_correlated = event_builder_utils.correlate_ev(monopix_match_table, correlation_table, ref_valid_table)
+    monopix_match_table = monopix_match_table[monopix_match_table["trigger_number"] != event_builder.MAX_64BIT_TAG]
+    correlation_table = correlation_table[:n_correlated]
+
+    # Phases sorted by the fraction of the hits in the Time-walk peak bin
+    phase_ref = np.int64(monopix_match_table["rx1_timestamp"]) & 0xF
+    diff = np.int64(monopix_match_table["le_timestamp"] - monopix_match_table["rx1_timestamp"])
+    phase_fraction = []
+    for ph in np.arange(0, 16):
+        hist = np.histogram(diff[phase_ref == ph], bins=np.arange(-0x10000, 0x10000, 0x1))[0]
+        max_i = np.argmax(hist)
+        phase_fraction.append(float(hist[max_i]) / float(hist[max_i] + hist[max_i - 16] + hist[max_i + 16]))
+    phase_quality = List([x for y, x in sorted(zip(phase_fraction, np.arange(0, 16)), reverse=True)])
+    event_builder_utils.calculate_phase_in_FE(ref_valid_table, phase_quality)
+
+    event_table = np.empty(len(monopix_match_table), dtype=[("event_number", "<i8"), ("column", "<u2"), ("row", "<u2"), ("frame", "<u2"), ("charge", "<f4"),
+                                                           ("tot", "<f4"), ("phase", "u1"), ("phase_quality", "u1"), ("veto_flg", "u1")])
+    event_builder_utils.fill_event_table(event_table, monopix_match_table, phase_quality, None)
+    hist = np.histogram(diff, bins=np.arange(-0x10000, 0x10000, 0x1))
+    amp, mean, width, sigma = analysis_utils.fit_boxfc(hist[1][:-1], hist[0])
+    diff_offset = mean - np.abs(width) / 2.0
+    lower_lim = round(diff_offset - 1 * np.abs(width) - 5 * np.abs(sigma), 0)
+    upper_lim = round(diff_offset + 10 * np.abs(width) + 5 * np.abs(sigma), 0)
+    frame = diff - diff_offset + 32
+    event_table["frame"] = np.uint16(frame)
+    event_table = event_table[np.bitwise_and(frame <= upper_lim - diff_offset + 32, frame >= lower_lim - diff_offset + 32)]
+
+    return {'TLU': tlu_match_table, 'Correlation': correlation_table, 'Hits': event_table, 'FE': ref_valid_table}
+
+
+class TestEventBuilder(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        raw_data_file = os.path.join(cls.tmp_dir, 'raw_data.h5')
+        cls.ref_file = os.path.join(cls.tmp_dir, 'ref.h5')
+        RawDataGenerator(scan_id='scan_source', seed=4).generate(raw_data_file, '1MB', ref_file=cls.ref_file)
+        cls.interpreted_file = os.path.join(cls.tmp_dir, 'raw_data_interpreted.h5')
+        with tb.open_file(raw_data_file) as in_file:
+            hits, _ = Interpreter().interpret_data(in_file.root.raw_data[:], meta_data=in_file.root.meta_data[:])
+        with tb.open_file(cls.interpreted_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Dut', obj=hits)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def _build_events(self, name, chunk_size, ref_file=None):
+        out_dir = os.path.join(self.tmp_dir, name)
+        os.makedirs(out_dir)
+        shutil.copy(self.ref_file if ref_file is None else ref_file, os.path.join(out_dir, 'ref.h5'))
+        ref_file = os.path.join(out_dir, 'ref.h5')
+        event_builder.build_events(self.interpreted_file, ref_file, os.path.join(out_dir, 'ev.h5'), None, chunk_size=chunk_size)
+        self.assertEqual(sorted(os.listdir(out_dir)), ['ev.h5', 'ref.h5', 'ref_valid.h5'])  # Temporary file removed
+        tables = {}
+        with tb.open_file(os.path.join(out_dir, 'ev.h5')) as in_file:
+            for node in ['TLU', 'Correlation', 'Hits']:
+                tables[node] = in_file.get_node(in_file.root, node)[:]
+        with tb.open_file(os.path.join(out_dir, 'ref_valid.h5')) as in_file:
+            tables['FE'] = in_file.root.Hits[:]
+        return tables
+
+    def test_chunk_size(self):
+        # Same events as the original builder, for clean data the search distance of the linear search is sufficient
+        tables = build_events_in_memory(self.interpreted_file, self.ref_file)
+        self.assertGreater(tables['Hits'].shape[0], 0)
+        self.assertTrue(np.all(np.diff(tables['TLU']['trigger_number']) > 0))
+        self.assertTrue(np.all(np.isin(tables['Hits']['event_number'], tables['FE']['event_number'])))
+        for name, chunk_size in [('full', 10 ** 7), ('chunked', 50)]:
+            tables_chunked = self._build_events(name, chunk_size=chunk_size)
+            for node, data in tables.items():
+                self.assertEqual(data.dtype, tables_chunked[node].dtype)
+                self.assertTrue(np.array_equal(data, tables_chunked[node]), (name, node))
+
+    def test_hits_after_last_fe_event(self):
+        # FE-I4 data ends before the Monopix data
+        ref_file = os.path.join(self.tmp_dir, 'ref_cut.h5')
+        with tb.open_file(self.ref_file) as in_file:
+            ref = in_file.root.Hits[:]
+        with tb.open_file(ref_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Hits', obj=ref[ref['event_number'] <= ref['event_number'][len(ref) * 4 // 5]])
+        tables = self._build_events('ref_cut', chunk_size=100, ref_file=ref_file)
+        last_event = tables['FE']['event_number'][-1]
+        self.assertTrue(np.all(tables['Hits']['event_number'] <= last_event))
+        self.assertTrue(np.all(np.isin(tables['Hits']['event_number'], tables['FE']['event_number'])))
+
+        # The original builder kept the hits after the last FE-I4 event, without correlation. Otherwise only the phase quality
+        # differs, since these hits were included in the phase statistics.
+        tables_in_memory = build_events_in_memory(self.interpreted_file, ref_file)
+        after_last = tables_in_memory['Hits']['event_number'] > last_event
+        self.assertGreater(np.count_nonzero(after_last), 0)
+        self.assertTrue(np.all(tables_in_memory['Correlation']['event_number'] <= last_event))
+        tables_in_memory['Hits'] = tables_in_memory['Hits'][~after_last]
+        for node, data in tables_in_memory.items():
+            ignored = {'Hits': ['phase_quality'], 'FE': ['TDC_trigger_distance']}.get(node, [])
+            self.assertEqual(data.dtype, tables[node].dtype)
+            self.assertEqual(data.shape, tables[node].shape)
+            for name in data.dtype.names:
+                if name not in ignored:
+                    self.assertTrue(np.array_equal(data[name], tables[node][name]), (node, name))
+
+    def test_align_tlu_trigger_number(self):
+        trigger_number = (np.cumsum(np.random.default_rng(0).integers(1, 100, 5000)) + 0xFF00) & 0xFFFF
+        dat = np.zeros(len(trigger_number), dtype=[('cnt', '<u8')])
+        tlu_mask = np.ones(len(trigger_number), dtype=bool)
+        event_builder.align_tlu_trigger_number(tlu_mask, trigger_number.astype(np.int64), dat)
+        dat_chunked = np.zeros_like(dat)
+        last_trigger_n = None
+        for start in range(0, len(trigger_number), 777):
+            chunk = dat_chunked[start:start + 777]
+            last_trigger_n = event_builder.align_tlu_trigger_number(tlu_mask[start:start + 777], trigger_number[start:start + 777].astype(np.int64), chunk, last_trigger_n)
+            dat_chunked[start:start + 777] = chunk
+        self.assertTrue(np.array_equal(dat, dat_chunked))
+        self.assertTrue(np.all(np.diff(dat['cnt'].astype(np.int64)) > 0))
+        self.assertRaises(ValueError, event_builder.align_tlu_trigger_number, tlu_mask[:2], np.array([5, 5]), dat[:2], last_trigger_n)
+
+    def _word_stream(self, n_words, seed):
+        # Random order of tagged words with long distances between matching words
+        rng = np.random.default_rng(seed)
+        dat = np.zeros(n_words, dtype=Interpreter.hit_dtype)
+        dat['col'] = rng.choice([event_builder.RX640_TAG, event_builder.TLU640_TAG, event_builder.TLU_TAG, event_builder.HITOR640_TAG, 0, 10, 55],
+                                n_words, p=[0.05, 0.05, 0.05, 0.05, 0.3, 0.3, 0.2])
+        dat['row'] = rng.integers(0, 340, n_words)
+        dat['le'] = rng.integers(0, 64, n_words)
+        dat['te'] = rng.integers(0, 64, n_words)
+        dat['timestamp'] = np.cumsum(rng.integers(0, 3, n_words)) << 4
+        tlu_mask = dat['col'] == event_builder.TLU_TAG
+        dat['cnt'][tlu_mask] = np.cumsum(rng.integers(1, 3, np.count_nonzero(tlu_mask)))
+        return dat
+
+    def test_sorted_word_matchers(self):
+        dat = self._word_stream(3000, 5)
+        n_tlu = np.count_nonzero(dat['col'] == event_builder.TLU640_TAG)
+        n_mono = np.count_nonzero(dat['col'] < event_builder.MONO_COL_SIZE)
+        for linear, sorted_, dtype, n_rows in [(event_builder_utils.assign_timestamps_to_tlu_hr, event_builder_utils.assign_timestamps_to_tlu_hr_sorted, event_builder.TLU_MATCH_DTYPE, n_tlu),
+                                               (event_builder_utils.assign_tlu_to_monopix, event_builder_utils.assign_tlu_to_monopix_sorted, event_builder.MONOPIX_MATCH_DTYPE, n_mono)]:
+            # The linear search finds the same words with an unlimited search distance
+            table, table_sorted, table_window = np.zeros(n_rows, dtype=dtype), np.zeros(n_rows, dtype=dtype), np.zeros(n_rows, dtype=dtype)
+            linear(dat, table, len(dat) + 1)
+            self.assertEqual(sorted_(dat, table_sorted), n_rows)
+            self.assertTrue(np.array_equal(table, table_sorted))
+            linear(dat, table_window, event_builder.WORD_SEARCH_DISTANCE)
+            found = table_window['trigger_number'] != event_builder.MAX_64BIT_TAG
+            self.assertGreater(np.count_nonzero(table_sorted['trigger_number'] != event_builder.MAX_64BIT_TAG), np.count_nonzero(found))
+            for name in ['trigger_number', 'rx1_timestamp', 'tlu_HR_timestamp']:  # Words found within the search distance
+                found = table_window[name] != event_builder.MAX_64BIT_TAG
+                self.assertTrue(np.array_equal(table_window[name][found], table_sorted[name][found]))
+
+    def test_chunked_word_matchers(self):
+        words_file = os.path.join(self.tmp_dir, 'words.h5')
+        with tb.open_file(words_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Dut', obj=self._word_stream(3000, 6))
+        tables = []
+        with tb.open_file(words_file) as in_file:
+            for chunk_size in [10 ** 6, 100, 7]:
+                with tb.open_file(os.path.join(self.tmp_dir, 'words_tmp_%d.h5' % chunk_size), 'w') as tmp_h5:
+                    tlu_hist = event_builder.match_tlu_and_monopix(in_file.root.Dut, tmp_h5, chunk_size)
+                    tables.append((tlu_hist, tmp_h5.root.TLU[:], tmp_h5.root.Monopix[:]))
+        self.assertGreater(len(tables[0][2]), 0)
+        for tlu_hist, tlu, monopix in tables[1:]:
+            self.assertTrue(np.array_equal(tlu_hist, tables[0][0]))
+            self.assertTrue(np.array_equal(tlu, tables[0][1]))
+            self.assertTrue(np.array_equal(monopix, tables[0][2]))
+
+    def test_sorted_trigger_joins(self):
+        rng = np.random.default_rng(7)
+        tlu = np.zeros(2000, dtype=event_builder.TLU_MATCH_DTYPE)
+        tlu['trigger_number'] = np.sort(rng.choice(np.arange(1, 4000), 2000, replace=False))
+        tlu['rx1_timestamp'] = rng.integers(0, 2 ** 40, 2000)
+        monopix = np.zeros(5000, dtype=event_builder.MONOPIX_MATCH_DTYPE)
+        monopix['trigger_number'] = np.sort(rng.integers(0, 4100, 5000))
+        index = np.minimum(np.searchsorted(tlu['trigger_number'], monopix['trigger_number']), len(tlu) - 1)
+        found = tlu['trigger_number'][index] == monopix['trigger_number']
+        event_builder_utils.assign_rx1_sorted(monopix, tlu)
+        self.assertTrue(np.array_equal(monopix['trigger_number'] != event_builder.MAX_64BIT_TAG, found))
+        self.assertTrue(np.array_equal(monopix['rx1_timestamp'][found], tlu['rx1_timestamp'][index[found]]))
+
+        with tb.open_file(self.ref_file) as in_file:
+            ref = in_file.root.Hits[:]
+        ref = ref[ref['event_number'] < 4000]
+        ref['trigger_number'][::5] += 1  # Corrupted FE-I4 trigger numbers
+        index = np.minimum(np.searchsorted(tlu['trigger_number'], ref['event_number']), len(tlu) - 1)
+        valid = (tlu['trigger_number'][index] == ref['event_number']) & ((ref['trigger_number'] & 0xFFFF) == (ref['event_number'] & 0xFFFF))
+        ref_valid = np.zeros_like(ref)
+        self.assertEqual(event_builder_utils.assign_rx1_to_FE_sorted(ref, tlu, ref_valid), np.count_nonzero(valid))
+        ref_valid = ref_valid[:np.count_nonzero(valid)]
+        self.assertTrue(np.array_equal(ref_valid['event_number'], ref['event_number'][valid]))
+        self.assertTrue(np.array_equal(ref_valid['TDC'], tlu['rx1_timestamp'][index[valid]].astype(ref.dtype['TDC'])))
+
+        monopix = monopix[monopix['trigger_number'] != event_builder.MAX_64BIT_TAG]
+        correlation = np.zeros(len(monopix), dtype=event_builder.CORRELATION_DTYPE)
+        first = np.minimum(np.searchsorted(ref_valid['event_number'], monopix['trigger_number']), len(ref_valid) - 1)
+        found = ref_valid['event_number'][first] == monopix['trigger_number']
+        _, n_correlated = event_builder_utils.correlate_ev_sorted(monopix, correlation, ref_valid)
+        self.assertEqual(n_correlated, np.count_nonzero(found))
+        self.assertTrue(np.array_equal(monopix['trigger_number'] != event_builder.MAX_64BIT_TAG, found))
+        self.assertTrue(np.array_equal(correlation['ref_row'][:n_correlated], ref_valid['row'][first[found]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from monopix2_daq.fifo_readout import FifoReadout
+
+
+class FifoStub(object):
+    ''' SRAM FIFO returning scripted FIFO_SIZE values (bytes, 0 when the script is empty) '''
+
+    def __init__(self):
+        self.fifo_size = []
+        self.error = None  # Raised by reading FIFO_SIZE
+
+    def __getitem__(self, key):
+        if key == 'FIFO_SIZE':
+            if self.error is not None:
+                raise self.error
+            return self.fifo_size.pop(0) if self.fifo_size else 0
+        return 0
+
+    def get_data(self):
+        return np.arange(10, dtype=np.uint32)
+
+
+class ConfStub(dict):
+
+    def write(self):
+        pass
+
+
+class ChannelStub(object):
+    LOST_COUNT = 0
+    LOST_DATA_COUNTER = 0
+
+
+class TestFifoReadout(unittest.TestCase):
+
+    def setUp(self):
+        self.dut = {'fifo': FifoStub(), 'CONF': ConfStub()}
+        for channel in ['data_rx', 'timestamp_inj', 'timestamp_mon', 'timestamp_tlu', 'timestamp_rx1', 'tlu']:
+            self.dut[channel] = ChannelStub()
+        self.fifo_readout = FifoReadout(self.dut, logLevel=logging.WARNING)
+
+    def test_adapt_interval(self):
+        fr = self.fifo_readout
+        fr.readout_interval = 0.05
+        fr.max_readout_interval = 0.02
+        fr.target_words_per_read = 1000
+        fr._interval = fr.readout_interval
+        fr.reset_interval_stats()
+
+        def adapt(data_words, fifo_words):
+            self.dut['fifo'].fifo_size.append(4 * fifo_words)
+            return fr._adapt_interval(data_words)
+
+        self.assertAlmostEqual(adapt(1500, 600), 0.025)  # Above 2 * target: halved
+        self.assertEqual(adapt(2000, 1200), 0.0)  # FIFO holds more than target: read again immediately
+        self.assertAlmostEqual(fr.current_readout_interval, 0.0125)
+        self.assertAlmostEqual(adapt(2000, 0), 0.0125)  # At 2 * target: unchanged
+        for _ in range(10):
+            adapt(2001, 0)
+        self.assertAlmostEqual(fr.current_readout_interval, fr.min_readout_interval)  # Clamped
+        self.assertAlmostEqual(adapt(100, 100), 1.25 * fr.min_readout_interval)  # Below target / 4: lengthened
+        self.assertAlmostEqual(adapt(500, 0), 1.25 * fr.min_readout_interval)  # In between: unchanged
+        for _ in range(30):
+            adapt(0, 0)
+        self.assertAlmostEqual(fr.current_readout_interval, fr.max_readout_interval)  # Clamped
+
+        stats = fr.get_interval_stats()
+        self.assertEqual(stats['reads'], 45)
+        self.assertEqual(stats['immediate_reads'], 1)
+        self.assertEqual(stats['fifo_words_max'], 1200)
+        self.assertEqual(stats['words_per_read_max'], 2001)
+        self.assertAlmostEqual(stats['interval'], fr.max_readout_interval)
+        self.assertAlmostEqual(stats['interval_min'], fr.min_readout_interval)
+        self.assertAlmostEqual(stats['interval_max'], 0.025)
+        self.assertTrue(fr.min_readout_interval < stats['interval_avg'] < fr.max_readout_interval)
+
+        # Without reads the current interval is reported
+        fr.reset_interval_stats()
+        stats = fr.get_interval_stats()
+        self.assertEqual((stats['reads'], stats['interval_min'], stats['interval_max'], stats['interval_avg']), (0,) + (fr.current_readout_interval,) * 3)
+
+    def test_readout_metrics(self):
+        fr = self.fifo_readout
+        fr.rate_time_constant = 1.
+        clock = [100.]
+        with mock.patch('monopix2_daq.fifo_readout.monotonic', lambda: clock[0]):
+            fr.reset_readout_metrics()
+            metrics = fr.get_readout_metrics()
+            self.assertEqual((metrics['words'], metrics['reads'], metrics['words_per_second'], metrics['words_per_second_avg']), (0, 0, 0., 0.))
+
+            # 1000 words every 100 ms, the rates approach 10000 words/s and 10 reads/s with the time constant
+            for _ in range(10):
+                clock[0] += 0.1
+                fr._update_readout_metrics(1000)
+            metrics = fr.get_readout_metrics()
+            self.assertEqual((metrics['words'], metrics['bytes'], metrics['reads']), (10000, 40000, 10))
+            self.assertAlmostEqual(metrics['words_per_second'], 10000. * (1. - np.exp(-1.)))
+            self.assertAlmostEqual(metrics['bytes_per_second'], 40000. * (1. - np.exp(-1.)))
+            self.assertAlmostEqual(metrics['reads_per_second'], 10. * (1. - np.exp(-1.)))
+            self.assertAlmostEqual(metrics['words_per_second_avg'], 10000.)
+            self.assertAlmostEqual(metrics['elapsed'], 1.)
+
+            # An empty read after 2 s decays the word rate, the read rate moves towards 0.5 reads/s
+            words_rate, reads_rate = metrics['words_per_second'], metrics['reads_per_second']
+            clock[0] += 2.
+            fr._update_readout_metrics(0)
+            metrics = fr.get_readout_metrics()
+            self.assertEqual((metrics['words'], metrics['reads']), (10000, 11))
+            self.assertAlmostEqual(metrics['words_per_second'], words_rate * np.exp(-2.))
+            self.assertAlmostEqual(metrics['reads_per_second'], 0.5 + (reads_rate - 0.5) * np.exp(-2.))
+            self.assertAlmostEqual(metrics['words_per_second_avg'], 10000. / 3.)
+
+            # Without time step only the counters change
+            words_rate, reads_rate = metrics['words_per_second'], metrics['reads_per_second']
+            fr._update_readout_metrics(500)
+            metrics = fr.get_readout_metrics()
+            self.assertEqual((metrics['words'], metrics['reads']), (10500, 12))
+            self.assertEqual((metrics['words_per_second'], metrics['reads_per_second']), (words_rate, reads_rate))
+
+    def test_fifo_size_error(self):
+        # A failing FIFO_SIZE read of the adaptive interval is passed to the errback and the readout stops cleanly
+        fr = self.fifo_readout
+        fr.adaptive_interval = True
+        fr.readout_interval = 0.01
+        errors, chunks = [], []
+
+        def errback(exc_info):
+            errors.append(exc_info[1])
+            fr.stop_readout.set()
+
+        fr.start(callback=chunks.append, errback=errback, ring_buffer=True)
+        self.dut['fifo'].error = IOError('FIFO_SIZE read failed')
+        time.sleep(0.1)
+        stop_thread = threading.Thread(target=fr.stop)
+        stop_thread.start()
+        stop_thread.join(5.)
+        self.assertFalse(stop_thread.is_alive())
+        self.assertIsInstance(errors[0], IOError)
+        self.assertFalse(fr.worker_thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
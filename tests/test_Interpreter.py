@@ -0,0 +1,100 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import unittest
+
+import numpy as np
+
+from monopix2_daq.analysis.interpreter import RawDataInterpreter, ParallelRawDataInterpreter, VectorizedRawDataInterpreter, OccupancyAccumulator, Interpreter, hit_dtype
+
+
+def create_raw_data(n_sequences, error_rate=0., seed=0):
+    ''' Random mix of Monopix data, timestamp640 and TLU words, optionally with corrupted and swapped words.
+    '''
+    rng = np.random.default_rng(seed)
+    timestamp_headers = [(0x43, 0x42, 0x41), (0x53, 0x52, 0x51), (0x63, 0x62, 0x61), (0x67, 0x66, 0x65), (0x73, 0x72, 0x71)]
+    words = []
+    for kind in rng.integers(0, 8, n_sequences):
+        if kind < 4:
+            words += [rng.integers(0, 2 ** 27), 0x08000000 | rng.integers(0, 2 ** 25), 0x0A000000 | rng.integers(0, 2 ** 25)]
+        elif kind < 7:
+            words += [(h << 24) | rng.integers(0, 2 ** 24) for h in timestamp_headers[rng.integers(0, len(timestamp_headers))]]
+        else:
+            words.append(0x80000000 | rng.integers(0, 2 ** 31))
+    raw_data = np.array(words, dtype=np.uint32)
+    if error_rate > 0:
+        sel = rng.random(raw_data.shape[0]) < error_rate
+        raw_data[sel] = rng.integers(0, 2 ** 32, np.count_nonzero(sel))
+        swap = np.flatnonzero(rng.random(raw_data.shape[0] - 1) < error_rate)
+        raw_data[swap], raw_data[swap + 1] = raw_data[swap + 1].copy(), raw_data[swap].copy()
+    return raw_data
+
+
+class TestInterpreter(unittest.TestCase):
+
+    def check_identical(self, raw_data, chunk_size, meta_data=None):
+        hits = []
+        interpreters = [RawDataInterpreter(), VectorizedRawDataInterpreter(block_size=5000), ParallelRawDataInterpreter(n_threads=4, min_part_size=100)]
+        for data_interpreter in interpreters:
+            chunks = []
+            for start in range(0, raw_data.shape[0], chunk_size):
+                hit_buffer = np.zeros(chunk_size, dtype=hit_dtype)
+                chunks.append(data_interpreter.interpret(raw_data[start:start + chunk_size], meta_data, hit_buffer))
+            hits.append(np.concatenate(chunks))
+        self.assertGreater(hits[0].shape[0], 0)
+        for i in range(1, len(interpreters)):
+            self.assertTrue(np.array_equal(hits[0], hits[i]))
+            self.assertEqual(interpreters[0].get_error_count(), interpreters[i].get_error_count())
+
+    def test_without_errors(self):
+        self.check_identical(create_raw_data(10000), chunk_size=7777)
+
+    def test_with_errors(self):
+        for error_rate in (0.001, 0.05):
+            self.check_identical(create_raw_data(10000, error_rate=error_rate, seed=1), chunk_size=6000)
+
+    def test_meta_data(self):
+        raw_data = create_raw_data(10000, error_rate=0.001, seed=2)
+        index = np.linspace(0, raw_data.shape[0], 101).astype(np.uint32)
+        meta_data = np.zeros(100, dtype=[('index_start', '<u4'), ('index_stop', '<u4'), ('scan_param_id', '<u2')])
+        meta_data['index_start'] = index[:-1]
+        meta_data['index_stop'] = index[1:]
+        meta_data['scan_param_id'] = np.arange(100) // 4
+        self.check_identical(raw_data, chunk_size=3000, meta_data=meta_data)
+
+    def test_occupancy_accumulator(self):
+        raw_data = create_raw_data(10000, error_rate=0.001, seed=3)
+        hits = RawDataInterpreter().interpret(raw_data, None, np.zeros(raw_data.shape[0], dtype=hit_dtype))
+        hits = hits[np.logical_and(hits["cnt"] < 2, np.logical_and(hits["col"] < 56, hits["row"] < 340))]
+        expected = np.histogram2d(hits["col"], hits["row"], bins=[np.arange(57), np.arange(341)])[0]
+        occupancy = OccupancyAccumulator()
+        for start in range(0, raw_data.shape[0], 1001):
+            occupancy.add(raw_data[start:start + 1001])
+        self.assertGreater(expected.sum(), 0)
+        self.assertTrue(np.array_equal(occupancy.occupancy, expected))
+        self.assertEqual(occupancy.n_words, raw_data.shape[0])
+        occupancy.reset()
+        self.assertEqual(occupancy.occupancy.sum(), 0)
+
+    def test_interpret_data(self):
+        raw_data = create_raw_data(10000, error_rate=0.001, seed=4)
+        data_interpreter = RawDataInterpreter()
+        expected = data_interpreter.interpret(raw_data, None, np.zeros(raw_data.shape[0], dtype=Interpreter.hit_dtype))
+        for chunk_size in (1000, 5000, 100000):
+            hit_data, error_cnt = Interpreter().interpret_data(raw_data, chunk_size=chunk_size)
+            self.assertTrue(np.array_equal(hit_data, expected))
+            self.assertEqual(error_cnt, data_interpreter.get_error_count())
+            hit_chunks = [hits.copy() for hits in Interpreter().iter_interpret_data(raw_data, chunk_size=chunk_size)]
+            self.assertTrue(np.array_equal(np.concatenate(hit_chunks), expected))
+        # Only TLU words: one hit per word, the result array has to grow
+        raw_data = np.arange(5000, dtype=np.uint32) | np.uint32(0x80000000)
+        hit_data, _ = Interpreter().interpret_data(raw_data, chunk_size=1000)
+        self.assertEqual(hit_data.shape[0], raw_data.shape[0])
+        self.assertEqual(Interpreter().interpret_data(raw_data[:0])[0].shape[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
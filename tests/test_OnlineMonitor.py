@@ -0,0 +1,179 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import queue
+import threading
+import time
+import unittest
+
+import numpy as np
+import zmq
+
+from monopix2_daq.online_monitor.lfmonopix2_inter import LFMonopix2
+from monopix2_daq.scan_base import send_data, send_data_multipart
+
+
+def create_raw_data(n_hits, seed=0):
+    ''' Monopix data words (column, row, LE and TE) of pixels on the matrix, each followed by the two timestamp words.
+    '''
+    rng = np.random.default_rng(seed)
+    col, row = rng.integers(0, 56, n_hits), rng.integers(0, 340, n_hits)
+    le, te = rng.integers(0, 64, n_hits), rng.integers(0, 64, n_hits)
+    raw_data = np.empty((n_hits, 3), dtype=np.uint32)
+    raw_data[:, 0] = (col << 21) | (te << 15) | (le << 9) | row
+    raw_data[:, 1] = 0x08000000 | rng.integers(0, 2 ** 25, n_hits)
+    raw_data[:, 2] = 0x0A000000 | rng.integers(0, 2 ** 25, n_hits)
+    return raw_data.ravel()
+
+
+class TestOnlineMonitor(unittest.TestCase):
+
+    def create_converter(self, **kwargs):
+        converter = LFMonopix2(frontend='tcp://127.0.0.1:5500', backend='tcp://127.0.0.1:5501', kind='lfmonopix2_converter', loglevel='WARNING', **kwargs)
+        converter.setup_interpretation()
+        return converter
+
+    def interpret(self, converter, raw_data, chunk_sizes, index=0):
+        ''' Readouts of the given sizes starting at index, returns the published frames '''
+        frames = []
+        for i, chunk_size in enumerate(chunk_sizes):
+            meta_data = {'timestamp_start': i * 0.1, 'timestamp_stop': i * 0.1 + 0.1, 'error': 0, 'scan_param_id': 0,
+                         'index_start': index, 'index_stop': index + chunk_size}
+            frames += converter.interpret_data([('tcp://127.0.0.1:5500', (raw_data[index:index + chunk_size], meta_data))]) or []
+            index += chunk_size
+        return frames
+
+    def start_recv_data(self, converter):
+        ''' Poll loop without frontends, it only queues publish requests '''
+        converter.frontends = []
+        converter.fe_poller = zmq.Poller()
+        converter.raw_data = queue.Queue()
+        converter.fe_stop = threading.Event()
+        recv_thread = threading.Thread(target=converter.recv_data)
+        recv_thread.start()
+        return recv_thread
+
+    def apply(self, occupancy, frame):
+        ''' Occupancy map of the receiver after the frame '''
+        if 'occupancy' in frame:
+            return frame['occupancy'].copy()
+        changed, values = frame['occupancy_delta']
+        occupancy.ravel()[changed] = values
+        return occupancy
+
+    def test_wire_format(self):
+        raw_data = create_raw_data(1000)
+        readouts = [raw_data[:1200], raw_data[1200:1200], raw_data[1200:2400:2], raw_data[2400:]]  # Also empty and not contiguous
+        context = zmq.Context.instance()
+        sender, receiver = context.socket(zmq.PAIR), context.socket(zmq.PAIR)
+        receiver.bind('inproc://test_wire_format')
+        sender.connect('inproc://test_wire_format')
+        converter = self.create_converter(max_refresh_rate=0)
+        try:
+            for send, copy in [(send_data_multipart, True), (send_data_multipart, False), (send_data, None)]:
+                index = 0
+                for i, data in enumerate(readouts):
+                    kwargs = {} if copy is None else {'copy': copy}
+                    send(sender, (data, 0.1 * i, 0.1 * i + 0.05, i % 2), scan_param_id=3, index_start=index, index_stop=index + len(data),
+                         data_length=len(data), **kwargs)
+                    frames = receiver.recv_multipart(copy=False)
+                    self.assertEqual(len(frames), 1 if send is send_data else 2)
+                    decoded, meta_data = converter.deserialize_data(frames)
+                    self.assertEqual(decoded.dtype, np.uint32)
+                    self.assertEqual(decoded.shape, data.shape)
+                    self.assertTrue(np.array_equal(decoded, data))
+                    self.assertEqual((meta_data['index_start'], meta_data['index_stop'], meta_data['data_length']), (index, index + len(data), len(data)))
+                    self.assertEqual((meta_data['timestamp_start'], meta_data['timestamp_stop'], meta_data['error'], meta_data['scan_param_id']),
+                                     (0.1 * i, 0.1 * i + 0.05, i % 2, 3))
+                    if send is send_data_multipart:
+                        self.assertNotIn('dtype', meta_data)
+                        self.assertNotIn('shape', meta_data)
+                    index += len(data)
+        finally:
+            sender.close()
+            receiver.close()
+
+    def test_chunked(self):
+        raw_data = create_raw_data(20000)
+        reference = self.create_converter(max_refresh_rate=0)
+        self.interpret(reference, raw_data, [raw_data.shape[0]])
+        self.assertGreater(reference.total_hits, 0)
+
+        # Hits split between readouts are continued, every readout is published without rate limit
+        converter = self.create_converter(max_refresh_rate=0)
+        chunk_sizes = np.diff(np.r_[0, np.sort(np.random.default_rng(1).choice(raw_data.shape[0], 500, replace=False)), raw_data.shape[0]])
+        frames = self.interpret(converter, raw_data, chunk_sizes)
+        self.assertEqual(len(frames), chunk_sizes.shape[0])
+        self.assertEqual(converter.total_hits, reference.total_hits)
+        self.assertEqual(converter.partial_hits, 0)
+        self.assertTrue(np.array_equal(converter.hist_occ, reference.hist_occ))
+        self.assertTrue(np.array_equal(converter.hist_tot, reference.hist_tot))
+        self.assertTrue(np.array_equal(converter.hist_tot_all, reference.hist_tot_all))
+
+        # Mostly deltas, the receiver gets the same occupancy
+        self.assertIn('occupancy', frames[0])
+        self.assertGreater(sum('occupancy_delta' in frame for frame in frames), chunk_sizes.shape[0] // 2)
+        occupancy = None
+        for frame in frames:
+            occupancy = self.apply(occupancy, frame)
+        self.assertTrue(np.array_equal(occupancy, reference.hist_occ))
+
+    def test_rate_limit(self):
+        raw_data = create_raw_data(1000)
+        converter = self.create_converter(max_refresh_rate=1.)
+        frames = self.interpret(converter, raw_data, [300] * 10)
+        self.assertEqual(len(frames), 1)  # Only the first readout
+        self.assertTrue(converter.publish_pending)
+        occupancy = self.apply(None, frames[0])
+
+        # The held back readouts are published by the poll loop after the refresh interval, without new data
+        recv_thread = self.start_recv_data(converter)
+        try:
+            self.assertIsNone(converter.raw_data.get(timeout=5.))
+            self.assertGreaterEqual(time.time() - converter.ts_last_publish, 1.)
+            self.assertTrue(converter.raw_data.empty())  # Queued once
+            frames = converter.interpret_data(None)
+        finally:
+            converter.fe_stop.set()
+            recv_thread.join()
+        self.assertEqual(len(frames), 1)
+        self.assertFalse(converter.publish_pending)
+        self.assertEqual(frames[0]['meta_data']['index_stop'], 3000)
+        self.assertEqual(frames[0]['meta_data']['total_hits'], converter.total_hits)
+        occupancy = self.apply(occupancy, frames[0])
+        self.assertTrue(np.array_equal(occupancy, converter.hist_occ))
+        self.assertIsNone(converter.interpret_data(None))  # Nothing new
+
+        # The last readout before an integration reset is always published
+        converter.handle_command(['RESET'])
+        converter.handle_command(['3'])
+        frames = self.interpret(converter, raw_data, [300] * 3)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(converter.total_hits, 0)
+
+    def test_omitted_publish_request(self):
+        raw_data = create_raw_data(1000)
+        converter = self.create_converter(max_refresh_rate=5.)
+        self.assertEqual(len(self.interpret(converter, raw_data, [300] * 2)), 1)
+        recv_thread = self.start_recv_data(converter)
+        try:
+            self.assertIsNone(converter.raw_data.get(timeout=5.))  # Omitted by the converter, e.g. queue above max_buffer
+            ts_request = time.time()
+            self.assertIsNone(converter.raw_data.get(timeout=5.))  # Requested again without new data
+            self.assertGreaterEqual(time.time() - ts_request, 0.15)
+            frames = converter.interpret_data(None)
+            self.assertEqual(len(frames), 1)
+            self.assertEqual(frames[0]['meta_data']['index_stop'], 600)
+            self.assertFalse(converter.publish_pending)
+            time.sleep(0.5)
+            self.assertTrue(converter.raw_data.empty())  # Nothing held back
+        finally:
+            converter.fe_stop.set()
+            recv_thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
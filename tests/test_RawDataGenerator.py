@@ -0,0 +1,96 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables as tb
+import yaml
+
+from monopix2_daq.analysis.interpreter import Interpreter
+from monopix2_daq.sim.raw_data_generator import RawDataGenerator, merge_sequences, parse_size
+
+
+class TestRawDataGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.raw_data_file = os.path.join(self.tmp_dir, 'raw_data.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _interpret(self):
+        with tb.open_file(self.raw_data_file) as in_file:
+            raw_data = in_file.root.raw_data[:]
+            meta_data = in_file.root.meta_data[:]
+            kwargs = yaml.full_load(in_file.root.kwargs[0])
+            self.assertTrue(np.all(meta_data['index_stop'][:-1] == meta_data['index_start'][1:]))
+            self.assertEqual(meta_data['index_stop'][-1], raw_data.shape[0])
+            self.assertEqual(sorted(in_file.root.pixel_conf._v_children), ['EnInj', 'EnMonitor', 'EnPre', 'Trim'])
+        return raw_data, meta_data, kwargs
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1MB'), 1024 ** 2)
+        self.assertEqual(parse_size('2.5 GB'), int(2.5 * 1024 ** 3))
+        self.assertEqual(parse_size('4096'), 4096)
+        self.assertRaises(ValueError, parse_size, '1 XB')
+
+    def test_merge_sequences(self):
+        raw_data = merge_sequences([(np.array([5, 1]), np.array([[50, 51, 52], [10, 11, 12]])), (np.array([3]), np.array([[30]]))])
+        self.assertTrue(np.array_equal(raw_data, [10, 11, 12, 30, 50, 51, 52]))
+
+    def test_scan_threshold(self):
+        n_words = RawDataGenerator(scan_id='scan_threshold', seed=1).generate(self.raw_data_file, '1MB')
+        self.assertAlmostEqual(n_words / (1024 ** 2 / 4.), 1, delta=0.05)
+        raw_data, meta_data, kwargs = self._interpret()
+        hits, error_cnt = Interpreter().interpret_data(raw_data, meta_data=meta_data)
+        self.assertEqual(error_cnt, 0)
+        scan_param_range = np.arange(*kwargs['injlist_param'])
+        inj = hits[hits['col'] == 0xFC]
+        self.assertEqual(inj.shape[0], scan_param_range.shape[0] * kwargs['inj_n_param'])
+        self.assertTrue(np.all(np.diff(inj['timestamp']) > 0))
+        # S-curves: no hits far below, all pulses far above the threshold
+        hits = hits[hits['col'] < 56]
+        n_pixels = np.unique(hits['col'].astype(np.int64) * 340 + hits['row']).shape[0]
+        counts = np.bincount(hits['scan_param_id'], minlength=scan_param_range.shape[0])
+        self.assertEqual(counts[scan_param_range < 0.15].sum(), 0)
+        self.assertTrue(np.all(counts[scan_param_range > 0.4] == n_pixels * kwargs['inj_n_param']))
+
+    def test_scan_source(self):
+        ref_file = os.path.join(self.tmp_dir, 'ref.h5')
+        word_mix = {'monopix': 3, 'mon': 0.5}
+        n_words = RawDataGenerator(scan_id='scan_source', word_mix=word_mix, seed=2).generate(self.raw_data_file, '1MB', ref_file=ref_file)
+        self.assertLessEqual(n_words, 1024 ** 2 // 4)
+        self.assertGreater(n_words, 0.99 * 1024 ** 2 // 4)
+        raw_data, meta_data, kwargs = self._interpret()
+        hits, error_cnt = Interpreter().interpret_data(raw_data)
+        self.assertEqual(error_cnt, 0)
+        tlu = hits[hits['col'] == 0xFF]
+        self.assertEqual(tlu.shape[0], kwargs['n_triggers'])  # Only complete triggers
+        self.assertTrue(np.all((np.diff(tlu['cnt'].astype(np.int64)) & 0xFFFF) == 1))
+        self.assertEqual(np.count_nonzero(hits['col'] == 0xFB), tlu.shape[0])
+        self.assertAlmostEqual(np.count_nonzero(hits['col'] < 56) / float(tlu.shape[0]), 3, delta=0.1)
+        self.assertAlmostEqual(np.count_nonzero(hits['col'] == 0xFD) / float(tlu.shape[0]), 0.5, delta=0.05)
+        with tb.open_file(ref_file) as in_file:
+            ref = in_file.root.Hits[:]
+        self.assertEqual(ref.shape[0], kwargs['n_triggers'])
+        self.assertTrue(np.array_equal(ref['event_number'] & 0xFFFF, tlu['cnt']))
+
+    def test_errors(self):
+        generator = RawDataGenerator(scan_id='scan_source', error_rate=0.01, seed=3)
+        n_words = generator.generate(self.raw_data_file, '1MB')
+        self.assertGreater(generator.n_errors, 0)
+        self.assertLess(n_words, 1024 ** 2 // 4)
+        raw_data, _, _ = self._interpret()
+        self.assertGreater(Interpreter().interpret_data(raw_data)[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import shared_memory
+
+import numpy as np
+import tables as tb
+
+from monopix2_daq.raw_data_writer import RawDataWriter, RawDataWriterProcess
+from monopix2_daq.scan_base import MetaTable
+
+
+class TestRawDataWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.chunks = []
+        for i, n_words in enumerate(rng.integers(0, 300, 200)):
+            meta = (i * 0.01, i * 0.01 + 0.005, int(rng.integers(0, 2)), i // 20)  # timestamp_start, timestamp_stop, error, scan_param_id
+            self.chunks.append((rng.integers(0, 2 ** 32, n_words, dtype=np.uint32), meta))
+        self.chunks.insert(50, (np.arange(5000, dtype=np.uint32), (0.5, 0.6, 0, 2)))  # Larger than the buffer
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _create_file(self, name):
+        h5_file = tb.open_file(os.path.join(self.tmp_dir, name), mode='w')
+        h5_file.create_earray(h5_file.root, name='raw_data', atom=tb.UIntAtom(), shape=(0,), title='raw_data')
+        h5_file.create_table(h5_file.root, name='meta_data', description=MetaTable, title='meta_data')
+        return h5_file
+
+    def _write_per_chunk(self):
+        # Every chunk appended as it arrives (ScanBase.handle_data without the RawDataWriter)
+        with self._create_file('per_chunk.h5') as h5_file:
+            raw_data_earray, meta_data_table = h5_file.root.raw_data, h5_file.root.meta_data
+            for data, (timestamp_start, timestamp_stop, error, scan_param_id) in self.chunks:
+                total_words = raw_data_earray.nrows
+                raw_data_earray.append(data)
+                raw_data_earray.flush()
+                meta_data_table.row['timestamp_start'] = timestamp_start
+                meta_data_table.row['timestamp_stop'] = timestamp_stop
+                meta_data_table.row['error'] = error
+                meta_data_table.row['data_length'] = data.shape[0]
+                meta_data_table.row['index_start'] = total_words
+                meta_data_table.row['index_stop'] = total_words + data.shape[0]
+                meta_data_table.row['scan_param_id'] = scan_param_id
+                meta_data_table.row.append()
+                meta_data_table.flush()
+            return raw_data_earray[:], meta_data_table[:]
+
+    def _read(self, name):
+        with tb.open_file(os.path.join(self.tmp_dir, name)) as h5_file:
+            return h5_file.root.raw_data[:], h5_file.root.meta_data[:]
+
+    def test_same_as_per_chunk(self):
+        raw_data, meta_data = self._write_per_chunk()
+        for buffer_size, max_rows in [(4 * 1024 ** 2, 10000), (1000, 7)]:
+            with self._create_file('bulk.h5') as h5_file:
+                writer = RawDataWriter(h5_file.root.raw_data, h5_file.root.meta_data, buffer_size=buffer_size, interval=100., max_rows=max_rows)
+                for data, meta in self.chunks:
+                    data_view = np.concatenate((data, data))[:data.shape[0]]  # Views are copied
+                    index_start, index_stop = writer.append(data_view, *meta)
+                    self.assertEqual(index_stop - index_start, data.shape[0])
+                writer.close()
+            bulk_raw_data, bulk_meta_data = self._read('bulk.h5')
+            self.assertTrue(np.array_equal(bulk_raw_data, raw_data))
+            self.assertEqual(bulk_meta_data.dtype, meta_data.dtype)
+            self.assertTrue(np.array_equal(bulk_meta_data, meta_data))
+
+    def test_flush_triggers(self):
+        with self._create_file('bulk.h5') as h5_file:
+            raw_data_earray, meta_data_table = h5_file.root.raw_data, h5_file.root.meta_data
+            # Nothing is written before the buffer is full
+            writer = RawDataWriter(raw_data_earray, meta_data_table, buffer_size=400, interval=100.)
+            writer.append(np.arange(60, dtype=np.uint32), 0., 0., 0, 0)
+            self.assertEqual((raw_data_earray.nrows, meta_data_table.nrows, writer.n_writes), (0, 0, 0))
+            writer.append(np.arange(40, dtype=np.uint32), 0., 0., 0, 0)  # Buffer (100 words) full
+            self.assertEqual((raw_data_earray.nrows, meta_data_table.nrows, writer.n_writes), (100, 2, 1))
+            writer.append(np.arange(60, dtype=np.uint32), 0., 0., 0, 0)
+            writer.append(np.arange(60, dtype=np.uint32), 0., 0., 0, 0)  # Does not fit, the previous chunk is written first
+            self.assertEqual((raw_data_earray.nrows, meta_data_table.nrows, writer.n_writes), (160, 3, 2))
+            # Written when the last write is older than the interval
+            writer.interval = 0.
+            writer.append(np.arange(10, dtype=np.uint32), 0., 0., 0, 0)
+            self.assertEqual((raw_data_earray.nrows, meta_data_table.nrows, writer.n_writes), (230, 5, 3))
+            writer.append(np.arange(0, dtype=np.uint32), 0., 0., 0, 0)  # Empty chunks get a meta data row
+            self.assertEqual((raw_data_earray.nrows, meta_data_table.nrows, writer.n_writes), (230, 6, 4))
+            writer.close()
+            self.assertEqual(writer.n_writes, 4)
+            self.assertTrue(np.array_equal(meta_data_table.col('index_stop'), [60, 100, 160, 220, 230, 230]))
+
+    def test_process(self):
+        raw_data, meta_data = self._write_per_chunk()
+        filename = os.path.join(self.tmp_dir, 'process.h5')
+        self._create_file('process.h5').close()
+        # Small shared memory: chunks wrap around and some are sent through the queue
+        writer = RawDataWriterProcess(filename, buffer_size=1000, interval=100., shm_size=4 * 2000)
+        shm_name = writer._shm.name
+        for i, (data, meta) in enumerate(self.chunks):
+            writer.append(data, *meta)
+            if i % 50 == 0:
+                writer.write()
+        writer.close()
+        self.assertFalse(writer._process.is_alive())
+        self.assertEqual(writer._process.exitcode, 0)
+        self.assertGreater(writer.spills, 0)
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, name=shm_name)  # Released
+        writer.close()  # Nothing to do
+        self.assertRaises(RuntimeError, writer.append, self.chunks[0][0], *self.chunks[0][1])
+        # The file can be opened again
+        with tb.open_file(filename, mode='a') as h5_file:
+            h5_file.root.meta_data.attrs.power_status = 'ok'
+        process_raw_data, process_meta_data = self._read('process.h5')
+        self.assertTrue(np.array_equal(process_raw_data, raw_data))
+        self.assertTrue(np.array_equal(process_meta_data, meta_data))
+
+    def test_process_terminated(self):
+        filename = os.path.join(self.tmp_dir, 'process.h5')
+        self._create_file('process.h5').close()
+        writer = RawDataWriterProcess(filename, interval=100.)
+        shm_name = writer._shm.name
+        writer.append(self.chunks[1][0], *self.chunks[1][1])
+        writer._process.terminate()  # e.g. killed during the scan
+        writer._process.join()
+        writer.append(self.chunks[2][0], *self.chunks[2][1])
+        writer.close()  # Does not block
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, name=shm_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
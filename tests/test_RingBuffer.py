@@ -0,0 +1,79 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+import unittest
+from threading import Thread
+
+import numpy as np
+
+from monopix2_daq.fifo_readout import RingBuffer
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_order_and_content(self):
+        rb = RingBuffer(size=1000, max_chunks=16)
+        chunks = [np.arange(i * 1000, i * 1000 + n, dtype=np.uint32) for i, n in enumerate(np.random.randint(0, 700, 500))]
+        received = []
+
+        def consumer():
+            while True:
+                item = rb.pop()
+                if item is None:
+                    break
+                received.append((item[0].copy(), item[1]))
+                rb.release()
+
+        t = Thread(target=consumer)
+        t.start()
+        for i, c in enumerate(chunks):
+            rb.push(c, i)
+        rb.close()
+        t.join()
+
+        self.assertEqual(len(received), len(chunks))
+        for i, (data, meta) in enumerate(received):
+            self.assertEqual(meta, i)
+            self.assertTrue(np.array_equal(data, chunks[i]))
+        self.assertLessEqual(rb.high_water_mark, rb.size)
+        self.assertEqual(rb.used, 0)
+
+    def test_view_and_spill(self):
+        rb = RingBuffer(size=100)
+        rb.push(np.ones(60, dtype=np.uint32), 0)
+        rb.push(np.ones(60, dtype=np.uint32) * 2, 1)  # does not fit, kept as it is
+        rb.push(np.ones(200, dtype=np.uint32) * 3, 2)  # larger than the buffer
+        data, _ = rb.pop()
+        self.assertTrue(np.shares_memory(data, rb._buffer))
+        rb.release()
+        for value in (2, 3):
+            data, _ = rb.pop()
+            self.assertFalse(np.shares_memory(data, rb._buffer))
+            self.assertTrue(np.all(data == value))
+            rb.release()
+        self.assertEqual(rb.spills, 2)
+        self.assertEqual(rb.used, 0)
+
+    def test_descriptors_in_use(self):
+        rb = RingBuffer(size=1000, max_chunks=2)
+        for i in range(5):  # does not wait for the consumer
+            rb.push(np.full(10, i, dtype=np.uint32), i)
+        self.assertEqual(rb.spills, 3)
+        for i in range(5):
+            data, meta = rb.pop()
+            self.assertEqual(meta, i)
+            self.assertTrue(np.all(data == i))
+            self.assertEqual(np.shares_memory(data, rb._buffer), i < 2)
+            rb.release()
+        self.assertEqual(rb.used, 0)
+        rb.push(np.full(10, 5, dtype=np.uint32), 5)  # descriptors released
+        self.assertEqual(rb.spills, 3)
+        data, meta = rb.pop()
+        self.assertTrue(np.shares_memory(data, rb._buffer) and np.all(data == 5) and meta == 5)
+
+
+if __name__ == '__main__':
+    unittest.main()